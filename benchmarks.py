@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""Contains the benchmarks that are run with ``python manage.py benchmark <name>``,
+and the benchmark suite of the prediction pipeline that is run with
+``python manage.py benchmark_suite``
+
+Every benchmark is a function that returns its measurements as a dictionary.
+"""
+
+import os
+import re
+import gc
+import json
+import time
+import random
+import platform
+import resource
+import importlib.util
+import multiprocessing
+import tracemalloc
+
+from django.conf import settings
+from django.test import override_settings
+
+from rules import VOCABULARY_PATH, COMPILED_MODIFIERS
+from vocabulary import CompactVocabulary
+
+def _traced(function):
+    """Runs a function and returns its result, the memory it kept allocated
+    and the peak of the memory allocated while it ran, in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        gc.collect()
+        kept, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, kept, peak
+
+def vocabulary_memory(words=('kaerk', 'hoes', 'mennig', 'broekstaart')):
+    """Compares the memory of the vocabulary as a list of dictionaries, as loaded from
+    the JSON file, with :class:`vocabulary.CompactVocabulary`, and the time and peak
+    memory of a linear :func:`text_processing.get_closest()` over both
+    """
+    from text_processing import get_closest
+
+    def load_dicts():
+        with open(VOCABULARY_PATH, 'r') as jf:
+            return json.load(jf)
+
+    def load_compact():
+        return CompactVocabulary.from_entries(load_dicts())
+
+    dicts, dicts_bytes, _ = _traced(load_dicts)
+    compact, compact_bytes, _ = _traced(load_compact)
+
+    results = {'entries': len(dicts),
+               'dicts_bytes': dicts_bytes,
+               'compact_bytes': compact_bytes}
+
+    for name, vocabulary in (('dicts', dicts), ('compact', compact)):
+        start = time.perf_counter()
+        _, _, peak = _traced(lambda: [get_closest(word, vocabulary) for word in words])
+        results[name + '_get_closest_seconds'] = (time.perf_counter() - start) / len(words)
+        results[name + '_get_closest_peak_bytes'] = peak
+
+    return results
+
+def regex_clean_str_word(word, split=False, hard=True):
+    """The version of :func:`text_processing.clean_str_word()` that runs every
+    pattern on every word, kept to compare the speed and the output
+    """
+    for comp_chr in ['\u0300', '\u0302', '\u0303', '\u0304', '\u0306', '\u0308', '\u030c']:
+        word = word.replace(comp_chr, '')
+    word = re.sub(r'<.*?>', '', word).strip()
+    word = re.sub(r'^[’|`|\'|ʼ]*[t|n|s]\s', '', word).strip()
+    word = re.sub(r',\s[’|`|\'|ʼ][t|n|s]$', '', word).strip()
+    word = re.sub(r'em/zich$', '', word).strip()
+    word = re.sub(r'^[-|‑]|\([-|‑]\)|[-|‑]$', '', word).strip()
+    word = re.sub(r'\*|!|\?|,|`|’|‘|\'|ʼ|/|\(|\)|[0-9]', '', word).strip()
+    if split and ' - ' in word:
+        word = word.split(' - ')[0].strip()
+    if hard:
+        word = re.sub(r'-|‑|–|\.|\s', '', word).strip()
+    return word
+
+def clean_str_word(repeat=3):
+    """Compares the words per second of :func:`text_processing.clean_str_word()`,
+    :func:`text_processing.clean_many()` and :func:`regex_clean_str_word()`
+    on the 'trefwoord' versions of the vocabulary
+    """
+    from text_processing import clean_str_word, clean_many
+
+    with open(VOCABULARY_PATH, 'r') as jf:
+        words = [w['trefwoord'] for w in json.load(jf)]
+
+    results = {'words': len(words)}
+    for name, function in (('regex', lambda: [regex_clean_str_word(w, split=True) for w in words]),
+                           ('translate', lambda: [clean_str_word(w, split=True) for w in words]),
+                           ('clean_many', lambda: clean_many(words, split=True))):
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+        results[name + '_words_per_second'] = len(words) / min(seconds)
+
+    return results
+
+BENCHMARKS = {
+    'vocabulary_memory': vocabulary_memory,
+    'clean_str_word': clean_str_word,
+}
+
+# The number of words in the workload of each tier of the suite
+TIERS = {
+    'small': 200,
+    'medium': 2000,
+    'large': 20000,
+}
+
+# The measurements of a stage that are compared with the baseline,
+# and whether a higher value is better
+COMPARED = {
+    'words_per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_kb': False,
+}
+
+def workload(tier, seed=0):
+    """Returns the dialect words of a tier: three out of four are taken from the
+    Phonetisaurus model corpus, the others are 'trefwoord' versions of the vocabulary,
+    which still need the cleaning. The same seed always gives the same words.
+    """
+    rnd = random.Random(seed)
+    size = TIERS[tier]
+
+    # Each line of the corpus is an aligned pair, so the dialect word is the
+    # concatenation of the left hand sides of the alignments
+    with open(os.path.join(settings.BASE_DIR, 'models', 'phonetisaurus-model.corpus'), 'r') as f:
+        corpus = [''.join(token.split('}')[0].replace('|', '') for token in line.split())
+                  for line in f.read().splitlines()]
+    with open(VOCABULARY_PATH, 'r') as jf:
+        vocabulary = [w['trefwoord'] for w in json.load(jf)]
+
+    words = [rnd.choice(corpus) for _ in range(size - size // 4)]
+    words += [rnd.choice(vocabulary) for _ in range(size // 4)]
+    rnd.shuffle(words)
+    return words
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+def _stages():
+    """Returns the stages of the suite: for each, the function that processes a batch
+    of words, the size of the batches, and whether it gets the cleaned words
+    """
+    import text_processing as tp
+
+    index = tp.get_vocabulary_index()
+    return {
+        'clean_str_word': (lambda words: [tp.clean_str_word(w, split=True, hard=True) for w in words], 1, False),
+        'get_closest': (lambda words: [tp.get_closest(w, index) for w in words], 1, True),
+        'alternate_dialect': (lambda words: [tp.alternate_dialect(w, [], index, COMPILED_MODIFIERS)
+                                             for w in words], 1, True),
+        'process_single_word': (lambda words: [tp.process_single_word(w, vocabulary=index,
+                                                                      modifiers=COMPILED_MODIFIERS)
+                                               for w in words], 1, True),
+        # The workers answer whole batches, so the latency is the time of a batch per word
+        'apply_phonetisaurus': (tp.apply_phonetisaurus, settings.G2P_BATCH_SIZE, True),
+    }
+
+def _run_stage(name, words, connection):
+    """Runs a stage in a forked process, so that its peak memory is measured on its own,
+    and sends the measurements back over the connection
+    """
+    import text_processing as tp
+
+    function, batch_size, _ = _stages()[name]
+    # A first call starts e.g. the Phonetisaurus workers,
+    # after which every stage starts without cached results
+    function(words[:1])
+    tp.CLOSEST_CACHE.clear()
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(words), batch_size):
+        batch = words[i:i + batch_size]
+        batch_start = time.perf_counter()
+        function(batch)
+        latencies.extend([(time.perf_counter() - batch_start) / len(batch)] * len(batch))
+    seconds = time.perf_counter() - start
+
+    connection.send({'words_per_second': len(words) / seconds if seconds else 0.0,
+                     'p50_ms': 1000 * _percentile(latencies, 50),
+                     'p99_ms': 1000 * _percentile(latencies, 99),
+                     'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    connection.close()
+
+def g2p_backend():
+    """Returns the Phonetisaurus backend used by the suite: the configured one,
+    or the fake one when Phonetisaurus or its model is not installed
+    """
+    model_path = os.path.join(settings.BASE_DIR, 'models', 'phonetisaurus-model.fst')
+    if settings.G2P_BACKEND == 'phonetisaurus' and (importlib.util.find_spec('Phonetisaurus') is None or
+                                                      not os.path.isfile(model_path)):
+        return 'fake'
+    return settings.G2P_BACKEND
+
+def run_suite(tier, seed=0, stages=None):
+    """Runs the stages of the prediction pipeline on the workload of a tier
+
+    Parameters
+    ----------
+    tier : string
+        One of the keys of :data:`TIERS`
+
+    seed : integer, (default=0)
+        The seed of the workload
+
+    stages : list of strings, (default=None)
+        The names of the stages to run, all of them when not given
+
+    Returns
+    -------
+    results : dictionary
+        The settings of the run, and for each stage the words per second,
+        the median and the 99th percentile of the latency per word in milliseconds,
+        and the peak resident memory of the process in kilobytes
+    """
+    import text_processing as tp
+
+    words = workload(tier, seed)
+    clean_words = tp.clean_many(words, split=True, hard=True)
+    backend = g2p_backend()
+
+    results = {'tier': tier, 'seed': seed, 'words': len(words), 'g2p_backend': backend,
+               'python': platform.python_version(), 'stages': {}}
+
+    # Loaded before forking, so that the stages do not measure the loading
+    tp.get_vocabulary_index().prepare()
+
+    context = multiprocessing.get_context('fork')
+    with override_settings(G2P_BACKEND=backend):
+        for name, (_, _, cleaned) in _stages().items():
+            if stages and name not in stages:
+                continue
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_stage, args=(name, clean_words if cleaned else words, sender))
+            process.start()
+            sender.close()
+            results['stages'][name] = receiver.recv()
+            process.join()
+
+    return results
+
+def compare(results, baseline, threshold):
+    """Compares the results of :func:`run_suite()` with those of an earlier run
+
+    Parameters
+    ----------
+    threshold : float
+        The relative change that is allowed, e.g. 0.2 for 20%
+
+    Returns
+    -------
+    regressions : list of strings
+        A description of every measurement that got worse by more than the threshold
+    """
+    regressions = []
+    for name, stage in results['stages'].items():
+        if name not in baseline.get('stages', {}):
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = baseline['stages'][name][key], stage[key]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append('%s %s: %.4g -> %.4g (%+.0f%%)' % (name, key, old, new, 100 * change))
+    return regressions
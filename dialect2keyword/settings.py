@@ -35,6 +35,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'main',
 ]
 
 MIDDLEWARE = [
@@ -134,3 +135,73 @@ MEDIA_URL = '/media/'
 
 # Maximum number of words to be shown on each page in words.html
 MAX_WORDS_PAGE = 50
+
+# Number of saved annotations that are waiting before they are written into the processed file
+ANNOTATION_COMPACT_ROWS = 500
+
+# Maximum number of vocabulary lookups kept in the memory by the rule-based algorithm
+CLOSEST_CACHE_SIZE = 50000
+
+# Maximum number of strings expanded with the rules for a single word, None for no limit
+MAX_EXPANSIONS = None
+# Maximum number of seconds of the rule-based search of a single word, None for no limit.
+# The best keyword found so far is returned, and its score is marked with an asterisk.
+WORD_DEADLINE_SECONDS = None
+# Number of seconds a job should take. The time that is left is spread over the remaining words
+# as a time limit for each of them. None for no limit.
+JOB_DEADLINE_SECONDS = None
+
+# Number of processes that run the rule-based algorithm for an upload, None for the number of CPUs
+# divided by JOB_WORKERS. Every job worker has its own processes, so JOB_WORKERS * RULEBASED_WORKERS
+# of them search at the same time, besides the G2P_WORKERS Phonetisaurus workers.
+RULEBASED_WORKERS = None
+
+# The job queue of the uploaded files, processed by 'python manage.py process_jobs'
+JOB_QUEUE_PATH = os.path.join(BASE_DIR, 'jobs.sqlite3')
+# Number of files processed at the same time
+JOB_WORKERS = 2
+# Uploads are refused when this many files are waiting, in total and for a single folder name
+MAX_QUEUED_JOBS = 100
+MAX_QUEUED_JOBS_PER_FOLDER = 10
+# Number of times a file is processed, including the first time, before its job is marked as failed.
+# A job is only tried again after its worker stopped unexpectedly, so 2 allows a single retry
+MAX_JOB_ATTEMPTS = 2
+# A running job that has not reported progress for this many seconds is shown as stalled
+JOB_STALL_SECONDS = 600
+
+# Number of uploaded words that are predicted and written to the processed file at once
+UPLOAD_CHUNK_SIZE = 1000
+
+# Number of uploaded lines sorted in the memory at once while removing the duplicates
+SORT_RUN_SIZE = 100000
+
+# The predictions kept between uploads, see prediction_cache.py. None turns the cache off.
+PREDICTION_CACHE_PATH = os.path.join(BASE_DIR, 'predictions.sqlite3')
+# Size of the stored predictions above which the least recently used ones are removed
+PREDICTION_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# The Phonetisaurus workers, see g2p.py. Use the 'fake' backend when Phonetisaurus is not installed.
+G2P_BACKEND = os.environ.get('G2P_BACKEND', 'phonetisaurus')
+G2P_WORKERS = 2
+G2P_BATCH_SIZE = 500
+G2P_TIMEOUT = 60
+# Number of parts a word list is split into to run on the workers at the same time, None for one per worker
+G2P_SHARDS = None
+
+# The counters and timers of each job, see metrics.py. Written next to the processed file
+# and served by the '/metrics' page.
+METRICS_ENABLED = True
+
+# The jobs run under the profiler, see profiling.py. Besides the uploads with the profile flag,
+# every PROFILE_EVERY_N_JOBS-th job is profiled; None profiles no other jobs.
+PROFILE_EVERY_N_JOBS = None
+# Number of functions listed in the summary of a profile
+PROFILE_TOP = 30
+
+# Words whose rule-based prediction takes more than this many seconds are logged with a trace
+# of their search and reported per job, see slow_words.py. None turns the traces off.
+SLOW_WORD_SECONDS = 1.0
+
+# The canonical keys that resolve dialect words without the rule search, see rule_index.py.
+# Built by 'python manage.py build_rule_index'; not used while the file does not exist. None turns it off.
+RULE_INDEX_PATH = os.path.join(MEDIA_ROOT, 'rule_index.sqlite3')
@@ -18,7 +18,7 @@ from django.urls import path
 from django.conf import settings
 from django.conf.urls.static import static
 
-from main.views import home, upload, files, words, save, download
+from main.views import home, upload, status, metrics, files, words, save, download
 
 urlpatterns = [
 
@@ -31,6 +31,13 @@ urlpatterns = [
     # that is given to the function
     path('files/<str:folder_name>', files, name='files'),
 
+    # Returns the progress of the processing of an uploaded file as JSON,
+    # polled by the upload page
+    path('status/<str:folder_name>/<str:file_name>', status, name='status'),
+
+    # The metrics of the processed jobs in the Prometheus text format
+    path('metrics', metrics, name='metrics'),
+
     # Path to call 'words' views function, here 'folder_name' and 'file_name' are a dynamic variables
     # that are given to the function
     path('words/<str:folder_name>/<str:file_name>/', words, name='words'),
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Contains the long-lived Phonetisaurus workers used by :func:`text_processing.apply_phonetisaurus()`
+
+A worker is a subprocess that loads the model once and then answers requests
+over its standard input and output: one dialect word per line is sent, and
+one line of "<dialect word>\\t<prediction>" is returned for each of them,
+in the same order. The prediction is left empty when the model has no output.
+
+The same file is also the script that runs inside the workers:
+
+    $  python g2p.py --model ./models/phonetisaurus-model.fst
+    $  python g2p.py --fake
+"""
+
+import os
+import sys
+import queue
+import logging
+import argparse
+import threading
+import time
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# The commands that start a worker with each of the backends, for a given model path.
+# The 'fake' backend returns the dialect words unchanged and needs no model,
+# so it can stand in for Phonetisaurus in tests and on machines without it.
+BACKENDS = {
+    'phonetisaurus': lambda model_path: [sys.executable, os.path.abspath(__file__), '--model', model_path],
+    'fake': lambda model_path: [sys.executable, os.path.abspath(__file__), '--fake'],
+}
+
+class G2PWorkerError(Exception):
+    """Raised when a worker cannot be started, crashes or does not answer in time"""
+
+class G2PWorker:
+    """A single worker subprocess that keeps the model loaded between requests
+
+    Parameters
+    ----------
+    command : list of strings
+        The command that starts the worker
+
+    timeout : float
+        The number of seconds to wait for the answers to a batch
+    """
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.process = None
+        self.lines = None
+
+    def start(self):
+        try:
+            self.process = Popen(self.command, stdin=PIPE, stdout=PIPE, cwd=settings.BASE_DIR,
+                                 universal_newlines=True, encoding='utf-8', bufsize=1)
+        except OSError as e:
+            raise G2PWorkerError('worker could not be started: ' + str(e))
+        # The output is read in a thread, so that the waiting can time out
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self.process.stdout, self.lines), daemon=True).start()
+
+    @staticmethod
+    def _read(stdout, lines):
+        for line in stdout:
+            lines.put(line.rstrip('\n'))
+        # The end of the output means the worker has stopped
+        lines.put(None)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def predict(self, words):
+        """Sends a batch of words to the worker and returns the predictions
+
+        Returns
+        -------
+        predictions : list of strings
+            The predictions in the same order as the words, empty when there is none.
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        try:
+            self.process.stdin.write(''.join(word + '\n' for word in words))
+            self.process.stdin.flush()
+        except OSError as e:
+            self.stop()
+            raise G2PWorkerError('worker stopped while sending: ' + str(e))
+
+        deadline = time.monotonic() + self.timeout
+        predictions = []
+        for word in words:
+            try:
+                line = self.lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.stop()
+                raise G2PWorkerError('worker did not answer in ' + str(self.timeout) + ' seconds')
+            if line is None:
+                returncode = self.process.wait()
+                self.stop()
+                raise G2PWorkerError('worker stopped with exit code ' + str(returncode))
+
+            answered, _, prediction = line.partition('\t')
+            if answered != word:
+                self.stop()
+                raise G2PWorkerError('worker answered ' + repr(answered) + ' for ' + repr(word))
+            predictions.append(prediction)
+
+        return predictions
+
+class G2PPool:
+    """A fixed number of :class:`G2PWorker` that are started once and reused for every job
+
+    Parameters
+    ----------
+    command : list of strings
+        The command that starts a worker
+
+    size : integer, (default=1)
+        The number of workers
+
+    batch_size : integer, (default=500)
+        The maximum number of words sent to a worker at once
+
+    timeout : float, (default=60)
+        The number of seconds a worker can take for a batch
+
+    retries : integer, (default=1)
+        How many times a batch is sent to a restarted worker after a crash or a timeout.
+        When the retries are exhausted, :class:`G2PWorkerError` is raised, so that
+        a broken installation is never mistaken for words without a prediction.
+    """
+    def __init__(self, command, size=1, batch_size=500, timeout=60, retries=1):
+        self.batch_size = batch_size
+        self.retries = retries
+        self.workers = [G2PWorker(command, timeout) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def _predict_batch(self, words):
+        worker = self.idle.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return worker.predict(words)
+                except G2PWorkerError as e:
+                    logger.warning('Phonetisaurus worker failed (attempt %d): %s', attempt + 1, e)
+                    error = e
+            raise G2PWorkerError('no predictions after ' + str(self.retries + 1) + ' attempts: ' + str(error))
+        finally:
+            self.idle.put(worker)
+
+    def _predict_shard(self, words):
+        predictions = []
+        for start in range(0, len(words), self.batch_size):
+            predictions.extend(self._predict_batch(words[start:start + self.batch_size]))
+        return predictions
+
+    def predict(self, words, shards=None):
+        """Returns the predictions for the given words, in the same order.
+        Words without a prediction get an empty string.
+
+        Raises
+        ------
+        G2PWorkerError
+            When a batch could not be predicted, also after the retries.
+
+        Parameters
+        ----------
+        words : list of strings
+            Give the words that needs to be processed
+
+        shards : integer, (default=None)
+            The number of consecutive parts the words are split into. The parts are
+            processed at the same time, each on its own worker, and their predictions
+            are merged back in the original order. When not given, one part per worker.
+        """
+        shards = max(1, min(shards or len(self.workers), len(words)))
+        if shards == 1:
+            return self._predict_shard(words)
+
+        size = -(-len(words) // shards)
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            parts = executor.map(self._predict_shard,
+                                 [words[start:start + size] for start in range(0, len(words), size)])
+            return [prediction for part in parts for prediction in part]
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+# The pools of the current process, per backend and model path
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _forget_pools():
+    # The workers belong to the parent process; a forked child starts its own
+    global _POOLS_LOCK
+    _POOLS.clear()
+    _POOLS_LOCK = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_pools)
+
+def get_pool(model_path):
+    """Returns the worker pool for the given model, starting it on the first call.
+    The backend and the size of the pool are set by the G2P_* settings.
+    """
+    key = (settings.G2P_BACKEND, model_path)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = G2PPool(BACKENDS[settings.G2P_BACKEND](model_path),
+                                  size=settings.G2P_WORKERS,
+                                  batch_size=settings.G2P_BATCH_SIZE,
+                                  timeout=settings.G2P_TIMEOUT)
+        return _POOLS[key]
+
+def serve(predict):
+    """Answers the requests on the standard input until it is closed"""
+    for line in sys.stdin:
+        word = line.rstrip('\n')
+        sys.stdout.write(word + '\t' + predict(word) + '\n')
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a Phonetisaurus worker on the standard input and output')
+    parser.add_argument('--model', help='path of the Phonetisaurus model file')
+    parser.add_argument('--fake', action='store_true', help='return the words unchanged instead of using a model')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before each answer (fake only)')
+    parser.add_argument('--exit-after', type=int, default=None, help='stop after this many answers (fake only)')
+    args = parser.parse_args()
+
+    if args.fake:
+        answered = [0]
+        def predict(word):
+            if args.exit_after is not None and answered[0] >= args.exit_after:
+                sys.exit(1)
+            answered[0] += 1
+            time.sleep(args.delay)
+            return word
+        serve(predict)
+        return
+
+    # The same settings as 'phonetisaurus-apply -n 1' uses by default
+    from Phonetisaurus import PhonetisaurusScript
+    model = PhonetisaurusScript(args.model)
+
+    def predict(word):
+        results = model.Phoneticize(word, 1, 10000, 99.0, False, False, 0.0)
+        if not results:
+            return ''
+        return ' '.join(model.FindOsym(u) for u in results[0].Uniques)
+
+    serve(predict)
+
+if __name__ == '__main__':
+    main()
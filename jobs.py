@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""Contains the job queue that replaces starting a process for every upload
+
+Uploads are stored as jobs in a SQLite file. A fixed number of worker processes,
+started with ``python manage.py process_jobs``, take the jobs from the queue
+and run :func:`text_processing.process_file()` on them.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+logger = logging.getLogger(__name__)
+
+# The columns that store the progress of a job, see :meth:`JobQueue.set_progress()`,
+# its metrics, see :meth:`JobQueue.finish()`, and whether it is profiled, see profiling.py
+PROGRESS_COLUMNS = {
+    'total_words': 'INTEGER',
+    'processed_words': 'INTEGER NOT NULL DEFAULT 0',
+    'rulebased_seconds': 'REAL NOT NULL DEFAULT 0',
+    'phonetisaurus_seconds': 'REAL NOT NULL DEFAULT 0',
+    'cache_hits': 'INTEGER NOT NULL DEFAULT 0',
+    'predicted_words': 'INTEGER NOT NULL DEFAULT 0',
+    'updated': 'REAL',
+    'metrics': 'TEXT',
+    'profile': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+class QueueFull(Exception):
+    """Raised when a job is not admitted because too many jobs are waiting"""
+
+class JobQueue:
+    """A first-in-first-out queue of upload jobs stored in a SQLite file,
+    which can be shared by the web server and the worker processes.
+
+    The jobs are scheduled fairly across the folder names: the next job is taken
+    from the folder that has the least jobs running at that moment, and only then
+    the oldest job first.
+
+    Parameters
+    ----------
+    path : string
+        The path of the SQLite file. Created when it does not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              folder_name TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              email_address TEXT NOT NULL DEFAULT '',
+                              state TEXT NOT NULL DEFAULT 'queued',
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              worker_pid INTEGER,
+                              created REAL NOT NULL,
+                              started REAL,
+                              finished REAL,
+                              error TEXT)''')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, folder_name)')
+
+            # The progress of the running jobs, added to queues created before it was tracked
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            for column, definition in PROGRESS_COLUMNS.items():
+                if column not in columns:
+                    db.execute('ALTER TABLE jobs ADD COLUMN ' + column + ' ' + definition)
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_file_name ON jobs (file_name)')
+
+            # The metrics of the finished jobs are added up by finish(), so that the
+            # metrics view does not have to read every job that ever finished
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            if db.execute("SELECT 1 FROM meta WHERE name = 'metrics'").fetchone() is None:
+                from metrics import merge
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    total = merge(json.loads(row['metrics'])
+                                  for row in db.execute('SELECT metrics FROM jobs WHERE metrics IS NOT NULL'))
+                    db.execute("INSERT OR IGNORE INTO meta VALUES ('metrics', ?)", (json.dumps(total),))
+                    db.execute('COMMIT')
+                except Exception:
+                    db.execute('ROLLBACK')
+                    raise
+
+    @contextmanager
+    def _connect(self):
+        # Every call opens its own connection, so the queue can be used after a fork
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def submit(self, folder_name, file_name, email_address='', profile=False):
+        """Adds a job to the end of the queue. When profile is True, the job is run
+        under the profiler, see :func:`profiling.run_profiled()`.
+
+        Raises
+        ------
+        QueueFull
+            When MAX_QUEUED_JOBS jobs are already waiting, or MAX_QUEUED_JOBS_PER_FOLDER
+            jobs of the same folder name.
+
+        Returns
+        -------
+        job_id : integer
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                waiting = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+                if waiting >= settings.MAX_QUEUED_JOBS:
+                    raise QueueFull('There are already ' + str(waiting) + ' files waiting to be processed.')
+
+                waiting = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND folder_name = ?",
+                                     (folder_name,)).fetchone()[0]
+                if waiting >= settings.MAX_QUEUED_JOBS_PER_FOLDER:
+                    raise QueueFull('There are already ' + str(waiting) + ' files of this folder waiting to be processed.')
+
+                job_id = db.execute('INSERT INTO jobs (folder_name, file_name, email_address, profile, created) '
+                                    'VALUES (?, ?, ?, ?, ?)',
+                                    (folder_name, file_name, email_address, int(profile), time.time())).lastrowid
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+        return job_id
+
+    def claim(self):
+        """Takes the next job from the queue and marks it as running by the current process
+
+        Returns
+        -------
+        job : dictionary or None
+            The columns of the job, or None when the queue is empty.
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            job = db.execute("""SELECT * FROM jobs AS j WHERE state = 'queued'
+                                ORDER BY (SELECT COUNT(*) FROM jobs AS r
+                                          WHERE r.state = 'running' AND r.folder_name = j.folder_name),
+                                         id
+                                LIMIT 1""").fetchone()
+            if job is not None:
+                db.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, "
+                           "worker_pid = ?, started = ? WHERE id = ?",
+                           (os.getpid(), time.time(), job['id']))
+            db.execute('COMMIT')
+
+        return dict(job) if job is not None else None
+
+    def finish(self, job_id, error=None, metrics=None):
+        """Marks a job as done, or as failed when an error is given.
+        The email address is removed, as it is not needed anymore.
+        The metrics returned by :func:`text_processing.process_file()` are stored with the job,
+        and added to the totals returned by :meth:`metrics()`.
+        """
+        from metrics import merge
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute("UPDATE jobs SET state = ?, finished = ?, error = ?, metrics = ?, email_address = '' "
+                           "WHERE id = ?",
+                           ('failed' if error else 'done', time.time(), error,
+                            json.dumps(metrics) if metrics else None, job_id))
+                if metrics:
+                    total = merge([self._metrics(db), metrics])
+                    db.execute("UPDATE meta SET value = ? WHERE name = 'metrics'", (json.dumps(total),))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    def set_progress(self, job_id, processed_words, total_words, timings, cache_hits=0, predicted_words=0):
+        """Stores the progress of a running job, as reported by :func:`text_processing.process_file()`"""
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET processed_words = ?, total_words = ?, rulebased_seconds = ?, '
+                       'phonetisaurus_seconds = ?, cache_hits = ?, predicted_words = ?, updated = ? WHERE id = ?',
+                       (processed_words, total_words, timings['rulebased'], timings['phonetisaurus'],
+                        cache_hits, predicted_words, time.time(), job_id))
+
+    def status(self, file_name):
+        """Returns the status of the latest job of a file, with its throughput and estimated finish time
+
+        Returns
+        -------
+        status : dictionary or None
+            None when the file has no job. Otherwise, contains the 'state' of the job,
+            the number of 'processed_words' and 'total_words', the words per second of the
+            whole job ('rate') and of each predictor over the words it was run on, without
+            the cached words ('rulebased_rate', 'phonetisaurus_rate'),
+            the 'eta' as a timestamp, the share of the words found in the prediction
+            cache ('cache_hit_rate'), and whether the job is 'stalled', i.e. has not
+            reported progress for JOB_STALL_SECONDS. Queued jobs have their 'position' in
+            the queue. All times are UNIX timestamps.
+        """
+        with self._connect() as db:
+            job = db.execute('SELECT * FROM jobs WHERE file_name = ? ORDER BY id DESC LIMIT 1',
+                             (file_name,)).fetchone()
+            if job is None:
+                return None
+            job = dict(job)
+            position = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND id < ?",
+                                  (job['id'],)).fetchone()[0]
+
+        now = time.time()
+        status = {key: job[key] for key in ('state', 'processed_words', 'total_words',
+                                            'created', 'started', 'finished', 'updated')}
+        status.update({'rate': None, 'rulebased_rate': None, 'phonetisaurus_rate': None,
+                       'eta': None, 'stalled': False,
+                       'cache_hit_rate': job['cache_hits'] / job['processed_words'] if job['processed_words'] else None})
+
+        if job['state'] == 'queued':
+            status['position'] = position + 1
+
+        processed = job['processed_words']
+        if job['state'] == 'running' and processed:
+            elapsed = now - job['started']
+            status['rate'] = processed / elapsed if elapsed > 0 else None
+            # The predictors only spend their time on the words that were not cached
+            if job['rulebased_seconds']:
+                status['rulebased_rate'] = job['predicted_words'] / job['rulebased_seconds']
+            if job['phonetisaurus_seconds']:
+                status['phonetisaurus_rate'] = job['predicted_words'] / job['phonetisaurus_seconds']
+            if status['rate'] and job['total_words'] is not None:
+                status['eta'] = now + (job['total_words'] - processed) / status['rate']
+
+        if job['state'] == 'running':
+            last_seen = job['updated'] or job['started']
+            status['stalled'] = now - last_seen > settings.JOB_STALL_SECONDS
+
+        return status
+
+    def recover(self, alive_pids=(), interrupted=False):
+        """Puts the running jobs of the processes that are not alive anymore back in the queue,
+        e.g. after a worker or the whole machine crashed. Jobs that were already tried
+        MAX_JOB_ATTEMPTS times are marked as failed instead.
+
+        Parameters
+        ----------
+        interrupted : boolean, (default=False)
+            Whether the workers were stopped on purpose, e.g. with Ctrl-C. The jobs are
+            then put back in the queue without counting the attempt.
+
+        Returns
+        -------
+        recovered : integer
+            The number of jobs that were running in a process that is not alive
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            jobs = [job for job in db.execute("SELECT id, attempts, worker_pid FROM jobs WHERE state = 'running'")
+                    if job['worker_pid'] not in alive_pids]
+            for job in jobs:
+                if interrupted:
+                    db.execute("UPDATE jobs SET state = 'queued', worker_pid = NULL, attempts = attempts - 1 "
+                               "WHERE id = ?", (job['id'],))
+                elif job['attempts'] >= settings.MAX_JOB_ATTEMPTS:
+                    db.execute("UPDATE jobs SET state = 'failed', finished = ?, email_address = '', "
+                               "error = 'worker stopped while processing' WHERE id = ?", (time.time(), job['id']))
+                else:
+                    db.execute("UPDATE jobs SET state = 'queued', worker_pid = NULL WHERE id = ?", (job['id'],))
+            db.execute('COMMIT')
+
+        return len(jobs)
+
+    @staticmethod
+    def _metrics(db):
+        return json.loads(db.execute("SELECT value FROM meta WHERE name = 'metrics'").fetchone()[0])
+
+    def metrics(self):
+        """Returns the metrics of all finished jobs, added up by :func:`metrics.merge()`"""
+        with self._connect() as db:
+            return self._metrics(db)
+
+    def counts(self):
+        """Returns the number of jobs in each state"""
+        with self._connect() as db:
+            return {row['state']: row['n'] for row in db.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state')}
+
+# The queues of the current process by path, so that the schema is only checked once.
+# A queue opens a new connection for every call, so it can still be used after a fork.
+_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+def get_queue():
+    """Returns the job queue of the project, stored at JOB_QUEUE_PATH"""
+    with _QUEUES_LOCK:
+        if settings.JOB_QUEUE_PATH not in _QUEUES:
+            _QUEUES[settings.JOB_QUEUE_PATH] = JobQueue(settings.JOB_QUEUE_PATH)
+        return _QUEUES[settings.JOB_QUEUE_PATH]
+
+def work(queue, poll_interval):
+    """The loop of a worker process: takes the jobs from the queue one by one and processes them"""
+    # Imported here, so that the web server does not load the vocabulary when it only submits jobs
+    from text_processing import process_file, start_pool
+    from profiling import should_profile, run_profiled
+    fs = FileSystemStorage()
+
+    # The rule-based workers are forked once, before any threads are started,
+    # and keep their vocabulary lookups from one job to the next
+    start_pool()
+
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        logger.info('Job %d started: %s', job['id'], job['file_name'])
+        try:
+            progress = lambda processed, total, timings, cache_hits, predicted: queue.set_progress(
+                job['id'], processed, total, timings, cache_hits, predicted)
+            if should_profile(job['id'], job['profile']):
+                logger.info('Job %d is profiled', job['id'])
+                # The rule-based search runs in this process, so that its functions are in the profile
+                metrics = run_profiled(fs.path(job['file_name'] + '_processed'), process_file,
+                                       job['file_name'], job['email_address'], progress=progress, workers=1)
+            else:
+                metrics = process_file(job['file_name'], job['email_address'], progress=progress)
+        except Exception as e:
+            logger.exception('Job %d failed', job['id'])
+            queue.finish(job['id'], error=repr(e))
+        else:
+            logger.info('Job %d done', job['id'])
+            queue.finish(job['id'], metrics=metrics)
+
+def run_workers(workers, poll_interval=1.0):
+    """Starts a fixed number of worker processes, and restarts them when they stop.
+    The jobs of stopped workers are put back in the queue. Runs until interrupted.
+    """
+    # Loaded before forking, so that the workers share the vocabulary and the rules
+    import text_processing
+    text_processing.get_vocabulary_index().prepare()
+
+    queue = get_queue()
+    # Jobs that were running when the workers were stopped last time.
+    # Only one process_jobs command should use the same queue.
+    recovered = queue.recover()
+    if recovered:
+        logger.warning('%d interrupted jobs are put back in the queue', recovered)
+
+    context = multiprocessing.get_context('fork')
+    processes = []
+    interrupted = False
+    try:
+        while True:
+            processes = [p for p in processes if p.is_alive()]
+            if len(processes) < workers:
+                recovered = queue.recover(alive_pids={p.pid for p in processes})
+                if recovered:
+                    logger.warning('%d jobs of a stopped worker are put back in the queue', recovered)
+                for _ in range(workers - len(processes)):
+                    process = context.Process(target=work, args=(queue, poll_interval))
+                    process.start()
+                    processes.append(process)
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        # A shutdown on purpose does not count as an attempt of the running jobs
+        interrupted = True
+        raise
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        queue.recover(interrupted=interrupted)
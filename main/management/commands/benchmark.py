@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from benchmarks import BENCHMARKS
+
+class Command(BaseCommand):
+    help = 'Runs one of the benchmarks of benchmarks.py and prints its measurements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS), help='the benchmark to run')
+
+    def handle(self, *args, **options):
+        for key, value in BENCHMARKS[options['name']]().items():
+            self.stdout.write(key + ': ' + (('%.6f' % value) if isinstance(value, float) else str(value)))
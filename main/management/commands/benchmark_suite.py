@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks import TIERS, run_suite, compare
+
+class Command(BaseCommand):
+    help = ('Runs the benchmark suite of the prediction pipeline on a fixed workload, '
+            'and fails when it got slower than a baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=list(TIERS), default='small',
+                            help='size of the workload')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='seed of the workload')
+        parser.add_argument('--stage', action='append', dest='stages',
+                            help='run only this stage, can be given more than once')
+        parser.add_argument('--output', help='path of the JSON file the results are written to')
+        parser.add_argument('--baseline', help='path of the JSON file of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='relative change that is allowed before a regression is reported')
+
+    def handle(self, *args, **options):
+        results = run_suite(options['tier'], options['seed'], options['stages'])
+
+        self.stdout.write('%d words (%s tier, seed %d), Phonetisaurus backend: %s' % (
+            results['words'], results['tier'], results['seed'], results['g2p_backend']))
+        for name, stage in results['stages'].items():
+            self.stdout.write('%-20s %10.1f words/s  p50 %8.3f ms  p99 %8.3f ms  peak RSS %8d kB' % (
+                name, stage['words_per_second'], stage['p50_ms'], stage['p99_ms'], stage['peak_rss_kb']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline'], 'r') as f:
+                baseline = json.load(f)
+            if (baseline['tier'], baseline['seed']) != (results['tier'], results['seed']):
+                raise CommandError('The baseline was measured on another workload')
+            regressions = compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions beyond %.0f%%:\n' % (100 * options['threshold']) +
+                                   '\n'.join(regressions))
+            self.stdout.write('No regressions beyond %.0f%%' % (100 * options['threshold']))
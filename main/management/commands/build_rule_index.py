@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks import TIERS, workload
+from rules import MODIFIERS, COMPILED_MODIFIERS
+from rule_index import RuleIndex, build_rule_index, agreement
+from text_processing import get_vocabulary_index, clean_many
+
+class Command(BaseCommand):
+    help = ('Builds the index of canonical keys, which resolves dialect words without the rule search, '
+            'and compares its predictions with those of the search')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=1,
+                            help='number of rules applied after each other to create a key')
+        parser.add_argument('--tier', choices=list(TIERS), default='small',
+                            help='size of the workload the predictions are compared on')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='seed of the workload')
+        parser.add_argument('--report-only', action='store_true',
+                            help='only report on the index that is already built')
+
+    def handle(self, *args, **options):
+        if not settings.RULE_INDEX_PATH:
+            raise CommandError('RULE_INDEX_PATH is not set')
+        vocabulary_index = get_vocabulary_index()
+
+        if options['report_only']:
+            report = RuleIndex(settings.RULE_INDEX_PATH).report()
+        else:
+            start = time.perf_counter()
+            report = build_rule_index(vocabulary_index, MODIFIERS, settings.RULE_INDEX_PATH, depth=options['depth'])
+            self.stdout.write('Built %s in %.1f seconds' % (settings.RULE_INDEX_PATH, time.perf_counter() - start))
+
+        self.stdout.write('%d keys of depth %d (%d ambiguous keys left out), %.1f MB' % (
+            report['keys'], report['depth'], report['ambiguous'], report['bytes'] / 1024 / 1024))
+        self.stdout.write('%d of %d vocabulary versions have a key (%.1f%%)' % (
+            report['covered'], report['forms'], 100 * report['covered'] / report['forms'] if report['forms'] else 0))
+
+        words = clean_many(workload(options['tier'], options['seed']), split=True, hard=True)
+        result = agreement(RuleIndex(settings.RULE_INDEX_PATH), words, vocabulary_index, COMPILED_MODIFIERS)
+        self.stdout.write('%d of %d words found in the index, %d of them predicted the same as the search' % (
+            result['hits'], result['words'], result['agree']))
+        self.stdout.write('%d words found by the search after the rules changed them, %d of them not in the index' % (
+            result['exact'], result['missed']))
+        self.stdout.write('The hits took %.3f seconds with the index and %.3f seconds with the search' % (
+            result['index_seconds'], result['search_seconds']))
+        for disagreement in result['disagreements']:
+            self.stdout.write('  %s: index %s, search %s' % (
+                disagreement['word'], disagreement['index'], disagreement['search']))
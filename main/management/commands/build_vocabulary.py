@@ -0,0 +1,31 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from rules import VOCABULARY_PATH, VOCABULARY_BINARY_PATH
+from vocabulary import BinaryVocabulary, VocabularyIndex, build_binary
+
+class Command(BaseCommand):
+    help = 'Builds the binary version of the vocabulary, which is loaded faster than the JSON file'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with open(VOCABULARY_PATH, 'r') as jf:
+            vocabulary = json.load(jf)
+        json_index = VocabularyIndex(vocabulary)
+        json_seconds = time.perf_counter() - start
+
+        build_binary(vocabulary, VOCABULARY_BINARY_PATH, source_path=VOCABULARY_PATH)
+
+        start = time.perf_counter()
+        binary_index = VocabularyIndex(BinaryVocabulary(VOCABULARY_BINARY_PATH))
+        binary_seconds = time.perf_counter() - start
+
+        if binary_index.version != json_index.version:
+            raise RuntimeError('The binary vocabulary does not match ' + VOCABULARY_PATH)
+
+        self.stdout.write('Built ' + VOCABULARY_BINARY_PATH + ' with ' + str(len(vocabulary)) +
+                          ' entries (version ' + binary_index.version + ')')
+        self.stdout.write('Loading the vocabulary and its index takes %.3f seconds from the JSON file '
+                          'and %.3f seconds from the binary file' % (json_seconds, binary_seconds))
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from jobs import run_workers
+
+class Command(BaseCommand):
+    help = 'Runs the worker processes that process the uploaded files in the job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.JOB_WORKERS,
+                            help='number of files processed at the same time')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='seconds between checks of an empty queue')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Processing the job queue with ' + str(options['workers']) + ' workers')
+        try:
+            run_workers(options['workers'], options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped')
@@ -1,3 +1,996 @@
-from django.test import TestCase
+import os
+import re
+import gzip
+import sys
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.test import SimpleTestCase, override_settings
+
+from rules import VOCABULARY, VOCABULARY_PATH, MODIFIERS, COMPILED_MODIFIERS, RuleMatcher
+import g2p
+import jobs
+from prediction_cache import PredictionCache
+from metrics import Metrics, merge, to_prometheus
+from profiling import should_profile, run_profiled
+from slow_words import SlowWordReport, format_trace, rule_counts
+from rule_index import RuleIndex, build_rule_index, canonical_keys, inverse_rules, agreement
+import benchmarks
+from benchmarks import regex_clean_str_word
+from results import ResultFile, AnnotationStore, parse_row, build_index
+from main.views import load_data
+from vocabulary import ClosestCache, VocabularyIndex, CompactVocabulary, BinaryVocabulary, build_binary
+from text_processing import (get_closest, get_closest_many, alternate_dialect, clean_str_word, clean_many,
+                             process_single_word, process_words, apply_phonetisaurus, run_predictors,
+                             read_unique_lines, process_file, format_row, word_time_limit, start_pool, stop_pool,
+                             rulebased_workers, VOCABULARY_INDEX, CLOSEST_CACHE)
+
+def load_corpus_words(n, seed=0):
+    """Returns a fixed sample of dialect words from the Phonetisaurus model corpus.
+    Each line of the corpus is an aligned pair, so the dialect word is the
+    concatenation of the left hand sides of the alignments.
+    """
+    with open('models/phonetisaurus-model.corpus', 'r') as f:
+        lines = f.readlines()
+    sample = random.Random(seed).sample(lines, n)
+    return [''.join(token.split('}')[0].replace('|', '') for token in line.split())
+            for line in sample]
+
+def reference_alternate_dialect(dialect_word, combinations, vocabulary, modifiers, step=0, min_distance=None):
+    """The original recursive version of :func:`text_processing.alternate_dialect()`,
+    kept to check that the search returns the same results
+    """
+    input_ = {'dialect': dialect_word}
+    input_['estimates'], input_['distance'] = get_closest(input_['dialect'], vocabulary)
+    combinations.append(input_)
+
+    if not min_distance:
+        min_distance = input_['distance']
+
+    for comb in combinations:
+        dialect = comb['dialect']
+        curr_dist = comb['distance']
+        if curr_dist > min_distance:
+            continue
+        for fr, to_list in modifiers[step].items():
+            if fr in dialect:
+                for to in to_list:
+                    alternated_word = re.sub(fr, to, dialect).strip()
+                    estimates, alt_dist = get_closest(alternated_word, vocabulary)
+                    if alt_dist < curr_dist:
+                        combinations.append({
+                            'dialect': alternated_word,
+                            'estimates': estimates,
+                            'distance': alt_dist
+                        })
+                        if alt_dist < min_distance:
+                            min_distance = alt_dist
+
+    combinations = [c for c in combinations if c['distance'] == min_distance]
+    combinations = list({c['dialect']: c for c in combinations}.values())
+    combinations = sorted(combinations, key=lambda k: k['distance'])
+
+    if min_distance > 0:
+        step += 1
+        if step < len(modifiers):
+            combinations = reference_alternate_dialect(dialect_word, combinations,
+                                                       vocabulary, modifiers,
+                                                       step, min_distance)
+
+    return combinations
+
+class VocabularyIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        rnd = random.Random(1)
+        # Dialect words, vocabulary words and vocabulary words one edit away
+        self.words = load_corpus_words(20)
+        self.words += [w['modified'] for w in rnd.sample(VOCABULARY, 10)]
+        self.words += [w['modified'][1:] + 'e' for w in rnd.sample(VOCABULARY, 10)]
+        self.words += ['', 'x' * 40]
+
+    def test_same_as_scan(self):
+        for word in self.words:
+            for distance_limit in (1, 2):
+                with self.subTest(word=word, distance_limit=distance_limit):
+                    self.assertEqual(get_closest(word, VOCABULARY_INDEX, distance_limit),
+                                     get_closest(word, VOCABULARY, distance_limit))
+
+    def test_batch_same_as_scan(self):
+        for distance_limit in (1, 2):
+            with self.subTest(distance_limit=distance_limit):
+                self.assertEqual(get_closest_many(self.words, VOCABULARY_INDEX, distance_limit),
+                                 [get_closest(word, VOCABULARY, distance_limit) for word in self.words])
+
+    def test_binary_vocabulary(self):
+        with open(VOCABULARY_PATH, 'r') as jf:
+            vocabulary = json.load(jf)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'vocabulary.bin')
+            build_binary(vocabulary, path, source_path=VOCABULARY_PATH)
+            binary = BinaryVocabulary(path)
+
+            self.assertEqual(list(binary), vocabulary)
+            self.assertFalse(binary.is_outdated(VOCABULARY_PATH))
+            binary_index, json_index = VocabularyIndex(binary), VocabularyIndex(vocabulary)
+            self.assertEqual(binary_index.version, json_index.version)
+            self.assertEqual(binary_index.positions, json_index.positions)
+            for word in self.words:
+                self.assertEqual(binary_index.closest(word, 2), json_index.closest(word, 2))
+
+    def test_compact_vocabulary(self):
+        with open(VOCABULARY_PATH, 'r') as jf:
+            vocabulary = json.load(jf)
+        compact = CompactVocabulary.from_entries(vocabulary)
+        self.assertEqual(list(compact), vocabulary)
+        self.assertLess(len(compact.trefwoord), len(vocabulary) // 10)
+        for word in self.words[:10]:
+            self.assertEqual(get_closest(word, compact, 2), get_closest(word, vocabulary, 2))
+
+class CleanStrWordTests(SimpleTestCase):
+
+    def assertSameAsRegex(self, words, modes=((False, True), (True, True))):
+        for split, hard in modes:
+            with self.subTest(split=split, hard=hard):
+                expected = [regex_clean_str_word(word, split, hard) for word in words]
+                self.assertEqual([clean_str_word(word, split, hard) for word in words], expected)
+                self.assertEqual(clean_many(words, split, hard), expected)
+
+    def test_vocabulary(self):
+        self.assertSameAsRegex([w['trefwoord'] for w in VOCABULARY] + [w['modified'] for w in VOCABULARY])
+
+    def test_corpus(self):
+        with open('models/phonetisaurus-model.corpus', 'r') as f:
+            lines = f.read().splitlines()
+        self.assertSameAsRegex(lines + [''.join(token.split('}')[0].replace('|', '') for token in line.split())
+                                        for line in lines])
+
+    def test_special_characters(self):
+        rnd = random.Random(3)
+        alphabet = 'ants em/zich<b>-‑–.,*!?`’‘\'ʼ()|0 \t\u00a0\u0300\u0308'
+        words = ["'t hoes", 'ʼn kaerk', "kaerk, 't", 'wassen em/zich', '-laau', 'laau - flaau', '(‑)ant',
+                 '<u>hoes</u>', ' ’s  ’t huus ', 'a|b-', 'zich em/zich em/zich']
+        self.assertSameAsRegex(words + [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12)))
+                                        for _ in range(20000)],
+                               modes=((False, False), (False, True), (True, False), (True, True)))
+
+class ClosestCacheTests(SimpleTestCase):
+
+    def test_lru_eviction(self):
+        cache = ClosestCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_get_closest_is_cached(self):
+        CLOSEST_CACHE.clear()
+        first = get_closest('baokhoes', VOCABULARY_INDEX)
+        self.assertIs(get_closest_many(['baokhoes'], VOCABULARY_INDEX)[0], first)
+        self.assertEqual(CLOSEST_CACHE.stats()['hits'], 1)
+        self.assertEqual(CLOSEST_CACHE.stats()['misses'], 1)
+
+    def test_hits_across_calls(self):
+        words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(10, seed=13)]
+        CLOSEST_CACHE.clear()
+        first, second = [], []
+        process_words(words, workers=1, stats=first)
+        process_words(words, workers=1, stats=second)
+        # Every lookup of the second call was made by the first one
+        self.assertEqual(sum(word_stats['closest_misses'] for word_stats in second), 0)
+        self.assertEqual(sum(word_stats['closest_hits'] for word_stats in second),
+                         sum(word_stats['closest_hits'] + word_stats['closest_misses'] for word_stats in first))
+
+class AlternateDialectTests(SimpleTestCase):
+
+    def setUp(self):
+        self.words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(60, seed=2)]
+
+    def test_same_as_recursive(self):
+        for word in self.words:
+            with self.subTest(word=word):
+                stats = {}
+                self.assertEqual(alternate_dialect(word, [], VOCABULARY_INDEX, COMPILED_MODIFIERS, stats=stats),
+                                 reference_alternate_dialect(word, [], VOCABULARY_INDEX, MODIFIERS))
+                self.assertFalse(stats['truncated'])
+
+    def test_expansion_budget(self):
+        word = max(self.words, key=len)
+        stats = {}
+        combinations = alternate_dialect(word, [], VOCABULARY_INDEX, MODIFIERS, max_expansions=0, stats=stats)
+        self.assertEqual(stats['expanded'], 0)
+        self.assertEqual(combinations[0]['dialect'], word)
+
+    def test_time_limit(self):
+        # A word that needs the rules to find its keyword
+        word = next(w for w in self.words if alternate_dialect(w, [], VOCABULARY_INDEX, COMPILED_MODIFIERS,
+                                                                 stats={}) and get_closest(w, VOCABULARY_INDEX)[1])
+        stats = {}
+        combinations = alternate_dialect(word, [], VOCABULARY_INDEX, COMPILED_MODIFIERS, max_seconds=0, stats=stats)
+        self.assertTrue(stats['truncated'] and stats['timed_out'])
+        self.assertEqual(combinations[0]['dialect'], word)
+
+        keywords = process_single_word(word, vocabulary=VOCABULARY_INDEX, modifiers=COMPILED_MODIFIERS, max_seconds=0)
+        self.assertTrue(keywords[0]['truncated'])
+        self.assertEqual(parse_row(format_row(word, keywords, '-'))[2], str(keywords[0]['score']) + '*')
+        keywords = process_single_word(word, vocabulary=VOCABULARY_INDEX, modifiers=COMPILED_MODIFIERS,
+                                       max_seconds=60)
+        self.assertNotIn('truncated', keywords[0])
+
+    @override_settings(WORD_DEADLINE_SECONDS=2.0, RULEBASED_WORKERS=4)
+    def test_word_time_limit(self):
+        self.assertEqual(word_time_limit(None, 10), 2.0)
+        # 10 seconds left for 100 words on 4 workers
+        self.assertAlmostEqual(word_time_limit(time.perf_counter() + 10, 100), 0.4, places=2)
+        self.assertEqual(word_time_limit(time.perf_counter() - 10, 100), 0.0)
+        with override_settings(WORD_DEADLINE_SECONDS=None):
+            self.assertAlmostEqual(word_time_limit(time.perf_counter() + 10, 1), 40, places=1)
+
+    def test_trace(self):
+        for modifiers in (MODIFIERS, COMPILED_MODIFIERS):
+            for word in self.words[:20]:
+                with self.subTest(word=word):
+                    stats = {}
+                    trace = []
+                    self.assertEqual(alternate_dialect(word, [], VOCABULARY_INDEX, modifiers, stats=stats, trace=trace),
+                                     alternate_dialect(word, [], VOCABULARY_INDEX, modifiers))
+                    self.assertEqual(len(trace), stats['expanded'])
+                    self.assertEqual(sum(len(alternatives) for _, _, _, alternatives in trace), stats['scored'] - 1)
+                    tried, kept = rule_counts(trace)
+                    for step in range(len(modifiers)):
+                        self.assertEqual(sum(n for (s, _), n in tried.items() if s == step), stats['tried'][step])
+                        self.assertEqual(sum(n for (s, _), n in kept.items() if s == step), stats['accepted'][step])
+                    for step, _, _, alternatives in trace:
+                        for fr, to, alternative, _, _ in alternatives:
+                            self.assertIn(to, MODIFIERS[step][fr])
+
+class RuleIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'rule_index.sqlite3')
+        self.modifiers = [{'oe': ['ui']}, {'ö': ['oe', 'eu'], 'ie': ['ij']}]
+        self.vocabulary = VocabularyIndex([{'modified': m, 'trefwoord': t} for m, t in [
+            ('huis', 'huis'), ('kruid', 'kruid'), ('kruit', 'kruit'), ('lijf', 'lijf'), ('leus', 'leus'),
+            ('leuf', 'leuf'), ('loef', 'loef')]])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_canonical_keys(self):
+        inverse = inverse_rules(self.modifiers)
+        self.assertEqual(list(canonical_keys('huis', inverse)), ['hoes'])
+        self.assertEqual(sorted(canonical_keys('huis', inverse, depth=2)), ['hoes', 'hös'])
+        # 'kroeoe' is not a key of 'kruioe', as the rule rewrites it into 'kruiui'
+        self.assertEqual(list(canonical_keys('kruioe', inverse)), ['kruiö'])
+
+    def test_build(self):
+        report = build_rule_index(self.vocabulary, self.modifiers, self.path, depth=2)
+        index = RuleIndex(self.path)
+        # 'löf' is a key of both 'loef' and 'leuf', so it is left out
+        self.assertEqual(index.lookup_many(['hoes', 'hös', 'lief', 'löf', 'huis', 'xyz']),
+                         {'hoes': 'huis', 'hös': 'huis', 'lief': 'lijf'})
+        self.assertEqual(report['forms'], 7)
+        self.assertEqual(report['ambiguous'], 1)
+        self.assertEqual(report['keys'], 8)
+        self.assertEqual(report['covered'], 5)
+
+    def test_process_words(self):
+        build_rule_index(self.vocabulary, self.modifiers, self.path)
+        index = RuleIndex(self.path)
+        words = ['hoes', 'kroed', 'xyz', 'huis']
+        stats = []
+        keywords = process_words(words, workers=1, stats=stats, rule_index=index,
+                                 vocabulary=self.vocabulary, modifiers=self.modifiers)
+        self.assertEqual(keywords, process_words(words, workers=1, vocabulary=self.vocabulary,
+                                                 modifiers=self.modifiers))
+        self.assertEqual([word_stats['rule_index'] for word_stats in stats], [True, True, False, False])
+
+        result = agreement(index, words, self.vocabulary, self.modifiers)
+        self.assertEqual((result['hits'], result['agree'], result['exact'], result['missed']), (2, 2, 2, 0))
+
+class SlowWordsTests(SimpleTestCase):
+
+    def test_report(self):
+        trace = [(0, 'hoës', 2, [('ë', 'e', 'hoes', 1, True), ('ë', 'ee', 'hoees', 2, False)]),
+                 (0, 'hoes', 1, [('oe', 'u', 'hus', 1, False)])]
+        self.assertEqual(format_trace(trace), '0 hoës(2) 2 tried: ë>e=hoes(1)\n0 hoes(1) 1 tried')
+        self.assertEqual(format_trace(trace, limit=1), '0 hoës(2) 2 tried: ë>e=hoes(1)\n... 1 more strings expanded')
+
+        report = SlowWordReport()
+        stats = {'expanded': 2, 'scored': 4, 'step': 0, 'truncated': False}
+        report.add('hoës', 1.5, stats, trace)
+        report.add('hoës', 2.5, stats, trace)
+        summary = report.summary()
+        self.assertEqual([word['seconds'] for word in summary['words']], [2.5, 1.5])
+        self.assertEqual(summary['worst_rules'], [
+            {'section': 0, 'key': 'ë', 'tried': 4, 'kept': 2, 'words': 2},
+            {'section': 0, 'key': 'oe', 'tried': 2, 'kept': 0, 'words': 2},
+        ])
+
+    def test_trace_of_single_search(self):
+        words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(5, seed=14)]
+        kwargs = {'vocabulary': VOCABULARY_INDEX, 'modifiers': COMPILED_MODIFIERS}
+        with override_settings(SLOW_WORD_SECONDS=0):
+            stats = []
+            process_words(words, workers=1, stats=stats, **kwargs)
+        for word, word_stats in zip(words, stats):
+            trace = []
+            process_single_word(word, trace=trace, **kwargs)
+            self.assertEqual(word_stats['trace'], trace)
+        # The trace is only kept for the slow words
+        with override_settings(SLOW_WORD_SECONDS=60):
+            stats = []
+            process_words(words, workers=1, stats=stats, **kwargs)
+        self.assertFalse(any('trace' in word_stats for word_stats in stats))
+
+class RuleMatcherTests(SimpleTestCase):
+
+    def test_same_as_replace(self):
+        words = load_corpus_words(300, seed=3) + ['ööö', 'üüüü', 'nienie', 'ieee']
+        for section, matcher in zip(MODIFIERS, COMPILED_MODIFIERS):
+            for word in words:
+                with self.subTest(word=word):
+                    self.assertEqual(matcher.alternations(word),
+                                     [word.replace(fr, to) for fr, to_list in section.items()
+                                      if fr in word for to in to_list])
+
+    def test_overlapping_keys(self):
+        matcher = RuleMatcher({'ab': ['x'], 'abc': ['y'], 'bb': ['z']})
+        self.assertEqual(matcher.matches('abbbabc'), {'ab': [0, 4], 'abc': [4], 'bb': [1, 2]})
+        self.assertEqual(matcher.alternations('abbbabc'), ['xbbxc', 'abbby', 'azbabc'])
+
+    def test_per_occurrence(self):
+        matcher = RuleMatcher({'oe': ['ui', 'u']})
+        self.assertEqual(matcher.alternations('koekoe', per_occurrence=True),
+                         ['kuikoe', 'koekui', 'kukoe', 'koeku'])
+
+# The results do not depend on a rule index that is built locally
+@override_settings(RULE_INDEX_PATH=None)
+class ProcessWordsTests(SimpleTestCase):
+
+    def test_same_as_single(self):
+        words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(40, seed=4)]
+        stats = []
+        self.assertEqual(process_words(words, workers=3, chunksize=4, stats=stats),
+                         [process_single_word(w, vocabulary=VOCABULARY_INDEX, modifiers=COMPILED_MODIFIERS)
+                          for w in words])
+        self.assertEqual(len(stats), len(words))
+
+    def test_rulebased_workers(self):
+        with mock.patch('os.cpu_count', return_value=8):
+            with override_settings(RULEBASED_WORKERS=None, JOB_WORKERS=3):
+                self.assertEqual(rulebased_workers(), 2)
+            with override_settings(RULEBASED_WORKERS=None, JOB_WORKERS=16):
+                self.assertEqual(rulebased_workers(), 1)
+            with override_settings(RULEBASED_WORKERS=5, JOB_WORKERS=3):
+                self.assertEqual(rulebased_workers(), 5)
+
+    def test_pool_keeps_cache(self):
+        words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(40, seed=12)]
+        CLOSEST_CACHE.clear()
+        # A pool of another size may be left by an earlier test
+        stop_pool()
+        start_pool(2)
+        try:
+            first = []
+            keywords = process_words(words, workers=2, chunksize=2, stats=first)
+            # Which worker gets a word differs between the batches, so after a few
+            # batches both workers have searched most of the words
+            for _ in range(3):
+                second = []
+                self.assertEqual(process_words(words, workers=2, chunksize=2, stats=second), keywords)
+        finally:
+            stop_pool()
+        # The workers still have the vocabulary lookups of the earlier batches
+        self.assertGreater(sum(word_stats['closest_hits'] for word_stats in second),
+                           sum(word_stats['closest_hits'] for word_stats in first))
+        self.assertLess(sum(word_stats['closest_misses'] for word_stats in second),
+                        sum(word_stats['closest_misses'] for word_stats in first))
+
+    @override_settings(G2P_BACKEND='fake')
+    def test_run_predictors(self):
+        words = [clean_str_word(w, split=True, hard=True) for w in load_corpus_words(10, seed=5)]
+        rulebased, stats, phonetisaurus, timings = run_predictors(words)
+        self.assertEqual(rulebased, process_words(words, workers=1))
+        self.assertEqual(phonetisaurus, [w if w else '-' for w in words])
+        self.assertEqual(len(stats), len(words))
+        self.assertLessEqual(timings['rulebased'], timings['total'])
+        self.assertLessEqual(timings['phonetisaurus'], timings['total'])
+
+class G2PPoolTests(SimpleTestCase):
+
+    def fake(self, *args):
+        return [sys.executable, g2p.__file__, '--fake'] + list(args)
+
+    def test_batches_in_order(self):
+        pool = g2p.G2PPool(self.fake(), batch_size=2)
+        try:
+            self.assertEqual(pool.predict(['a', 'b', 'c']), ['a', 'b', 'c'])
+            # The same worker is reused for the next request
+            process = pool.workers[0].process
+            self.assertEqual(pool.predict(['d']), ['d'])
+            self.assertIs(pool.workers[0].process, process)
+        finally:
+            pool.close()
+
+    def test_shards_in_order(self):
+        pool = g2p.G2PPool(self.fake(), size=3, batch_size=2)
+        words = [str(i) for i in range(11)]
+        try:
+            self.assertEqual(pool.predict(words, shards=3), words)
+            self.assertTrue(all(worker.process is not None for worker in pool.workers))
+        finally:
+            pool.close()
+
+    def test_restart_after_crash(self):
+        pool = g2p.G2PPool(self.fake('--exit-after', '2'), batch_size=2)
+        try:
+            self.assertEqual(pool.predict(['a', 'b', 'c', 'd', 'e']), ['a', 'b', 'c', 'd', 'e'])
+        finally:
+            pool.close()
+
+    def test_timeout(self):
+        pool = g2p.G2PPool(self.fake('--delay', '5'), timeout=0.2, retries=0)
+        try:
+            with self.assertRaises(g2p.G2PWorkerError):
+                pool.predict(['a'])
+        finally:
+            pool.close()
+
+    def test_worker_fails_to_start(self):
+        # The same as a missing Phonetisaurus module: the worker stops at once
+        pool = g2p.G2PPool([sys.executable, '-c', 'import sys; sys.exit(1)'], retries=1)
+        try:
+            with self.assertRaises(g2p.G2PWorkerError):
+                pool.predict(['a', 'b'])
+        finally:
+            pool.close()
+        pool = g2p.G2PPool(['/nonexistent/phonetisaurus-worker'])
+        with self.assertRaises(g2p.G2PWorkerError):
+            pool.predict(['a'])
+
+    @override_settings(G2P_BACKEND='fake')
+    def test_apply_phonetisaurus(self):
+        self.assertEqual(apply_phonetisaurus(['kaorn', '', 'wiendrouf'], model_path='fake-model', shards=2),
+                         ['kaorn', '-', 'wiendrouf'])
+
+# The results do not depend on a rule index that is built locally
+@override_settings(RULE_INDEX_PATH=None)
+class ProcessFileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.media.name, 'user'))
+        self.words = load_corpus_words(30, seed=6)
+        # Duplicates, also with surrounding white space, are only processed once
+        with open(os.path.join(self.media.name, 'user', 'words.txt'), 'w') as f:
+            f.write('\n'.join(self.words + [' ' + w for w in self.words[:5]] + self.words[10:20]) + '\n')
+
+    def tearDown(self):
+        self.media.cleanup()
+
+    def test_read_unique_lines(self):
+        path = os.path.join(self.media.name, 'user', 'words.txt')
+        with open(path, 'r') as f:
+            expected = sorted({line.strip() for line in f.readlines()})
+        self.assertEqual(list(read_unique_lines(path, run_size=7)), expected)
+
+    def test_process_file(self):
+        progress = []
+        with override_settings(MEDIA_ROOT=self.media.name, G2P_BACKEND='fake', UPLOAD_CHUNK_SIZE=8,
+                               SORT_RUN_SIZE=7, RULEBASED_WORKERS=1,
+                               PREDICTION_CACHE_PATH=os.path.join(self.media.name, 'predictions.sqlite3')):
+            first_metrics = process_file('user/words', 'user@example.com',
+                                         progress=lambda processed, total, timings, hits, predicted: progress.append(
+                                             (processed, total, hits, predicted)))
+            with open(os.path.join(self.media.name, 'user', 'words_processed.tsv'), 'r') as f:
+                first = f.read()
+
+            # Without the cache, the predictors are run on every word
+            self.assertEqual(progress[-1], (30, 30, 0, 30))
+
+            # The second time, every prediction comes from the cache
+            progress.clear()
+            second_metrics = process_file('user/words', 'user@example.com',
+                                          progress=lambda processed, total, timings, hits, predicted: progress.append(
+                                              (processed, total, hits, predicted)))
+
+        # The progress is reported before the first chunk and after every chunk
+        self.assertEqual(progress, [(0, 30, 0, 0), (8, 30, 8, 0), (16, 30, 16, 0), (24, 30, 24, 0),
+                                    (30, 30, 30, 0)])
+
+        expected = 'Dialect Word\tFirst Estimate\tSecond Estimate\n'
+        for word in sorted(set(self.words)):
+            clean = clean_str_word(word, split=True, hard=True)
+            keywords = process_single_word(clean, vocabulary=VOCABULARY_INDEX, modifiers=COMPILED_MODIFIERS)
+            expected += word + '\t' + keywords[0]['trefwoord'] + ' (' + str(keywords[0]['score']) + ')\t'
+            expected += (clean + ' (3)\t' if clean else '- (-)\t') + '\n'
+
+        with open(os.path.join(self.media.name, 'user', 'words_processed.tsv'), 'r') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(first, expected)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # The metrics of the last run are written next to the processed file
+        with open(os.path.join(self.media.name, 'user', 'words_processed.metrics.json'), 'r') as f:
+            self.assertEqual(json.load(f), second_metrics)
+        counters = first_metrics['counters']
+        self.assertEqual(counters['words'], 30)
+        self.assertEqual(counters['words_cached'], 0)
+        self.assertGreater(counters['closest_calls'], 0)
+        self.assertGreater(counters['alternations_tried{section="0"}'], 0)
+        self.assertLessEqual(counters['alternations_accepted{section="0"}'],
+                             counters['alternations_tried{section="0"}'])
+        for timer in ('clean', 'rulebased', 'phonetisaurus', 'write', 'index', 'job'):
+            self.assertIn(timer, first_metrics['timers'])
+        self.assertEqual(second_metrics['counters']['words_cached'], 30)
+        self.assertNotIn('closest_calls', second_metrics['counters'])
+
+    def test_job_deadline(self):
+        cache_path = os.path.join(self.media.name, 'predictions.sqlite3')
+        with override_settings(MEDIA_ROOT=self.media.name, G2P_BACKEND='fake', RULEBASED_WORKERS=1,
+                               PREDICTION_CACHE_PATH=cache_path, JOB_DEADLINE_SECONDS=0):
+            metrics = process_file('user/words')
+        results = ResultFile(os.path.join(self.media.name, 'user', 'words_processed.tsv'))
+        truncated = sum(row[2].endswith('*') for row in results[:])
+        self.assertGreater(truncated, 0)
+        self.assertEqual(truncated, metrics['counters']['words_truncated'])
+        # The searches stopped by the time limit are not cached
+        self.assertEqual(PredictionCache(cache_path, 10 ** 9).size()[0], 30 - truncated)
+
+    def test_g2p_failure_not_cached(self):
+        cache_path = os.path.join(self.media.name, 'predictions.sqlite3')
+        # The same as a missing Phonetisaurus module: the workers stop at once
+        broken = {'broken': lambda model_path: [sys.executable, '-c', 'import sys; sys.exit(1)']}
+        with mock.patch.dict(g2p.BACKENDS, broken), \
+                override_settings(MEDIA_ROOT=self.media.name, G2P_BACKEND='broken', RULEBASED_WORKERS=1,
+                                  PREDICTION_CACHE_PATH=cache_path):
+            with self.assertRaises(g2p.G2PWorkerError):
+                process_file('user/words')
+        self.assertEqual(PredictionCache(cache_path, 10 ** 9).size(), (0, 0))
+
+    def test_slow_words(self):
+        with override_settings(MEDIA_ROOT=self.media.name, G2P_BACKEND='fake', RULEBASED_WORKERS=1,
+                               PREDICTION_CACHE_PATH=None, SLOW_WORD_SECONDS=0):
+            with self.assertLogs('text_processing', 'WARNING'):
+                metrics = process_file('user/words')
+        with open(os.path.join(self.media.name, 'user', 'words_processed.slow_words.json'), 'r') as f:
+            report = json.load(f)
+        # Every word is slow when the threshold is 0
+        self.assertEqual(len(report['words']), 30)
+        self.assertEqual(metrics['counters']['words_slow'], 30)
+        self.assertTrue(report['worst_rules'])
+
+class MetricsTests(SimpleTestCase):
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.incr('words', 3)
+        metrics.incr('alternations_tried{section="1"}')
+        with metrics.timer('write'):
+            pass
+        metrics.observe('write', 0.5)
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {'words': 3, 'alternations_tried{section="1"}': 1})
+        self.assertEqual(summary['timers']['write']['count'], 2)
+        self.assertGreaterEqual(summary['timers']['write']['seconds'], 0.5)
+
+        merged = merge([summary, summary])
+        self.assertEqual(merged['counters']['words'], 6)
+        self.assertEqual(merged['timers']['write']['count'], 4)
+
+    def test_disabled(self):
+        metrics = Metrics(enabled=False)
+        metrics.incr('words')
+        with metrics.timer('write'):
+            pass
+        self.assertEqual(metrics.summary(), {'counters': {}, 'timers': {}})
+
+    def test_prometheus(self):
+        text = to_prometheus({'counters': {'alternations_tried{section="0"}': 2, 'alternations_tried{section="1"}': 5},
+                              'timers': {'write': {'count': 2, 'seconds': 0.25}}},
+                             gauges={'jobs{state="queued"}': 1})
+        self.assertEqual(text.splitlines(), [
+            '# TYPE dialect2keyword_alternations_tried_total counter',
+            'dialect2keyword_alternations_tried_total{section="0"} 2.0',
+            'dialect2keyword_alternations_tried_total{section="1"} 5.0',
+            '# TYPE dialect2keyword_write_seconds summary',
+            'dialect2keyword_write_seconds_sum 0.25',
+            'dialect2keyword_write_seconds_count 2.0',
+            '# TYPE dialect2keyword_jobs gauge',
+            'dialect2keyword_jobs{state="queued"} 1.0',
+        ])
+
+class PredictionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = PredictionCache(os.path.join(self.tmp.name, 'predictions.sqlite3'), max_bytes=100)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_put(self):
+        self.cache.put_many('a', {'hoes': ([{'trefwoord': 'huis', 'score': 4}], 'hoes')})
+        self.assertEqual(self.cache.get_many('a', ['hoes', 'kaerk']),
+                         {'hoes': ([{'trefwoord': 'huis', 'score': 4}], 'hoes')})
+        # Predictions of another configuration are not returned
+        self.assertEqual(self.cache.get_many('b', ['hoes']), {})
+
+    def test_eviction(self):
+        for i in range(20):
+            self.cache.put_many('a', {'word' + str(i): ([], '-')})
+            # Reading the first word keeps it recently used
+            self.cache.get_many('a', ['word0'])
+        count, size = self.cache.size()
+        self.assertLessEqual(size, 100)
+        self.assertIn('word0', self.cache.get_many('a', ['word0', 'word1']))
+        self.assertNotIn('word1', self.cache.get_many('a', ['word1']))
+
+    def test_running_size(self):
+        self.cache.put_many('a', {'hoes': ([], 'hoes'), 'kaerk': ([], 'kaerk')})
+        self.assertEqual(self.cache.size(), (2, 4 + 2 + 4 + 5 + 2 + 5))
+        # A replaced prediction only counts once
+        self.cache.put_many('a', {'hoes': ([], 'h')})
+        self.assertEqual(self.cache.size(), (2, 4 + 2 + 1 + 5 + 2 + 5))
+        # The total is the same as the sum of the rows after evicting
+        for i in range(20):
+            self.cache.put_many('a', {'word' + str(i): ([], '-')})
+        with sqlite3.connect(self.cache.path) as db:
+            count, size = db.execute('SELECT COUNT(*), SUM(size) FROM predictions').fetchone()
+        self.assertEqual(self.cache.size(), (count, size))
+        # An existing file without the total gets it from the rows
+        with sqlite3.connect(self.cache.path) as db:
+            db.execute('DROP TABLE meta')
+        self.assertEqual(PredictionCache(self.cache.path, max_bytes=100).size(), (count, size))
+
+class ProfilingTests(SimpleTestCase):
+
+    def test_should_profile(self):
+        with override_settings(PROFILE_EVERY_N_JOBS=None):
+            self.assertFalse(should_profile(4))
+            self.assertTrue(should_profile(5, requested=1))
+        with override_settings(PROFILE_EVERY_N_JOBS=4):
+            self.assertEqual([should_profile(i) for i in range(1, 9)], [False, False, False, True] * 2)
+
+    def test_run_profiled(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(PROFILE_TOP=5):
+            path = os.path.join(tmp, 'words_processed')
+            self.assertEqual(run_profiled(path, clean_many, ['hoës', 'kaerk'], split=True, hard=True),
+                             [clean_str_word(w, split=True, hard=True) for w in ['hoës', 'kaerk']])
+            self.assertTrue(os.path.getsize(path + '.prof'))
+            with open(path + '.profile.txt', 'r') as f:
+                summary = f.read()
+        self.assertIn('Top 5 functions by tottime', summary)
+        self.assertIn('clean_many', summary)
+
+    @override_settings(RULE_INDEX_PATH=None)
+    def test_profiled_job_shows_search(self):
+        with tempfile.TemporaryDirectory() as media:
+            os.mkdir(os.path.join(media, 'user'))
+            with open(os.path.join(media, 'user', 'words.txt'), 'w') as f:
+                f.write('\n'.join(load_corpus_words(10, seed=15)) + '\n')
+            # The same as a profiled job of jobs.work(): the search runs in the profiled process
+            with override_settings(MEDIA_ROOT=media, G2P_BACKEND='fake', RULEBASED_WORKERS=2,
+                                   PREDICTION_CACHE_PATH=None):
+                path = os.path.join(media, 'user', 'words_processed')
+                run_profiled(path, process_file, 'user/words', workers=1)
+            with open(path + '.profile.txt', 'r') as f:
+                summary = f.read()
+        self.assertIn('alternate_dialect', summary)
+
+class JobQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = jobs.JobQueue(os.path.join(self.tmp.name, 'jobs.sqlite3'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_fair_order(self):
+        self.queue.submit('anna', 'anna/a1')
+        self.queue.submit('anna', 'anna/a2')
+        self.queue.submit('bert', 'bert/b1')
+        # The second job of a folder waits until the other folders had their turn
+        self.assertEqual(self.queue.claim()['file_name'], 'anna/a1')
+        self.assertEqual(self.queue.claim()['file_name'], 'bert/b1')
+        self.assertEqual(self.queue.claim()['file_name'], 'anna/a2')
+        self.assertIsNone(self.queue.claim())
+
+    def test_profile_flag(self):
+        self.queue.submit('anna', 'anna/a1', profile=True)
+        self.queue.submit('anna', 'anna/a2')
+        self.assertEqual([self.queue.claim()['profile'] for _ in range(2)], [1, 0])
+
+    def test_metrics_totals(self):
+        for name in ('a1', 'a2'):
+            self.queue.submit('anna', 'anna/' + name)
+            job_id = self.queue.claim()['id']
+            self.queue.finish(job_id, metrics={'counters': {'words': 10}, 'timers': {'search': {'count': 1, 'seconds': 0.5}}})
+        expected = {'counters': {'words': 20}, 'timers': {'search': {'count': 2, 'seconds': 1.0}}}
+        self.assertEqual(self.queue.metrics(), expected)
+
+        # The totals of a queue created before they were kept are added up once from the jobs
+        with self.queue._connect() as db:
+            db.execute('DROP TABLE meta')
+        self.assertEqual(jobs.JobQueue(self.queue.path).metrics(), expected)
+
+    @override_settings(MAX_QUEUED_JOBS=3, MAX_QUEUED_JOBS_PER_FOLDER=2)
+    def test_admission(self):
+        self.queue.submit('anna', 'anna/a1')
+        self.queue.submit('anna', 'anna/a2')
+        with self.assertRaises(jobs.QueueFull):
+            self.queue.submit('anna', 'anna/a3')
+        self.queue.submit('bert', 'bert/b1')
+        with self.assertRaises(jobs.QueueFull):
+            self.queue.submit('carl', 'carl/c1')
+
+    @override_settings(MAX_JOB_ATTEMPTS=2)
+    def test_recover(self):
+        job_id = self.queue.submit('anna', 'anna/a1', 'anna@example.com')
+        self.queue.claim()
+        # The current process is alive, so its job is left alone
+        self.assertEqual(self.queue.recover(alive_pids={os.getpid()}), 0)
+        self.assertEqual(self.queue.recover(), 1)
+        self.assertEqual(self.queue.counts(), {'queued': 1})
+        # A shutdown on purpose does not use up an attempt
+        for _ in range(3):
+            self.assertEqual(self.queue.claim()['id'], job_id)
+            self.assertEqual(self.queue.recover(interrupted=True), 1)
+        self.assertEqual(self.queue.counts(), {'queued': 1})
+        # Only the attempt of the first recover() counts
+        self.assertEqual(self.queue.claim()['attempts'], 1)
+        self.queue.recover()
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+
+    @override_settings(JOB_STALL_SECONDS=60)
+    def test_status(self):
+        self.assertIsNone(self.queue.status('anna/a1'))
+        self.queue.submit('anna', 'anna/a1')
+        self.queue.submit('anna', 'anna/a2')
+        self.assertEqual(self.queue.status('anna/a2')['position'], 2)
+
+        job = self.queue.claim()
+        self.queue.set_progress(job['id'], 250, 1000, {'rulebased': 5.0, 'phonetisaurus': 2.0, 'total': 5.0},
+                                cache_hits=150, predicted_words=100)
+        status = self.queue.status('anna/a1')
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual((status['processed_words'], status['total_words']), (250, 1000))
+        # The rates of the predictors leave out the cached words
+        self.assertEqual((status['rulebased_rate'], status['phonetisaurus_rate']), (20, 50))
+        self.assertEqual(status['cache_hit_rate'], 0.6)
+        self.assertGreater(status['eta'], time.time())
+        self.assertFalse(status['stalled'])
+
+        with override_settings(JOB_STALL_SECONDS=-1):
+            self.assertTrue(self.queue.status('anna/a1')['stalled'])
+
+        self.queue.finish(job['id'])
+        self.assertEqual(self.queue.status('anna/a1')['state'], 'done')
+        self.assertEqual(self.queue.status('anna/a2')['position'], 1)
+
+    def test_get_queue(self):
+        with override_settings(JOB_QUEUE_PATH=self.queue.path):
+            queue = jobs.get_queue()
+            self.assertIs(jobs.get_queue(), queue)
+        with override_settings(JOB_QUEUE_PATH=os.path.join(self.tmp.name, 'other.sqlite3')):
+            self.assertIsNot(jobs.get_queue(), queue)
+
+    def test_status_view(self):
+        with override_settings(JOB_QUEUE_PATH=self.queue.path):
+            self.queue.submit('anna', 'anna/a1')
+            response = self.client.get('/status/anna/a1_processed')
+            self.assertEqual(response.json()['state'], 'queued')
+            self.assertEqual(self.client.get('/status/anna/a2').status_code, 404)
+
+    def test_metrics_view(self):
+        with override_settings(JOB_QUEUE_PATH=self.queue.path):
+            for i in range(2):
+                job_id = self.queue.submit('anna', 'anna/a' + str(i))
+                self.queue.claim()
+                self.queue.finish(job_id, metrics={'counters': {'words': 10}, 'timers': {}})
+            self.queue.submit('anna', 'anna/a2')
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('dialect2keyword_words_total 20.0', response.content.decode())
+        self.assertIn('dialect2keyword_jobs{state="queued"} 1.0', response.content.decode())
+
+class ResultFileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.media.name, 'user'))
+        self.path = os.path.join(self.media.name, 'user', 'words_processed.tsv')
+        rows = ['wörd' + str(i) + '\tword' + str(i) + ' (4)\t- (-)\t' + ('note' if i % 3 == 0 else '') + '\n'
+                for i in range(123)]
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('Dialect Word\tFirst Estimate\tSecond Estimate\tManual Annotation\n' + ''.join(rows))
+
+    def tearDown(self):
+        self.media.cleanup()
+
+    def test_same_as_load_data(self):
+        with override_settings(MEDIA_ROOT=self.media.name):
+            expected = load_data('user', 'words_processed')
+        results = ResultFile(self.path)
+        self.assertEqual(results.count(), len(expected))
+        for start, stop in ((0, 50), (50, 100), (100, 150), (122, 123), (7, 7)):
+            self.assertEqual(results[start:stop], expected[start:stop])
+        self.assertEqual(results[-1], expected[-1])
+
+    def test_rebuilt_after_change(self):
+        ResultFile(self.path)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('extra\tword (1)\t- (-)\t\n')
+        results = ResultFile(self.path)
+        self.assertEqual(results.count(), 124)
+        self.assertEqual(results[123], ['extra', 'word', '1', '-', '-'])
+
+    def test_build_index_concurrently(self):
+        errors = []
+        def build():
+            try:
+                for _ in range(20):
+                    build_index(self.path)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=build) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.path))),
+                         ['words_processed.tsv', 'words_processed.tsv.idx'])
+        self.assertEqual(ResultFile(self.path).count(), 123)
+
+    def test_replaced_while_open(self):
+        results = ResultFile(self.path)
+        store = AnnotationStore(self.path)
+        store.save({i: ('wörd' + str(i), 'a longer annotation') for i in range(0, 123, 2)})
+        # The rows are longer now, so the offsets of the old index do not fit the new file
+        store.compact()
+        self.assertEqual(results[50:53], [['wörd50', 'word50', '4', '-', '-', 'a longer annotation'],
+                                          ['wörd51', 'word51', '4', '-', '-', 'note'],
+                                          ['wörd52', 'word52', '4', '-', '-', 'a longer annotation']])
+
+    def test_words_view(self):
+        with override_settings(MEDIA_ROOT=self.media.name, MAX_WORDS_PAGE=50):
+            response = self.client.get('/words/user/words_processed/?page=3')
+        self.assertEqual([w[0] for w in response.context['words']], ['wörd' + str(i) for i in range(100, 123)])
+        self.assertEqual(response.context['words'].paginator.num_pages, 3)
+
+    def test_save_pages_concurrently(self):
+        def save_page(page):
+            start = (page - 1) * 50
+            self.client.post('/words/user/words_processed/save/page=' + str(page),
+                             {'input-for-wörd' + str(i): 'page ' + str(page) for i in range(start, min(start + 50, 123))})
+
+        with override_settings(MEDIA_ROOT=self.media.name, MAX_WORDS_PAGE=50, ANNOTATION_COMPACT_ROWS=1000):
+            threads = [threading.Thread(target=save_page, args=(page,)) for page in (1, 2, 3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # The annotations are shown before they are written into the file
+            response = self.client.get('/words/user/words_processed/?page=2')
+            self.assertEqual({w[5] for w in response.context['words']}, {'page 2'})
+            self.assertEqual(AnnotationStore(self.path).compact(), 123)
+
+            self.assertEqual([row[5] for row in load_data('user', 'words_processed')],
+                             ['page ' + str(i // 50 + 1) for i in range(123)])
+            self.assertEqual(AnnotationStore(self.path).get(0, 123), {})
+
+    def test_save_missing_file(self):
+        with override_settings(MEDIA_ROOT=self.media.name):
+            response = self.client.post('/words/user/missing_processed/save/page=1', {'input-for-wörd0': 'x'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_views_create_no_store(self):
+        with override_settings(MEDIA_ROOT=self.media.name):
+            self.assertEqual(self.client.get('/words/user/words_processed/').status_code, 200)
+            self.assertEqual(self.client.get('/words/user/words_processed/download').status_code, 200)
+        self.assertFalse(os.path.exists(self.path + '.annotations.sqlite3'))
+
+    def test_download_includes_annotations(self):
+        AnnotationStore(self.path).save({1: ('wörd1', 'checked')})
+        with override_settings(MEDIA_ROOT=self.media.name):
+            response = self.client.get('/words/user/words_processed/download')
+            lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[2], 'wörd1\tword1 (4)\t- (-)\tchecked\t')
+
+    def test_download_pending_annotations(self):
+        store = AnnotationStore(self.path)
+        store.save({0: ('wörd0', 'first'), 61: ('wörd61', 'a longer annotation'), 122: ('wörd122', 'last')})
+        with open(self.path, 'rb') as f:
+            original = f.read()
+        url = '/words/user/words_processed/download'
+        with override_settings(MEDIA_ROOT=self.media.name):
+            response = self.client.get(url)
+            content = b''.join(response.streaming_content)
+            etag = response['ETag']
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            for first, last in ((0, 10), (1500, 1800), (3000, 3999)):
+                response = self.client.get(url, HTTP_RANGE='bytes=%d-%d' % (first, last), HTTP_IF_RANGE=etag)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b''.join(response.streaming_content), content[first:last + 1])
+            self.assertEqual(gzip.decompress(b''.join(self.client.get(url, {'gzip': 1}).streaming_content)), content)
+
+            # The file is not written by a download
+            with open(self.path, 'rb') as f:
+                self.assertEqual(f.read(), original)
+            # Every save is another version
+            store.save({0: ('wörd0', 'first')})
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # The same as the file once the annotations are written into it
+        store.compact()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_download_conditional_range_gzip(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        url = '/words/user/words_processed/download'
+        with override_settings(MEDIA_ROOT=self.media.name):
+            response = self.client.get(url)
+            self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            etag = response['ETag']
+
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+            response = self.client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 10-19/' + str(len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content[10:20])
+            response = self.client.get(url, HTTP_RANGE='bytes=-5')
+            self.assertEqual(b''.join(response.streaming_content), content[-5:])
+            # A range of an older version gets the whole file
+            self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"old"').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=100000-').status_code, 416)
+
+            response = self.client.get(url, {'gzip': 1})
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), content)
+            self.assertNotEqual(response['ETag'], etag)
+
+            # Saved annotations change the file, so the old version is not valid anymore
+            AnnotationStore(self.path).save({1: ('wörd1', 'checked')})
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+class BenchmarkSuiteTests(SimpleTestCase):
+
+    def test_workload(self):
+        self.assertEqual(benchmarks.workload('small', seed=1), benchmarks.workload('small', seed=1))
+        self.assertNotEqual(benchmarks.workload('small', seed=1), benchmarks.workload('small', seed=2))
+        self.assertEqual(len(benchmarks.workload('small')), benchmarks.TIERS['small'])
+
+    def test_run_and_compare(self):
+        results = benchmarks.run_suite('small', stages=['clean_str_word', 'apply_phonetisaurus'])
+        self.assertEqual(set(results['stages']), {'clean_str_word', 'apply_phonetisaurus'})
+        for stage in results['stages'].values():
+            self.assertGreater(stage['words_per_second'], 0)
+            self.assertLessEqual(stage['p50_ms'], stage['p99_ms'])
+
+        self.assertEqual(benchmarks.compare(results, results, 0.2), [])
+        slower = json.loads(json.dumps(results))
+        slower['stages']['clean_str_word']['words_per_second'] *= 2
+        self.assertEqual(len(benchmarks.compare(results, slower, 0.2)), 1)
@@ -2,17 +2,20 @@
 
 import os
 from glob import glob
-from multiprocessing import Process
+from functools import partial
 
 from django.urls import reverse
-from django.http import FileResponse
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse, Http404
 from django.shortcuts import render, redirect
-from django.core.files import File
 from django.core.files.storage import FileSystemStorage
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger, InvalidPage
 from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 
-from text_processing import process_file
+from jobs import get_queue, QueueFull
+from metrics import to_prometheus
+from results import ResultFile, AnnotatedFile, AnnotationStore, parse_row, apply_annotations, iter_file, iter_gzip
 
 def load_data(folder_name, file_name):
     """A helper class to load a "processed" file from the media folder
@@ -50,12 +53,7 @@ def load_data(folder_name, file_name):
             for i, line in enumerate(f.readlines()):
                 if i == 0:
                     continue
-                # The original processed file contains confidence scores within paranthesis
-                # For easier reading on the templating, we change the structure into
-                # [dialect, keyword1, confidence1, keyword2, confidence2]
-                line = line.strip().replace(' (', '|').replace(')', '')
-                line = [ls for l in line.split('\t') for ls in l.split('|') if ls]
-                data_.append(line)
+                data_.append(parse_row(line))
 
     return data_
 
@@ -67,6 +65,8 @@ def home(request):
 def upload(request):
     """File upload code that runs when the 'Upload' button is clicked
     """
+    error = False
+
     # The files are uploaded in a form,
     # and so, we capture the action as a POST request here
     if request.method == 'POST':
@@ -75,6 +75,8 @@ def upload(request):
         upfile = request.FILES['upfile'] # file object
         folder_name = request.POST['folder_name'] # string
         email_address = request.POST.get('email-address', '') # string, (default='')
+        # Runs the processing under the profiler, see profiling.py
+        profile = bool(request.POST.get('profile')) # bool, (default=False)
 
         # Next lines saves the uploaded file into the project's 'media' folder
         # Notice that we save the file in a nested folder named as the give 'folder_name'
@@ -83,31 +85,67 @@ def upload(request):
         file_name = file_name.split('.txt')[0]
         # Data URL is shown back on the webpage after the successful upload
         data_url = 'https://dialect2keyword.cls.ru.nl/words/' + file_name + '_processed/'
+        # The upload page polls the status URL to show the progress of the processing
+        status_url = reverse('status', args=file_name.split('/', 1))
 
-        # Here we call the function that will process the uploaded data_
-        # We use parallel processing to be able to load the next page
-        # without waiting for the processing to be completed
-        p = Process(target=process_file, args=(file_name, email_address))
-        p.start()
+        # Here we add the uploaded data_ to the job queue, so that the next page
+        # loads without waiting for the processing to be completed.
+        # The queue is processed by the workers of 'python manage.py process_jobs'.
+        try:
+            get_queue().submit(folder_name, file_name, email_address, profile=profile)
+        except QueueFull as e:
+            # Too many files are waiting already, the upload is not kept
+            fs.delete(file_name + '.txt')
+            data_url = False
+            status_url = False
+            error = str(e)
 
     else:
         folder_name = False
         data_url = False
+        status_url = False
 
     return render(request, 'upload.html', {
         'folder_name': folder_name, # string or bool
         'data_url' : data_url, # string or bool
+        'status_url': status_url, # string or bool
+        'error': error, # string or bool
     })
 
+def status(request, folder_name, file_name):
+    """Returns the progress of the processing of an uploaded file as JSON.
+    The file name can be given with or without the '_processed' suffix.
+    """
+    if file_name.endswith('_processed'):
+        file_name = file_name[:-len('_processed')]
+
+    status_ = get_queue().status(folder_name + '/' + file_name)
+    if status_ is None:
+        return JsonResponse({'error': 'No job found for this file.'}, status=404)
+
+    return JsonResponse(status_)
+
+def metrics(request):
+    """Returns the metrics of all finished jobs and the number of jobs in each state
+    in the Prometheus text format
+    """
+    queue = get_queue()
+    gauges = {'jobs{state="%s"}' % state: n for state, n in queue.counts().items()}
+    return HttpResponse(to_prometheus(queue.metrics(), gauges=gauges),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def words(request, folder_name, file_name):
     """Reads the processed data from the file system and sends it to the front end
     """
     # The page number for the paginator
     page = request.GET.get('page', 1) # integer, (default=1)
     page_range = []
+    prev_user_input = ''
 
-    # Load the requested data from the file
-    data_ = load_data(folder_name, file_name)
+    # Only the rows of the requested page are read from the file, through its index
+    fs = FileSystemStorage()
+    file_path = fs.path(folder_name + '/' + file_name + '.tsv')
+    data_ = ResultFile(file_path) if os.path.isfile(file_path) else []
 
     if data_:
         # We cannot display files with large number of words at once
@@ -116,10 +154,14 @@ def words(request, folder_name, file_name):
 
         try:
             data_ = paginator.page(page)
-        except (PageNotAnInteger, InvalidPage):
-            data_ = paginator.page(1)
         except EmptyPage:
             data_ = paginator.page(paginator.num_pages)
+        except (PageNotAnInteger, InvalidPage):
+            data_ = paginator.page(1)
+
+        # The annotations that are not written into the file yet
+        apply_annotations(data_.object_list, data_.start_index() - 1,
+                          AnnotationStore(file_path).get(data_.start_index() - 1, data_.end_index()))
 
         # The list of previous user input
         # These are given to input objects via javascript for a continuous
@@ -143,7 +185,9 @@ def words(request, folder_name, file_name):
     })
 
 def save(request, folder_name, file_name, page):
-    """Saves the user input into the processed files back
+    """Saves the user input of a page into the annotation store of the processed file.
+    The annotations are written into the file itself once ANNOTATION_COMPACT_ROWS of them
+    are waiting.
     """
     if request.method == 'POST':
 
@@ -154,59 +198,126 @@ def save(request, folder_name, file_name, page):
                       for key, val in request.POST.items()
                       if key.startswith('input-for-')]
 
-        # Load the entire dataset from the file
-        data_ = load_data(folder_name, file_name)
+        # Only the rows of the saved page are read from the file
+        fs = FileSystemStorage()
+        file_path = fs.path(folder_name + '/' + file_name + '.tsv')
+        start = (page-1)*settings.MAX_WORDS_PAGE
+        try:
+            rows = ResultFile(file_path)[start:page*settings.MAX_WORDS_PAGE]
+        except FileNotFoundError:
+            raise Http404('File not found.')
 
         # As user only given input on a specific page, we can align the user inputs
         # and the original data by only looping over the paginated subset of the dataset
-        for i, item in enumerate(data_[(page-1)*settings.MAX_WORDS_PAGE:page*settings.MAX_WORDS_PAGE]):
+        annotations = {}
+        for i, (item, item_input) in enumerate(zip(rows, user_input), start):
             # For the sake of mind, the if statement here checks whether
             # the original data and the user input actually aligned
             # by checking whether the dialect word in the data is in the user input
-            if item[0] in user_input[i]:
-                if len(item) == 6:
-                    # If there is already aprevious user input,
-                    # just replace the previous one
-                    item[5] = user_input[i][item[0]]
-                elif len(item) == 5:
-                    # Add the user input to the data. Each item here becomes:
-                    # [dialect_word, first_estimate, first_estimate_confidence,
-                    # second_estimate, second_estimate_confidence, user_input]
-                    item.append(user_input[i][item[0]])
-
-        # Prepare the string to be written to the file
-        to_write = 'Dialect Word\tFirst Estimate\tSecond Estimate\tManual Annotation\n'
-        for item in data_:
-            to_write += item[0] + '\t'
-            to_write += item[1] + ' (' + str(item[2]) + ')' + '\t'
-            to_write += item[3] + ' (' + str(item[4]) + ')' + '\t'
-            to_write += (item[5] if len(item) == 6 else '') + '\t'
-            to_write += '\n'
-
-        # Write to the file
-        with open(settings.MEDIA_ROOT + '/' + folder_name  + '/' + file_name + '.tsv', 'w') as fn:
-            myfile = File(fn)
-            myfile.write(to_write)
+            if item[0] in item_input:
+                annotations[i] = (item[0], item_input[item[0]])
+
+        # The annotations of the page are stored at once, next to those of the other pages
+        store = AnnotationStore(file_path)
+        if store.save(annotations) >= settings.ANNOTATION_COMPACT_ROWS:
+            store.compact()
 
     # Redirect back to the same page
     return redirect('/words/' + folder_name + '/' + file_name  + '/?page=' + str(page))
 
 def download(request, folder_name, file_name):
     """Function to download files from the media folder
+
+    The file is streamed, compressed with gzip when the 'gzip' parameter is given.
+    Browsers can check with the ETag and Last-Modified headers whether the file changed
+    since their last download, and resume an interrupted download with a byte range.
     """
     fs = FileSystemStorage()
-    response = FileResponse(fs.open(folder_name + '/' + file_name + '.tsv', 'rb'), content_type='application/force-download')
-    response['Content-Disposition'] = 'attachment; filename="' + file_name + '.tsv"'
+    file_path = fs.path(folder_name + '/' + file_name + '.tsv')
+    if not os.path.isfile(file_path):
+        raise Http404('File not found.')
+
+    # The waiting annotations are put in the rows while the file is streamed, without writing it.
+    # They are part of the version of the download, so the ETag changes with every save.
+    store = AnnotationStore(file_path)
+    saves, annotations = store.pending()
+    file_stat = os.stat(file_path)
+    compressed = bool(request.GET.get('gzip'))
+    etag = '"' + format(file_stat.st_mtime_ns, 'x') + '-' + format(file_stat.st_size, 'x') + (
+        '-a' + str(saves) if annotations else '') + ('-gz' if compressed else '') + '"'
+    last_modified = int(max(file_stat.st_mtime, os.path.getmtime(store.db_path)) if annotations else file_stat.st_mtime)
+
+    # Answers 304 Not Modified when the browser already has this version
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    if annotations:
+        annotated = AnnotatedFile(ResultFile(file_path), annotations)
+        size, iter_bytes = annotated.size, annotated.iter_bytes
+    else:
+        size, iter_bytes = file_stat.st_size, partial(iter_file, file_path)
+
+    if compressed:
+        response = StreamingHttpResponse(iter_gzip(iter_bytes()), content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="' + file_name + '.tsv.gz"'
+    else:
+        byte_range = _byte_range(request, etag, size)
+        if byte_range == 'unsatisfiable':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */' + str(size)
+            return response
+
+        start, stop = byte_range or (0, size)
+        response = StreamingHttpResponse(iter_bytes(start, stop), content_type='application/force-download',
+                                         status=206 if byte_range else 200)
+        response['Content-Length'] = str(stop - start)
+        if byte_range:
+            response['Content-Range'] = 'bytes ' + str(start) + '-' + str(stop - 1) + '/' + str(size)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = 'attachment; filename="' + file_name + '.tsv"'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
 
     return response
 
+def _byte_range(request, etag, size):
+    """Reads the single byte range requested in the Range header
+
+    Returns
+    -------
+    byte_range : tuple of integers, string or None
+        The first byte and the end of the range, 'unsatisfiable' when the range is
+        outside the file, or None when the whole file should be sent
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    # A range is only valid for the version of the file given in If-Range
+    if request.META.get('HTTP_IF_RANGE', etag) != etag:
+        return None
+
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start, stop = int(first), min(int(last) + 1, size) if last else size
+        else:
+            start, stop = max(size - int(last), 0), size
+    except ValueError:
+        return None
+
+    if start >= size or start >= stop:
+        return 'unsatisfiable'
+    return start, stop
+
 def files(request, folder_name):
     """Retrieves the processed file names previously uploaded under the same folder_name
     """
     # Read the file names from the folder of the user
     # Returns a list of file names without the file extensions
     file_names = [os.path.splitext(os.path.basename(file_path))[0]
-                  for file_path in glob(settings.MEDIA_ROOT + '/' + folder_name + '/*')
+                  for file_path in glob(settings.MEDIA_ROOT + '/' + folder_name + '/*.tsv')
                   if '_processed' in file_path]
 
     return render(request, 'files.html', {
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Contains the counters and timers that show where the time of a job goes
+
+The measurements of a job are collected in a :class:`Metrics` by
+:func:`text_processing.process_file()`, written as JSON next to the processed file,
+and stored with the job in the queue. The sum over all jobs is served in the
+Prometheus text format by the '/metrics' page.
+
+Counters can have labels, which are written as a part of their name
+in the Prometheus format, e.g. 'alternations_tried{section="0"}'.
+"""
+
+import time
+from contextlib import contextmanager
+
+# The prefix of the names in the Prometheus format
+PREFIX = 'dialect2keyword_'
+
+class Metrics:
+    """The counters and timers of a single job
+
+    Parameters
+    ----------
+    enabled : bool, (default=True)
+        When False, nothing is measured and every method returns at once,
+        so the instrumented code can call them unconditionally.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        # The number of measurements and their total number of seconds, by name
+        self.timers = {}
+
+    def incr(self, name, value=1):
+        """Adds a value to a counter"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """Adds a measured number of seconds to a timer"""
+        if self.enabled:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Measures the time spent in the with-block"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        """Returns the measurements as a dictionary that can be stored as JSON"""
+        return {'counters': dict(self.counters),
+                'timers': {name: {'count': count, 'seconds': seconds}
+                           for name, (count, seconds) in self.timers.items()}}
+
+def merge(summaries):
+    """Adds up the :meth:`Metrics.summary()` of several jobs"""
+    total = Metrics()
+    for summary in summaries:
+        for name, value in summary.get('counters', {}).items():
+            total.incr(name, value)
+        for name, timer in summary.get('timers', {}).items():
+            total.timers.setdefault(name, [0, 0.0])
+            total.timers[name][0] += timer['count']
+            total.timers[name][1] += timer['seconds']
+    return total.summary()
+
+def _split_labels(name):
+    base, _, labels = name.partition('{')
+    return base, '{' + labels if labels else ''
+
+def to_prometheus(summary, gauges=None):
+    """Writes a :meth:`Metrics.summary()` in the Prometheus text format.
+    The counters become counters, and the timers summaries in seconds.
+
+    Parameters
+    ----------
+    gauges : dictionary, (default=None)
+        Values that are not added up over time, such as the number of queued jobs,
+        written as gauges
+    """
+    lines = []
+    typed = set()
+
+    def add(name, kind, value):
+        base, labels = _split_labels(name)
+        if base not in typed:
+            lines.append('# TYPE ' + PREFIX + base + ' ' + kind)
+            typed.add(base)
+        lines.append(PREFIX + base + labels + ' ' + repr(float(value)))
+
+    for name, value in sorted(summary.get('counters', {}).items()):
+        base, labels = _split_labels(name)
+        add(base + '_total' + labels, 'counter', value)
+
+    for name, timer in sorted(summary.get('timers', {}).items()):
+        base, labels = _split_labels(name)
+        if base + '_seconds' not in typed:
+            lines.append('# TYPE ' + PREFIX + base + '_seconds summary')
+            typed.add(base + '_seconds')
+        lines.append(PREFIX + base + '_seconds_sum' + labels + ' ' + repr(float(timer['seconds'])))
+        lines.append(PREFIX + base + '_seconds_count' + labels + ' ' + repr(float(timer['count'])))
+
+    for name, value in sorted((gauges or {}).items()):
+        add(name, 'gauge', value)
+
+    return '\n'.join(lines) + '\n'
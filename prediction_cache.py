@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Contains the cache that keeps the predictions of words between uploads
+
+The same dialect words come back in many uploads, so the predictions of both
+algorithms are stored in a SQLite file by the preprocessed dialect word. Each
+prediction belongs to a configuration, a hash of everything that changes the
+result: the vocabulary, the rules, the Phonetisaurus model and the settings of
+the search. Predictions of other configurations are never returned, and are
+removed in time by the size limit, least recently used first.
+"""
+
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# SQLite limits the number of parameters of a single statement
+_BATCH_SIZE = 500
+
+class PredictionCache:
+    """A size-bounded, least recently used cache of predictions stored in a SQLite file,
+    which can be shared by several worker processes.
+
+    Parameters
+    ----------
+    path : string
+        The path of the SQLite file. Created when it does not exist.
+
+    max_bytes : integer
+        The approximate size of the stored predictions above which the least recently
+        used ones are removed.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS predictions (
+                              config TEXT NOT NULL,
+                              word TEXT NOT NULL,
+                              rulebased TEXT NOT NULL,
+                              phonetisaurus TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              used REAL NOT NULL,
+                              PRIMARY KEY (config, word))''')
+            db.execute('CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)')
+            # The total size of the predictions is kept up to date by the writes,
+            # so that they do not have to add up the whole table
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute('''INSERT OR IGNORE INTO meta
+                          SELECT 'size', COALESCE(SUM(size), 0) FROM predictions''')
+
+    @contextmanager
+    def _connect(self):
+        # Every call opens its own connection, so the cache can be used after a fork
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get_many(self, config, words):
+        """Returns the cached predictions of the given words, and marks them as used
+
+        Returns
+        -------
+        predictions : dictionary
+            The rule-based keywords and the Phonetisaurus keyword, as a tuple,
+            for each of the words that are cached
+        """
+        words = list(set(words))
+        predictions = {}
+        with self._connect() as db:
+            for start in range(0, len(words), _BATCH_SIZE):
+                batch = words[start:start + _BATCH_SIZE]
+                rows = db.execute('SELECT word, rulebased, phonetisaurus FROM predictions '
+                                  'WHERE config = ? AND word IN (' + ','.join('?' * len(batch)) + ')',
+                                  [config] + batch)
+                for word, rulebased, phonetisaurus in rows:
+                    predictions[word] = (json.loads(rulebased), phonetisaurus)
+
+            if predictions:
+                now = time.time()
+                db.execute('BEGIN IMMEDIATE')
+                db.executemany('UPDATE predictions SET used = ? WHERE config = ? AND word = ?',
+                               [(now, config, word) for word in predictions])
+                db.execute('COMMIT')
+
+        return predictions
+
+    def put_many(self, config, predictions):
+        """Stores the predictions of words, given as a dictionary of
+        (rule-based keywords, Phonetisaurus keyword) tuples by word,
+        and removes the least recently used ones beyond the size limit
+        """
+        now = time.time()
+        rows = []
+        for word, (rulebased, phonetisaurus) in predictions.items():
+            rulebased = json.dumps(rulebased, ensure_ascii=False)
+            rows.append((config, word, rulebased, phonetisaurus,
+                         len(word) + len(rulebased) + len(phonetisaurus), now))
+
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # The rows that are replaced no longer count towards the total
+                words = list(predictions)
+                replaced = 0
+                for start in range(0, len(words), _BATCH_SIZE):
+                    batch = words[start:start + _BATCH_SIZE]
+                    replaced += db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions '
+                                           'WHERE config = ? AND word IN (' + ','.join('?' * len(batch)) + ')',
+                                           [config] + batch).fetchone()[0]
+                db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)', rows)
+                total = self._total(db) + sum(row[4] for row in rows) - replaced
+                total = self._evict(db, total)
+                db.execute("UPDATE meta SET value = ? WHERE name = 'size'", (total,))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def _total(db):
+        return db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def _evict(self, db, total):
+        """Removes the least recently used predictions when the total size is above
+        the limit, and returns the total size that is left
+        """
+        if total <= self.max_bytes:
+            return total
+
+        # Removes a tenth more than needed, so that not every write has to evict
+        to_free = total - self.max_bytes * 0.9
+        evicted = []
+        for rowid, size in db.execute('SELECT rowid, size FROM predictions ORDER BY used'):
+            evicted.append((rowid,))
+            to_free -= size
+            total -= size
+            if to_free <= 0:
+                break
+        db.executemany('DELETE FROM predictions WHERE rowid = ?', evicted)
+        return total
+
+    def size(self):
+        """Returns the number of stored predictions and their approximate size in bytes"""
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0], self._total(db)
+
+def get_cache():
+    """Returns the prediction cache of the project stored at PREDICTION_CACHE_PATH,
+    or None when the cache is turned off
+    """
+    if not settings.PREDICTION_CACHE_PATH:
+        return None
+    return PredictionCache(settings.PREDICTION_CACHE_PATH, settings.PREDICTION_CACHE_MAX_BYTES)
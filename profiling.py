@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Contains the profiling of single jobs
+
+A job is run under :mod:`cProfile` when it was uploaded with the profile flag,
+or when it is one of the jobs sampled by PROFILE_EVERY_N_JOBS. The profile is
+stored next to the processed file with the extension '_processed.prof', which
+can be opened with :mod:`pstats` or a viewer such as snakeviz, together with
+a summary of the PROFILE_TOP functions that took the most time in
+'_processed.profile.txt'.
+
+Only the process of the job is profiled, so a profiled job runs the rule-based
+algorithm in that process instead of the pool of worker processes. It takes
+longer than the other jobs, but its profile shows the functions of the search.
+Phonetisaurus runs in its own processes and is shown as the time spent waiting
+for them.
+"""
+
+import io
+import pstats
+import cProfile
+
+from django.conf import settings
+
+def should_profile(job_id, requested=False):
+    """Returns whether a job is profiled: when it is requested for the upload,
+    or when it is every PROFILE_EVERY_N_JOBS-th job
+    """
+    every = settings.PROFILE_EVERY_N_JOBS
+    return bool(requested) or bool(every and job_id % every == 0)
+
+def summarize(profile, top):
+    """Returns the top functions of a profile by their own time and by their cumulative time, as text"""
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.strip_dirs()
+    for sort_key in ('tottime', 'cumulative'):
+        out.write('Top %d functions by %s\n' % (top, sort_key))
+        stats.sort_stats(sort_key).print_stats(top)
+    return out.getvalue()
+
+def run_profiled(path, func, *args, **kwargs):
+    """Runs a function under :mod:`cProfile`, and writes the profile to path + '.prof'
+    and the summary of :func:`summarize()` to path + '.profile.txt'
+
+    Returns
+    -------
+    result
+        The return value of the function. The profile is also written when it raises.
+    """
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(path + '.prof')
+        with open(path + '.profile.txt', 'w') as f:
+            f.write(summarize(profile, settings.PROFILE_TOP))
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""Contains the random access to the rows of the processed files, and their manual annotations
+
+Next to every processed file, an index with the byte offset of each of its rows
+is stored in a file with the extension '.idx', so that a page of rows can be read
+without reading the rows before it. The index records the size and the modification
+time of the processed file it belongs to, and is built again when they change.
+
+The manual annotations are first stored by row in a SQLite file next to the processed
+file (see :class:`AnnotationStore`), and from time to time written into the processed
+file itself. A download puts the waiting annotations in the rows while the file is
+streamed (see :class:`AnnotatedFile`), so it does not have to write the file first.
+"""
+
+import os
+import zlib
+import sqlite3
+import struct
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+# The header of a processed file once it contains manual annotations
+ANNOTATED_HEADER = 'Dialect Word\tFirst Estimate\tSecond Estimate\tManual Annotation\n'
+
+# The number of bytes read from a processed file at once while it is downloaded
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+# The size and the modification time of the processed file, followed by the offsets
+_INDEX_HEADER = struct.Struct('<qq')
+_OFFSET_SIZE = array('Q').itemsize
+
+# The number of times the rows are read again when the file is replaced while they are read
+_READ_ATTEMPTS = 5
+
+def parse_row(line):
+    """Splits a line of a processed file into the values shown on the words page
+
+    Returns
+    -------
+    row : list of strings
+        The values of the line as [dialect, keyword1, confidence1, keyword2, confidence2],
+        followed by the manual annotation when there is one
+    """
+    # The original processed file contains confidence scores within paranthesis
+    # For easier reading on the templating, we change the structure into
+    # [dialect, keyword1, confidence1, keyword2, confidence2]
+    line = line.strip().replace(' (', '|').replace(')', '')
+    return [ls for l in line.split('\t') for ls in l.split('|') if ls]
+
+def build_index(path):
+    """Writes the index of the processed file at the given path.
+    The first line of the file is the header, so it is not a row.
+    """
+    offsets = array('Q')
+    with open(path, 'rb') as f:
+        file_stat = os.fstat(f.fileno())
+        f.readline()
+        position = f.tell()
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    # The end of the last row
+    offsets.append(position)
+
+    # Written to a temporary file first, so that a reader never sees a half-written index
+    with _temporary_file(path + '.idx', 'wb') as f:
+        f.write(_INDEX_HEADER.pack(file_stat.st_size, file_stat.st_mtime_ns))
+        offsets.tofile(f)
+
+@contextmanager
+def _temporary_file(path, mode, **kwargs):
+    """Opens a new temporary file next to the given path, which replaces it at once when
+    it is closed. The name is unique, so that several threads can write the same file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        with open(fd, mode, **kwargs) as f:
+            yield f
+        # mkstemp() makes the file private, the replaced file keeps its permissions
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+class ResultFile:
+    """The rows of a processed file, read through its index. Behaves like a list of
+    the rows returned by :func:`parse_row()` as far as Django's :class:`Paginator`
+    needs: the number of rows is given by :meth:`count()`, and a slice reads only
+    the requested rows from the file.
+
+    Parameters
+    ----------
+    path : string
+        The path of the processed file. The index is built when it is missing
+        or does not belong to the current version of the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+
+        file_stat = os.stat(path)
+        if not self._index_matches(file_stat):
+            build_index(path)
+
+    def _index_matches(self, file_stat):
+        try:
+            with open(self.index_path, 'rb') as f:
+                header = f.read(_INDEX_HEADER.size)
+        except FileNotFoundError:
+            return False
+        return (len(header) == _INDEX_HEADER.size and
+                _INDEX_HEADER.unpack(header) == (file_stat.st_size, file_stat.st_mtime_ns))
+
+    def count(self):
+        """Returns the number of rows, from the size of the index"""
+        return (os.path.getsize(self.index_path) - _INDEX_HEADER.size) // _OFFSET_SIZE - 1
+
+    def __len__(self):
+        return self.count()
+
+    def _open(self, read_index):
+        """Opens the processed file, and returns it with what `read_index` reads from the index.
+        The file is replaced when annotations are written into it, so the index is checked
+        against the file that is open, and the rows should be read from that same file.
+        """
+        for _ in range(_READ_ATTEMPTS):
+            f = open(self.path, 'rb')
+            file_stat = os.fstat(f.fileno())
+            try:
+                with open(self.index_path, 'rb') as index:
+                    header = index.read(_INDEX_HEADER.size)
+                    if (len(header) == _INDEX_HEADER.size and
+                            _INDEX_HEADER.unpack(header) == (file_stat.st_size, file_stat.st_mtime_ns)):
+                        return f, read_index(index)
+            except FileNotFoundError:
+                pass
+            f.close()
+            build_index(self.path)
+        raise RuntimeError(self.path + ' changed while its rows were read')
+
+    @staticmethod
+    def _read_offsets(index, start, stop):
+        offsets = array('Q')
+        index.seek(_INDEX_HEADER.size + start * _OFFSET_SIZE)
+        offsets.frombytes(index.read((stop - start + 1) * _OFFSET_SIZE))
+        return offsets
+
+    def _read(self, start, stop):
+        f, offsets = self._open(lambda index: self._read_offsets(index, start, stop))
+        with f:
+            f.seek(offsets[0])
+            data = f.read(offsets[-1] - offsets[0])
+        return [data[a - offsets[0]:b - offsets[0]] for a, b in zip(offsets, offsets[1:])]
+
+    def _open_rows(self, rows):
+        """Opens the processed file, and returns it with the start and the end of each of
+        the given rows, or None for the rows that are not in the file
+        """
+        def read_spans(index):
+            spans = []
+            for row in rows:
+                offsets = self._read_offsets(index, row, row + 1)
+                spans.append(tuple(offsets) if len(offsets) == 2 else None)
+            return spans
+        return self._open(read_spans)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            rows = self[key:key + 1] if key >= 0 else self[key:key + 1 or None]
+            if not rows:
+                raise IndexError('row index out of range')
+            return rows[0]
+
+        start, stop, step = key.indices(self.count())
+        if start >= stop:
+            return []
+
+        lines = self._read(start, stop)
+        return [parse_row(line.decode('utf-8')) for line in lines[::step]]
+
+class AnnotatedFile:
+    """A processed file with the annotations of an :class:`AnnotationStore` put in its rows,
+    the same as :meth:`AnnotationStore.compact()` writes it, but without writing the file.
+    Only the annotated rows are read when it is created, so its size is known before it is
+    streamed; the rows between them are copied from the file in blocks.
+
+    Parameters
+    ----------
+    result_file : :class:`ResultFile`
+        The processed file
+
+    annotations : dictionary
+        The (dialect word, annotation) tuples by row number, see :meth:`AnnotationStore.pending()`
+    """
+    def __init__(self, result_file, annotations):
+        rows = sorted(annotations)
+        self.file, spans = result_file._open_rows(rows)
+        end_of_file = os.fstat(self.file.fileno()).st_size
+
+        # Bytes to send as they are, or (start, end) ranges of the file
+        self.pieces = [ANNOTATED_HEADER.encode('utf-8')]
+        position = len(self.file.readline())
+        for row, span in zip(rows, spans):
+            if span is None:
+                continue
+            start, end = span
+            if start > position:
+                self.pieces.append((position, start))
+            self.file.seek(start)
+            line = _annotated_line(self.file.read(end - start).decode('utf-8'), *annotations[row])
+            self.pieces.append(line.encode('utf-8'))
+            position = end
+        if end_of_file > position:
+            self.pieces.append((position, end_of_file))
+
+        self.size = sum(len(piece) if isinstance(piece, bytes) else piece[1] - piece[0]
+                        for piece in self.pieces)
+
+    def iter_bytes(self, start=0, stop=None, block_size=DOWNLOAD_BLOCK_SIZE):
+        """Yields the bytes from start up to stop (the end when not given) in blocks,
+        and closes the file at the end
+        """
+        stop = self.size if stop is None else min(stop, self.size)
+        with self.file:
+            offset = 0
+            for piece in self.pieces:
+                length = len(piece) if isinstance(piece, bytes) else piece[1] - piece[0]
+                first, last = max(start - offset, 0), min(stop - offset, length)
+                offset += length
+                if first >= last:
+                    continue
+                if isinstance(piece, bytes):
+                    yield piece[first:last]
+                    continue
+                self.file.seek(piece[0] + first)
+                remaining = last - first
+                while remaining > 0:
+                    block = self.file.read(min(block_size, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+
+def iter_file(path, start=0, stop=None, block_size=DOWNLOAD_BLOCK_SIZE):
+    """Yields the bytes of a file from start up to stop (the end when not given) in blocks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start if stop is not None else None
+        while remaining is None or remaining > 0:
+            block = f.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+
+def iter_gzip(blocks):
+    """Compresses a stream of bytes into the gzip format, block by block"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def apply_annotations(rows, start, annotations):
+    """Puts the annotations of :meth:`AnnotationStore.get()` in the rows of
+    :func:`parse_row()` that start at the given row number, as their last value
+    """
+    for i, row in enumerate(rows, start):
+        if i in annotations:
+            if len(row) == 6:
+                row[5] = annotations[i]
+            elif len(row) == 5:
+                row.append(annotations[i])
+    return rows
+
+class AnnotationStore:
+    """The manual annotations of a processed file that are not written into the file yet,
+    stored by row number in a SQLite file next to it. Saving a page only writes the
+    annotations of that page, in a single transaction, so annotators that save different
+    pages at the same time do not overwrite each other's work.
+
+    The SQLite file is only created by the first :meth:`save()`, so that reading
+    and downloading a file that was never annotated leaves the folder as it is.
+
+    Parameters
+    ----------
+    path : string
+        The path of the processed file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db_path = path + '.annotations.sqlite3'
+
+    def exists(self):
+        """Returns whether annotations were ever saved for the file"""
+        # The file is empty until the transaction that creates the table is committed
+        return os.path.isfile(self.db_path) and os.path.getsize(self.db_path) > 0
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def save(self, annotations):
+        """Stores the annotations, given as a dictionary of (dialect word, annotation)
+        tuples by row number, replacing the earlier annotations of the same rows
+
+        Returns
+        -------
+        pending : integer
+            The number of annotations that are not written into the processed file yet
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('''CREATE TABLE IF NOT EXISTS annotations (
+                              row INTEGER PRIMARY KEY,
+                              word TEXT NOT NULL,
+                              annotation TEXT NOT NULL)''')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('saves', 0)")
+            db.execute("UPDATE meta SET value = value + 1 WHERE name = 'saves'")
+            db.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?)',
+                           [(row, word, annotation) for row, (word, annotation) in annotations.items()])
+            pending = db.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+            db.execute('COMMIT')
+        return pending
+
+    def pending(self):
+        """Returns the number of saves so far, which changes with every save, and the
+        annotations that are not written into the processed file yet, as a dictionary
+        of (dialect word, annotation) tuples by row number. Both are read at once.
+        """
+        if not self.exists():
+            return 0, {}
+        with self._connect() as db:
+            db.execute('BEGIN')
+            saves = db.execute("SELECT value FROM meta WHERE name = 'saves'").fetchone()
+            annotations = {row: (word, annotation) for row, word, annotation
+                           in db.execute('SELECT row, word, annotation FROM annotations')}
+            db.execute('COMMIT')
+        return saves[0] if saves is not None else 0, annotations
+
+    def get(self, start, stop):
+        """Returns the annotations of the rows from start up to stop, by row number"""
+        if not self.exists():
+            return {}
+        with self._connect() as db:
+            return dict(db.execute('SELECT row, annotation FROM annotations WHERE row >= ? AND row < ?',
+                                   (start, stop)))
+
+    def compact(self):
+        """Writes the stored annotations into the processed file and removes them from the store.
+        The file is replaced at once, and saves wait until it is done.
+
+        Returns
+        -------
+        written : integer
+            The number of annotations written into the file
+        """
+        if not self.exists():
+            return 0
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                annotations = {row: (word, annotation) for row, word, annotation
+                               in db.execute('SELECT row, word, annotation FROM annotations')}
+                if annotations:
+                    self._write(annotations)
+                    db.execute('DELETE FROM annotations')
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        return len(annotations)
+
+    def _write(self, annotations):
+        with open(self.path, 'r', encoding='utf-8') as f, _temporary_file(self.path, 'w', encoding='utf-8') as out:
+            f.readline()
+            out.write(ANNOTATED_HEADER)
+            for i, line in enumerate(f):
+                if i in annotations:
+                    line = _annotated_line(line, *annotations[i])
+                out.write(line)
+
+def _annotated_line(line, word, annotation):
+    # The row becomes "dialect word, first estimate, second estimate, annotation",
+    # the same layout as the rows that were saved before, when it is still the same word
+    fields = line.rstrip('\n').split('\t')
+    if fields[0] != word:
+        return line
+    return '\t'.join(fields[:3] + [annotation, '']) + '\n'
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Contains the index of canonical keys that resolves dialect words without the rule search
+
+The rules of :data:`rules.MODIFIERS` rewrite a dialect word until it is one of the
+'modified' versions of the vocabulary. The index turns this around: the inverse of
+every rule is applied to every 'modified' version, and the strings that the rule
+rewrites back into that version are its canonical keys. A dialect word that is
+one of the keys is resolved with a lookup, and only the other words need
+:func:`text_processing.alternate_dialect()`.
+
+A key is only kept when the forward rule gives the 'modified' version back, and
+when it does not belong to more than one 'modified' version. Keys that are
+themselves in the vocabulary are left out, as the search answers them at once.
+The index is built by ``python manage.py build_rule_index`` and stored in a
+SQLite file, so that the worker processes do not need to hold it in memory.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of parameters of a single statement
+_BATCH_SIZE = 500
+
+def inverse_rules(modifiers):
+    """Returns the (replacement, rule key) pairs of all the rules, one list per section"""
+    return [[(to, fr) for fr, to_list in section.items() for to in to_list] for section in modifiers]
+
+def canonical_keys(modified, inverse, depth=1):
+    """Yields the strings that the rules rewrite into the given 'modified' version
+    in at most `depth` steps, each of them once
+
+    Parameters
+    ----------
+    inverse : list of lists of tuples
+        The inverse rules, see :func:`inverse_rules()`
+
+    depth : integer, (default=1)
+        The number of rules applied after each other. Every step multiplies
+        the number of keys by about forty.
+    """
+    found = {modified}
+    frontier = [modified]
+    for _ in range(depth):
+        next_frontier = []
+        # The sections are applied in the reverse order of the search
+        for word in frontier:
+            for section in reversed(inverse):
+                for to, fr in section:
+                    if to in word:
+                        key = word.replace(to, fr)
+                        # The rule must rewrite the key into the same string again
+                        if key not in found and key.replace(fr, to) == word:
+                            found.add(key)
+                            next_frontier.append(key)
+                            yield key
+        frontier = next_frontier
+
+def index_version(vocabulary_version, modifiers, depth):
+    """Returns a hash of what the index is built from"""
+    return hashlib.sha1(json.dumps([vocabulary_version, modifiers, depth],
+                                   ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def build_rule_index(vocabulary_index, modifiers, path, depth=1):
+    """Writes the index of the canonical keys of a vocabulary to a SQLite file
+
+    Parameters
+    ----------
+    vocabulary_index : :class:`vocabulary.VocabularyIndex`
+        The vocabulary whose 'modified' versions are the targets of the keys
+
+    modifiers : list of dictionaries
+        The rule set, usually :data:`rules.MODIFIERS`
+
+    Returns
+    -------
+    report : dictionary
+        See :meth:`RuleIndex.report()`
+    """
+    inverse = inverse_rules(modifiers)
+    forms = vocabulary_index.positions
+
+    # Written to a temporary file first, so that the workers never see a half-built index
+    temp_path = path + '.' + str(os.getpid())
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('CREATE TEMP TABLE pairs (key TEXT NOT NULL, modified TEXT NOT NULL)')
+        db.execute('BEGIN')
+        for modified in forms:
+            db.executemany('INSERT INTO pairs VALUES (?, ?)',
+                           ((key, modified) for key in canonical_keys(modified, inverse, depth)
+                            if key not in forms))
+        db.execute('COMMIT')
+
+        db.execute('CREATE TABLE keys (key TEXT PRIMARY KEY, modified TEXT NOT NULL) WITHOUT ROWID')
+        db.execute('''INSERT INTO keys SELECT key, MIN(modified) FROM pairs
+                      GROUP BY key HAVING COUNT(DISTINCT modified) = 1''')
+        ambiguous = db.execute('''SELECT COUNT(*) FROM (SELECT key FROM pairs GROUP BY key
+                                  HAVING COUNT(DISTINCT modified) > 1)''').fetchone()[0]
+        db.execute('DROP TABLE pairs')
+
+        db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('version', index_version(vocabulary_index.version, modifiers, depth)),
+            ('depth', str(depth)),
+            ('forms', str(len(forms))),
+            ('ambiguous', str(ambiguous)),
+        ])
+        db.execute('VACUUM')
+    finally:
+        db.close()
+    os.replace(temp_path, path)
+
+    return RuleIndex(path).report()
+
+class RuleIndex:
+    """The canonical keys written by :func:`build_rule_index()`
+
+    Parameters
+    ----------
+    path : string
+        The path of the SQLite file
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            self.meta = dict(db.execute('SELECT name, value FROM meta'))
+        self.version = self.meta['version']
+        self.depth = int(self.meta['depth'])
+
+    @contextmanager
+    def _connect(self):
+        # Every call opens its own connection, so the index can be used after a fork
+        db = sqlite3.connect('file:' + self.path + '?mode=ro', uri=True, timeout=30)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def lookup_many(self, words):
+        """Returns the 'modified' version of the vocabulary that each of the given words
+        is a canonical key of, for the words that are in the index
+        """
+        words = list(set(words))
+        found = {}
+        with self._connect() as db:
+            for start in range(0, len(words), _BATCH_SIZE):
+                batch = words[start:start + _BATCH_SIZE]
+                found.update(db.execute('SELECT key, modified FROM keys WHERE key IN (' +
+                                        ','.join('?' * len(batch)) + ')', batch))
+        return found
+
+    def report(self):
+        """Returns the size and the coverage of the index: the number of 'keys', the number
+        of 'ambiguous' keys that were left out, the number of vocabulary 'forms' and how many
+        of them have at least one key ('covered'), the 'depth' and the size of the file in 'bytes'
+        """
+        with self._connect() as db:
+            keys = db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+            covered = db.execute('SELECT COUNT(DISTINCT modified) FROM keys').fetchone()[0]
+        return {'keys': keys, 'ambiguous': int(self.meta['ambiguous']), 'forms': int(self.meta['forms']),
+                'covered': covered, 'depth': self.depth, 'bytes': os.path.getsize(self.path)}
+
+def agreement(rule_index, words, vocabulary_index, modifiers):
+    """Compares the predictions of the index with those of the rule search on the given
+    dialect words, which should be cleaned with :func:`text_processing.clean_str_word()`
+
+    Returns
+    -------
+    agreement : dictionary
+        The number of distinct 'words', of 'hits' in the index and how many of them have
+        the same prediction as the search ('agree'). 'exact' is the number of words whose
+        search ends at a 'modified' version of the vocabulary after the rules changed them,
+        and 'missed' how many of those are not in the index. 'index_seconds' and
+        'search_seconds' are the time both took for the hits, and 'disagreements' lists
+        up to ten words with both predictions.
+    """
+    # Imported here, as text_processing uses the index itself
+    from text_processing import process_single_word, _resolve_word
+
+    words = list(dict.fromkeys(words))
+    start = time.perf_counter()
+    resolved = rule_index.lookup_many(words)
+    kwargs = {'vocabulary': vocabulary_index, 'modifiers': modifiers}
+    predictions = {word: _resolve_word(word, modified, kwargs)[0] for word, modified in resolved.items()}
+    index_seconds = time.perf_counter() - start
+
+    result = {'words': len(words), 'hits': len(resolved), 'agree': 0, 'exact': 0, 'missed': 0,
+              'index_seconds': index_seconds, 'search_seconds': 0.0, 'disagreements': []}
+    for word in words:
+        stats = {}
+        start = time.perf_counter()
+        keywords = process_single_word(word, stats=stats, **kwargs)
+        seconds = time.perf_counter() - start
+        # A score of 5 is a distance of 0, and the word itself was not in the vocabulary
+        exact = bool(stats['expanded'] and keywords and keywords[0]['score'] == 5)
+        result['exact'] += exact
+        if word in resolved:
+            result['search_seconds'] += seconds
+            if keywords == predictions[word]:
+                result['agree'] += 1
+            elif len(result['disagreements']) < 10:
+                result['disagreements'].append({'word': word, 'index': predictions[word], 'search': keywords})
+        elif exact:
+            result['missed'] += 1
+    return result
+
+def get_rule_index(vocabulary_index, modifiers):
+    """Returns the rule index of the project stored at RULE_INDEX_PATH, or None when it
+    is turned off, not built, or built from another vocabulary or other rules
+    """
+    if not settings.RULE_INDEX_PATH or not os.path.isfile(settings.RULE_INDEX_PATH):
+        return None
+    index = RuleIndex(settings.RULE_INDEX_PATH)
+    if index.version != index_version(vocabulary_index.version, modifiers, index.depth):
+        logger.warning('%s does not match the vocabulary and the rules, run build_rule_index again',
+                       settings.RULE_INDEX_PATH)
+        return None
+    return index
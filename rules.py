@@ -1,14 +1,64 @@
 # -*- coding: utf-8 -*-
 """Contains the rules that are used to modify the dialect words to create alternatives"""
 
+import re
+import os
 import json
+import logging
+import threading
 from django.core.files.storage import FileSystemStorage
 
+from vocabulary import BinaryVocabulary, CompactVocabulary
+
+logger = logging.getLogger(__name__)
+
 fs = FileSystemStorage()
 
-# Loads the list of known "dictionary" versions of the words
-with open(fs.path('vocabulary.json'), 'r') as jf:
-    VOCABULARY = json.load(jf)
+# The list of known "dictionary" versions of the words, and its binary version
+# that is built with 'python manage.py build_vocabulary' and loaded much faster
+VOCABULARY_PATH = fs.path('vocabulary.json')
+VOCABULARY_BINARY_PATH = fs.path('vocabulary.bin')
+
+def load_vocabulary():
+    """Loads the vocabulary from the binary file when it is built and up to date,
+    otherwise from the JSON file. The binary file is copied into the compact vocabulary,
+    so its memory map is not kept.
+
+    Returns
+    -------
+    vocabulary : :class:`vocabulary.CompactVocabulary`
+    """
+    if os.path.isfile(VOCABULARY_BINARY_PATH):
+        try:
+            binary = BinaryVocabulary(VOCABULARY_BINARY_PATH)
+        except ValueError as e:
+            logger.warning('Binary vocabulary is not used: %s', e)
+        else:
+            if not os.path.isfile(VOCABULARY_PATH) or not binary.is_outdated(VOCABULARY_PATH):
+                return CompactVocabulary.from_binary(binary)
+            logger.warning('Binary vocabulary is older than %s, run "python manage.py build_vocabulary"',
+                           VOCABULARY_PATH)
+
+    with open(VOCABULARY_PATH, 'r') as jf:
+        return CompactVocabulary.from_entries(json.load(jf))
+
+_vocabulary = None
+_vocabulary_lock = threading.Lock()
+
+def get_vocabulary():
+    """Returns the vocabulary, loading it on the first call"""
+    global _vocabulary
+    with _vocabulary_lock:
+        if _vocabulary is None:
+            _vocabulary = load_vocabulary()
+        return _vocabulary
+
+def __getattr__(name):
+    # VOCABULARY is loaded on its first use, so that importing the rules
+    # does not cost the time and memory of the vocabulary
+    if name == 'VOCABULARY':
+        return get_vocabulary()
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
 
 # Contains the subword strings and their possible alternative versions
 # Currently consists of 3 categories: 3 and more letters, 2 letters, 1 letters
@@ -84,3 +134,95 @@ MODIFIERS = [
         'ů': ['ui', 'o', 'u'],
     }
 ]
+
+class RuleMatcher:
+    """A section of the modifiers compiled into regular expressions that find
+    every occurrence of every rule key in a single pass over a string.
+
+    Each pattern is a lookahead, so overlapping occurrences are found as well.
+    The keys are split into layers in which no key is a prefix of another,
+    which guarantees that at most one key of a layer matches at each position.
+    For the current rule sets this is always a single layer.
+
+    Parameters
+    ----------
+    section : dictionary
+        One of the sections of :data:`MODIFIERS`
+    """
+    def __init__(self, section):
+        self.section = section
+
+        layers = []
+        for key in sorted(section, key=len, reverse=True):
+            for layer in layers:
+                if not any(other.startswith(key) for other in layer):
+                    layer.append(key)
+                    break
+            else:
+                layers.append([key])
+
+        # The position of each key in the section, to keep the order of the rules
+        self.order = {key: i for i, key in enumerate(section)}
+
+        self.patterns = [re.compile('(?=(' + '|'.join(re.escape(key) for key in layer) + '))')
+                         for layer in layers]
+
+    def keys(self, word):
+        """Returns the rule keys that occur in the given word, in the order of the section"""
+        found = [key for pattern in self.patterns for key in pattern.findall(word)]
+        if len(found) > 1:
+            found = sorted(set(found), key=self.order.__getitem__)
+        return found
+
+    def matches(self, word):
+        """Returns the start positions of all occurrences of the rule keys in the given word
+
+        Returns
+        -------
+        matches : dictionary
+            The keys that occur in the word and the list of their positions,
+            in the order of the section.
+        """
+        found = {}
+        for pattern in self.patterns:
+            for match in pattern.finditer(word):
+                found.setdefault(match.group(1), []).append(match.start())
+
+        if len(self.patterns) > 1:
+            for positions in found.values():
+                positions.sort()
+        return {key: found[key] for key in sorted(found, key=self.order.__getitem__)}
+
+    def alternations(self, word, per_occurrence=False):
+        """Creates the alternatives of a word by applying the rules of the section
+
+        Parameters
+        ----------
+        word : string
+            Give the word that needs to be modified
+
+        per_occurrence : bool, (default=False)
+            When given False, every rule replaces all (non-overlapping) occurrences
+            of its key at once, the same as :meth:`str.replace()`. When given True,
+            each occurrence of a key is replaced on its own.
+
+        Returns
+        -------
+        alternations : list of strings
+            The alternatives, ordered by the rule keys as in the section, and then by
+            the replacement strings as in the rule.
+        """
+        if not per_occurrence:
+            # Once the keys are known, the replacement itself is left to str.replace()
+            return [word.replace(key, to) for key in self.keys(word) for to in self.section[key]]
+
+        alternations = []
+        for key, positions in self.matches(word).items():
+            size = len(key)
+            for to in self.section[key]:
+                alternations.extend(word[:p] + to + word[p + size:] for p in positions)
+
+        return alternations
+
+# The modifiers compiled once, to be used by :func:`text_processing.alternate_dialect()`
+COMPILED_MODIFIERS = [RuleMatcher(section) for section in MODIFIERS]
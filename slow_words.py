@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Contains the report of the words that take long to predict
+
+Every word of a job is searched with a trace of the strings it expanded (see
+the trace of :func:`text_processing.alternate_dialect()`) and timed. The trace
+of a word that takes more than SLOW_WORD_SECONDS is kept and logged in a
+compact form. The traces of all slow words of a job are added up by rule,
+so that the rules of :data:`rules.MODIFIERS` that cause the largest searches
+can be found. The report is written next to the processed file with the
+extension '_processed.slow_words.json'.
+"""
+
+from collections import Counter
+
+def format_trace(trace, limit=20):
+    """Writes a trace in a compact form: a line for each expanded string with its step,
+    its distance, the number of alternatives tried, and the alternatives that were kept
+    as 'key>replacement=alternative(distance)'
+
+    Parameters
+    ----------
+    limit : integer, (default=20)
+        The number of expanded strings that are written, None for all of them
+    """
+    lines = []
+    for step, dialect, distance, alternatives in trace[:limit]:
+        kept = ' '.join('%s>%s=%s(%d)' % (fr, to, alternative, alt_distance)
+                        for fr, to, alternative, alt_distance, is_kept in alternatives if is_kept)
+        lines.append('%d %s(%d) %d tried%s' % (step, dialect, distance, len(alternatives),
+                                               ': ' + kept if kept else ''))
+    if limit is not None and len(trace) > limit:
+        lines.append('... %d more strings expanded' % (len(trace) - limit))
+    return '\n'.join(lines)
+
+def rule_counts(trace):
+    """Returns the number of alternatives each rule created and kept in a trace
+
+    Returns
+    -------
+    tried, kept : :class:`collections.Counter`
+        The numbers by (step, rule key)
+    """
+    tried = Counter()
+    kept = Counter()
+    for step, _, _, alternatives in trace:
+        for fr, _, _, _, is_kept in alternatives:
+            tried[step, fr] += 1
+            kept[step, fr] += is_kept
+    return tried, kept
+
+class SlowWordReport:
+    """Collects the slow words of a job and the rules that made their searches large"""
+    def __init__(self):
+        self.words = []
+        self.tried = Counter()
+        self.kept = Counter()
+        # The number of slow words each rule was used for
+        self.used = Counter()
+
+    def add(self, dialect_word, seconds, stats, trace):
+        """Adds a slow word with its time, the statistics and the trace of its search"""
+        tried, kept = rule_counts(trace)
+        self.tried.update(tried)
+        self.kept.update(kept)
+        self.used.update(tried.keys())
+        self.words.append({'word': dialect_word, 'seconds': seconds, 'expanded': stats['expanded'],
+                           'scored': stats['scored'], 'step': stats['step'],
+                           'truncated': stats['truncated'], 'trace': format_trace(trace)})
+
+    def worst_rules(self, top=20):
+        """Returns the rules that created the most alternatives in the slow words, with
+        their 'section', the rule 'key', the number of alternatives 'tried' and 'kept',
+        and the number of 'words' they were used for
+        """
+        return [{'section': step, 'key': fr, 'tried': tried, 'kept': self.kept[step, fr],
+                 'words': self.used[step, fr]}
+                for (step, fr), tried in self.tried.most_common(top)]
+
+    def summary(self, top=20):
+        """Returns the report as a dictionary that can be stored as JSON, slowest words first"""
+        return {'words': sorted(self.words, key=lambda word: word['seconds'], reverse=True),
+                'worst_rules': self.worst_rules(top)}
@@ -12,8 +12,13 @@
 
   // Function called on load to color the boxes of the words
   $('td.estimate').each(function () {
-    // Set the backgound colors of the predicted keywords based on their confidences
-    $(this).css('background-color', colors[$(this).data('confidence')]);
+    // Set the backgound colors of the predicted keywords based on their confidences.
+    // An asterisk marks a keyword whose search was stopped early.
+    var confidence = String($(this).data('confidence'));
+    $(this).css('background-color', colors[confidence.replace('*', '')]);
+    if (confidence.indexOf('*') >= 0) {
+      $(this).addClass('truncated').attr('title', 'The search for this keyword was stopped early');
+    }
   });
 
   // Function that is triggered when the box of a keyword is clicked
@@ -2,19 +2,80 @@
 
 import re
 import os
+import time
+import json
+import heapq
+import hashlib
+import tempfile
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import Levenshtein as lev
-from subprocess import Popen, PIPE
 
 from django.core.files import File
 from django.core.mail import send_mail
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
 
-from rules import MODIFIERS, VOCABULARY
+import g2p
+from rules import MODIFIERS, COMPILED_MODIFIERS, RuleMatcher, get_vocabulary
+from prediction_cache import get_cache
+from results import build_index
+from metrics import Metrics
+from slow_words import SlowWordReport, format_trace
+from rule_index import get_rule_index
+from vocabulary import VocabularyIndex, CompactVocabulary, ClosestCache
+
+logger = logging.getLogger(__name__)
+
+# The index answers the same queries as a scan over the vocabulary,
+# but without comparing the dialect word to every entry.
+# Built on the first use, see :func:`get_vocabulary_index()`.
+_vocabulary_index = None
+_vocabulary_index_lock = threading.Lock()
+
+def get_vocabulary_index():
+    """Returns the index over :data:`rules.VOCABULARY`, loading the vocabulary on the first call"""
+    global _vocabulary_index
+    with _vocabulary_index_lock:
+        if _vocabulary_index is None:
+            _vocabulary_index = VocabularyIndex(get_vocabulary())
+        return _vocabulary_index
+
+def __getattr__(name):
+    if name == 'VOCABULARY_INDEX':
+        return get_vocabulary_index()
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+# The same alternated strings come back for many words, so the lookups are cached
+CLOSEST_CACHE = ClosestCache(settings.CLOSEST_CACHE_SIZE)
+
+# The characters that make compound letters, removed first
+_COMBINING_CHARS = str.maketrans('', '', '\u0300\u0302\u0303\u0304\u0306\u0308\u030c')
+# HTML tags (<u>, <i>, <b>)
+_HTML_TAG = re.compile(r'<.*?>')
+# Some chars at the beginning, such as 't and 'n
+_LEADING_ARTICLE = re.compile(r'^[’|`|\'|ʼ]*[t|n|s]\s')
+_LEADING_ARTICLE_START = set('’`\'ʼ|tns')
+# Some chars at the end, such as , 't and , 'n
+_TRAILING_ARTICLE = re.compile(r',\s[’|`|\'|ʼ][t|n|s]$')
+# - and ‑ in paranthesis, at the beginning or at the end
+_DASHES = re.compile(r'^[-|‑]|\([-|‑]\)|[-|‑]$')
+# Punctuation and digits
+_PUNCTUATION = str.maketrans('', '', '*!?,`’‘\'ʼ/()0123456789')
+# -, ‑, – and ., removed together with the white space in the hard mode
+_HARD_CHARS = str.maketrans('', '', '-‑–.')
 
 def clean_str_word(word, split=False, hard=True):
     """Cleans a given word to prepare it for the further calculations
 
+    The character removals are done with translation tables, and the patterns are
+    compiled once and only run when the characters they need are in the word.
+
     Parameters
     ----------
     word : string
@@ -33,26 +94,33 @@ def clean_str_word(word, split=False, hard=True):
         Returns the modified versio of the word
     """
     # Clean from chars that makes compound letters
-    for comp_chr in ['\u0300', '\u0302', '\u0303', '\u0304', '\u0306', '\u0308', '\u030c']:
-        word = word.replace(comp_chr, '')
+    word = word.translate(_COMBINING_CHARS)
 
     # Clean html tags (<u>, <i>, <b>)
-    word = re.sub(r'<.*?>', '', word).strip()
+    if '<' in word:
+        word = _HTML_TAG.sub('', word)
+    word = word.strip()
 
     # Clean some of chars if they start with
-    word = re.sub(r'^[’|`|\'|ʼ]*[t|n|s]\s', '', word).strip()
+    if word[:1] in _LEADING_ARTICLE_START:
+        match = _LEADING_ARTICLE.match(word)
+        if match:
+            word = word[match.end():].strip()
 
     # Clean some of chars if they end with
-    word = re.sub(r',\s[’|`|\'|ʼ][t|n|s]$', '', word).strip()
+    if ',' in word:
+        word = _TRAILING_ARTICLE.sub('', word).strip()
 
     # Clean em/zich at the end
-    word = re.sub(r'em/zich$', '', word).strip()
+    if word.endswith('em/zich'):
+        word = word[:-len('em/zich')].strip()
 
     # Remove - and - in paranthesis, at the beginning or at the end
-    word = re.sub(r'^[-|‑]|\([-|‑]\)|[-|‑]$', '', word).strip()
+    if '-' in word or '‑' in word or '|' in word:
+        word = _DASHES.sub('', word).strip()
 
     # Clean some chars
-    word = re.sub(r'\*|!|\?|,|`|’|‘|\'|ʼ|/|\(|\)|[0-9]', '', word).strip()
+    word = word.translate(_PUNCTUATION).strip()
 
     if split and ' - ' in word:
         # Split dialectopgave and choose the first one, if two alternatives given
@@ -60,10 +128,25 @@ def clean_str_word(word, split=False, hard=True):
 
     if hard:
         # Remove -, -, –, ., and \s
-        word = re.sub(r'-|‑|–|\.|\s', '', word).strip()
+        word = ''.join(word.translate(_HARD_CHARS).split())
 
     return word
 
+def clean_many(words, split=False, hard=True):
+    """Cleans a batch of words with :func:`clean_str_word()`. Words that occur
+    more than once are only cleaned once.
+
+    Returns
+    -------
+    words : list of strings
+        The cleaned words, in the same order
+    """
+    cleaned = {}
+    for word in words:
+        if word not in cleaned:
+            cleaned[word] = clean_str_word(word, split, hard)
+    return [cleaned[word] for word in words]
+
 def get_closest(dialect_word, vocabulary, distance_limit=1):
     """Calculates and returns the most similar keyword from the vocabulary
        for a given dialect word
@@ -73,11 +156,13 @@ def get_closest(dialect_word, vocabulary, distance_limit=1):
     dialect_word : string
         Give the dialect word that needs to be checked agains the vocabulary
 
-    vocabulary : list of dictionaries
+    vocabulary : list of dictionaries, :class:`vocabulary.CompactVocabulary` or :class:`vocabulary.VocabularyIndex`
         Give the list of known "dictionary" versions of the words.
         The vocabulary should contain both 'modified' and the original 'trefwoord'
         versions under the keys named the same. The 'modified' versions should
         be created with :func:`clean_str_word()` function.
+        If an index is given, the search is delegated to the index instead of
+        scanning the entire list, and the results are cached in :data:`CLOSEST_CACHE`.
 
     distance_limit : integer, (default=1)
         When given, limits the number of keyword predictions should be returned
@@ -91,6 +176,30 @@ def get_closest(dialect_word, vocabulary, distance_limit=1):
     min_distance : integer
         The minimum distance calculated when dialect word is compared to the vocabulary
     """
+    if isinstance(vocabulary, VocabularyIndex):
+        key = CLOSEST_CACHE.key(vocabulary, dialect_word, distance_limit)
+        result = CLOSEST_CACHE.get(key)
+        if result is None:
+            result = vocabulary.closest(dialect_word, distance_limit)
+            CLOSEST_CACHE.put(key, result)
+        return result
+
+    if isinstance(vocabulary, CompactVocabulary):
+        # The distances are calculated over the column of 'modified' versions,
+        # so that dictionaries are only created for the entries that are kept
+        distances = list(map(partial(lev.distance, dialect_word), vocabulary.modified))
+        limit_to = sorted(set(distances))[:distance_limit] if distance_limit else None
+        vocab_ = [{'modified': vocabulary.modified[i],
+                   'trefwoord': vocabulary.trefwoord_at(i),
+                   'distance': distance}
+                  for i, distance in enumerate(distances)
+                  if limit_to is None or distance in limit_to]
+
+        vocab_ = list({c['trefwoord']: c for c in vocab_}.values())
+        vocab_ = sorted(vocab_, key=lambda k: k['distance'])
+
+        return vocab_, min({c['distance'] for c in vocab_})
+
     # Following line is proven faster than running the usual deepcopy() function
     # If this is not done, the added values are kept in the memory
     vocab_ = [{'modified': w['modified'],
@@ -113,113 +222,218 @@ def get_closest(dialect_word, vocabulary, distance_limit=1):
 
     return vocab_, min({c['distance'] for c in vocab_})
 
-def alternate_dialect(dialect_word, combinations, vocabulary, modifiers, step=0, min_distance=None):
-    """Recursively creates alternatives to the dialect word by manipulating it based on the rules
+def get_closest_many(dialect_words, vocabulary, distance_limit=1):
+    """Calculates the most similar keywords from the vocabulary for a batch
+       of dialect words at once
+
+    Parameters
+    ----------
+    dialect_words : list of strings
+        Give the dialect words that needs to be checked agains the vocabulary
+
+    vocabulary : list of dictionaries or :class:`vocabulary.VocabularyIndex`
+        The same as in :func:`get_closest()`. If an index is given, the whole batch
+        is scored together with :meth:`vocabulary.VocabularyIndex.closest_many()`,
+        apart from the dialect words that are found in :data:`CLOSEST_CACHE`.
+
+    distance_limit : integer, (default=1)
+        The same as in :func:`get_closest()`.
+
+    Returns
+    -------
+    results : list of tuples
+        The output of :func:`get_closest()` for each of the given dialect words,
+        in the same order.
+    """
+    if isinstance(vocabulary, VocabularyIndex):
+        results = {}
+        for dw in dialect_words:
+            if dw not in results:
+                results[dw] = CLOSEST_CACHE.get(CLOSEST_CACHE.key(vocabulary, dw, distance_limit))
+
+        # Only the dialect words that are not cached yet are scored
+        missing = [dw for dw, result in results.items() if result is None]
+        for dw, result in zip(missing, vocabulary.closest_many(missing, distance_limit)):
+            CLOSEST_CACHE.put(CLOSEST_CACHE.key(vocabulary, dw, distance_limit), result)
+            results[dw] = result
+
+        return [results[dw] for dw in dialect_words]
+
+    return [get_closest(dw, vocabulary, distance_limit) for dw in dialect_words]
+
+def alternate_dialect(dialect_word, combinations, vocabulary, modifiers, step=0, min_distance=None,
+                      max_expansions=None, max_seconds=None, stats=None, trace=None):
+    """Creates alternatives to the dialect word by manipulating it based on the rules
     until it creates a dictionary version or exhausts the options.
 
+    The rule sections are searched one after the other with an explicit queue.
+    An alternative is only kept when it is closer to the vocabulary than the string
+    it is created from, and a string is only expanded when it is not further away
+    than the minimum distance found so far. Every string is expanded once per section.
+
     Parameters
     ----------
     dialect_word : string
         Give the dialect word that needs to be modified
 
     combinations : list of dictionaries
-        Contains the candidate results. The variable modified during the recursion.
+        Contains the candidate results to start the search with. Usually empty.
 
-    vocabulary : list of dictionaries
+    vocabulary : list of dictionaries or :class:`vocabulary.VocabularyIndex`
         List of known "dictionary" versions of the words.
         The vocabulary should contain both 'modified' and the original 'trefwoord'
         versions under the keys named the same. The 'modified' versions should
         be created with :func:`clean_str_word()` function.
 
-    modifiers : list of dictionaries
+    modifiers : list of dictionaries or list of :class:`rules.RuleMatcher`
         The rule set that contains which modifications should be performed.
-        Example can be found in rules.py file.
+        Example can be found in rules.py file. The compiled version of the rules,
+        :data:`rules.COMPILED_MODIFIERS`, gives the same results faster.
 
     step : integer, (default=0)
-        The parameter set for the recursion. Inicates which of the sections in the
-        rule set is up next for the processing
+        Inicates which of the sections in the rule set the search starts with.
 
     min_distance : integer, (default=None)
-        The parameter set for the recursion. Contains the minimum found edit distance
-        from the comparisons to the vocabulary.
+        The minimum edit distance to start the search with. When not given,
+        the distance of the dialect word itself is used.
+
+    max_expansions : integer, (default=None)
+        When given, limits the number of strings that are expanded with the rules.
+        When the limit is reached, the best candidates found so far are returned.
+
+    max_seconds : float, (default=None)
+        When given, limits the time of the search in the same way as `max_expansions`.
+        The vocabulary lookup of the dialect word itself is always done, so there is
+        at least one candidate.
+
+    stats : dictionary, (default=None)
+        When given, it is filled with the number of 'expanded' strings, the number
+        of 'scored' strings, the last 'step' that is reached, whether the search
+        is 'truncated' by `max_expansions` or `max_seconds`, and whether that was
+        because it 'timed_out'. 'tried' and 'accepted' contain, for each
+        section of the rules, the number of alternatives that are created and the
+        number of them that are kept.
+
+    trace : list, (default=None)
+        When given, a (step, string, distance, alternatives) tuple is appended for every
+        expanded string, where the alternatives are (rule key, replacement, alternative,
+        distance, kept) tuples. See :func:`slow_words.format_trace()`.
 
     Returns
     -------
     combinations : list of dictionaries
         Contains the closest detected dictionary versions after the modifications.
     """
+    if stats is None:
+        stats = {}
+    stats.update({'expanded': 0, 'scored': 1, 'step': step, 'truncated': False, 'timed_out': False,
+                  'tried': [0] * len(modifiers), 'accepted': [0] * len(modifiers)})
+    deadline = time.perf_counter() + max_seconds if max_seconds is not None else None
+
     input_ = {'dialect': dialect_word}
     # Find the closest dictionary keyword to the given dialect word
     input_['estimates'], input_['distance'] = get_closest(input_['dialect'], vocabulary)
-    # The comparison of the given dialect to the vocabualry is already a result;
-    combinations.append(input_)
 
     # If the minimum distance is not given, take the minimum distance of the given dialect word
     if not min_distance:
         min_distance = input_['distance']
 
-    for comb in combinations:
-
-        dialect = comb['dialect']
-        curr_dist = comb['distance']
-
-        if curr_dist > min_distance:
-            continue
-
-        # Modifiers have different sections.
-        # `step` variable here decides which set's turn it is currently.
-        # `fr` variable here is the string candidate to be modified
-        # `to_list` contains strings that the candidate will be modified into
-        for fr, to_list in modifiers[step].items():
-
-            # If the candidate string exists in the dialect word
-            if fr in dialect:
-
-                for to in to_list:
-
-                    # Modify the dialect to create the alternative
-                    alternated_word = re.sub(fr, to, dialect).strip()
-                    # Find the closest dictionary keyword to the alternated version
-                    estimates, alt_dist = get_closest(alternated_word, vocabulary)
-
-                    # If the minimum possible distance of the alternated is smaller than
-                    # the minimum calculated distance of the given dialect word
-                    if alt_dist < curr_dist:
-
-                        # Add the new alternated word to the list of combinations.
-                        # Append adds the value to the end of the list.
-                        # This newly added item will also be alternated
-                        # in next steps in the same loop.
-                        combinations.append({
-                            'dialect': alternated_word,
-                            'estimates': estimates,
-                            'distance': alt_dist
-                        })
-
-                        # Check if the newly calculated distance is the minimum so far.
-                        # If so, update the global minimum distance
-                        if alt_dist < min_distance:
-                            min_distance = alt_dist
-
-    # Only leave the combinations with minimum distance calculated so far
-    combinations = [c for c in combinations if c['distance'] == min_distance]
-    # Duplicate elimination is needed since modifications may create the same alternatives
-    combinations = list({c['dialect']: c for c in combinations}.values())
-    # Sorted based on the distance
-    combinations = sorted(combinations, key=lambda k: k['distance'])
-
-    # If any of the alternatives reached to a dictionary version (min_distance==0),
-    # stop the recursion and return. Otherwise, call the function one more time.
-    # WARNING: Althouth ending the function here speeds up the processing,
-    #          the downside is we cannot control whether it is the correct result.
-    if min_distance > 0:
+    while True:
+        stats['step'] = step
+
+        # The comparison of the given dialect to the vocabualry is already a result.
+        # `visited` keeps the strings of this section in the order they are found.
+        visited = {}
+        for comb in combinations + [input_]:
+            visited.setdefault(comb['dialect'], comb)
+        queue = deque(visited.values())
+
+        while queue and not stats['truncated']:
+            comb = queue.popleft()
+
+            dialect = comb['dialect']
+            curr_dist = comb['distance']
+
+            # Alternatives must be closer than the string they are created from,
+            # so there is nothing to gain from strings that are already too far away
+            # or that are a dictionary version already
+            if curr_dist > min_distance or curr_dist == 0:
+                continue
+
+            if max_expansions is not None and stats['expanded'] >= max_expansions:
+                stats['truncated'] = True
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                stats['truncated'] = stats['timed_out'] = True
+                break
+            stats['expanded'] += 1
+
+            # Modifiers have different sections.
+            # `step` variable here decides which set's turn it is currently.
+            # `fr` variable here is the string candidate to be modified
+            # `to_list` contains strings that the candidate will be modified into
+            if isinstance(modifiers[step], RuleMatcher):
+                # The compiled rules find all the candidate strings in a single pass
+                alternated_words = [alternated_word.strip()
+                                    for alternated_word in modifiers[step].alternations(dialect)]
+            else:
+                alternated_words = [dialect.replace(fr, to).strip()
+                                    for fr, to_list in modifiers[step].items()
+                                    # If the candidate string exists in the dialect word
+                                    if fr in dialect
+                                    for to in to_list]
+            stats['scored'] += len(alternated_words)
+            stats['tried'][step] += len(alternated_words)
+            kept = []
+
+            # Find the closest dictionary keywords to all alternated versions at once
+            closest = get_closest_many(alternated_words, vocabulary)
+            for alternated_word, (estimates, alt_dist) in zip(alternated_words, closest):
+
+                # If the minimum possible distance of the alternated is smaller than
+                # the minimum calculated distance of the given dialect word,
+                # and the same alternative was not found before in this section
+                if alt_dist < curr_dist and alternated_word not in visited:
+
+                    # Add the new alternated word to the candidates.
+                    # It will also be alternated later in the same section.
+                    visited[alternated_word] = {
+                        'dialect': alternated_word,
+                        'estimates': estimates,
+                        'distance': alt_dist
+                    }
+                    queue.append(visited[alternated_word])
+                    stats['accepted'][step] += 1
+                    kept.append(alternated_word)
+
+                    # Check if the newly calculated distance is the minimum so far.
+                    # If so, update the global minimum distance
+                    if alt_dist < min_distance:
+                        min_distance = alt_dist
+
+            if trace is not None:
+                # The rules are listed in the same order as the alternatives they create
+                section = modifiers[step].section if isinstance(modifiers[step], RuleMatcher) else modifiers[step]
+                rules = [(fr, to) for fr, to_list in section.items() if fr in dialect for to in to_list]
+                kept = set(kept)
+                alternatives = []
+                for (fr, to), alternated_word, (_, alt_dist) in zip(rules, alternated_words, closest):
+                    # When two rules create the same alternative, only the first one kept it
+                    alternatives.append((fr, to, alternated_word, alt_dist, alternated_word in kept))
+                    kept.discard(alternated_word)
+                trace.append((step, dialect, curr_dist, alternatives))
+
+        # Only leave the combinations with minimum distance calculated so far.
+        # These are also the strings the next section starts with.
+        combinations = [c for c in visited.values() if c['distance'] == min_distance]
+
+        # If any of the alternatives reached to a dictionary version (min_distance==0),
+        # stop the search and return. Otherwise, continue with the next section.
+        # WARNING: Althouth ending the function here speeds up the processing,
+        #          the downside is we cannot control whether it is the correct result.
+        if min_distance == 0 or stats['truncated'] or step + 1 >= len(modifiers):
+            break
         step += 1
-        # If the sections of the modifiers is not yet exhausted;
-        if step < len(modifiers):
-            # Call the function itself again to proceed to the next step
-            combinations = alternate_dialect(dialect_word, combinations,
-                                             vocabulary, modifiers,
-                                             step, min_distance)
 
     return combinations
 
@@ -240,10 +454,11 @@ def process_single_word(dialect_word, max_return=1, **kwargs):
     Returns
     -------
     keywords : list of dictionaries
-        The predictions done by the algorithm.
+        The predictions done by the algorithm. When the search was stopped by
+        `max_expansions` or `max_seconds`, they have 'truncated' set to True.
     """
     estimates = []
-    keywords = []
+    stats = kwargs.setdefault('stats', {})
 
     # Obtain the predictions done by alternating the dialect word.
     combs = alternate_dialect(dialect_word, [], **kwargs)
@@ -252,24 +467,216 @@ def process_single_word(dialect_word, max_return=1, **kwargs):
         if 'estimates' in combs[0]:
             estimates = combs[0]['estimates']
 
-    if estimates:
-        for e in estimates[:max_return]:
-            estimate = {'trefwoord': e['trefwoord']}
-            # If the edit distance is larger than 5, it is a long shot
-            # Thus the score should be zero
-            if e['distance'] > 5:
-                estimate['score'] = 0
-            else:
-                # If edit distance smaller than 5,
-                # the score is inversly proportioned
-                estimate['score'] = 5 - e['distance']
-            keywords.append(estimate)
+    return score_estimates(estimates, max_return, truncated=stats['truncated'])
+
+def score_estimates(estimates, max_return=1, truncated=False):
+    """Turns the closest vocabulary entries of :func:`get_closest()` into the predictions
+    of :func:`process_single_word()`, with a score that shrinks with the edit distance
+    """
+    keywords = []
+    for e in estimates[:max_return]:
+        estimate = {'trefwoord': e['trefwoord']}
+        # If the edit distance is larger than 5, it is a long shot
+        # Thus the score should be zero
+        if e['distance'] > 5:
+            estimate['score'] = 0
+        else:
+            # If edit distance smaller than 5,
+            # the score is inversly proportioned
+            estimate['score'] = 5 - e['distance']
+        # The best candidate found before the search was stopped
+        if truncated:
+            estimate['truncated'] = True
+        keywords.append(estimate)
 
     return keywords
 
-def apply_phonetisaurus(dialect_words_list, model_path='./models/phonetisaurus-model.fst'):
+# The arguments of :func:`process_single_word()` in the worker processes of :func:`process_words()`.
+# Set before the workers are forked, so that they are inherited instead of pickled.
+_WORKER_KWARGS = {}
+
+def _process_word(dialect_word, kwargs):
+    """Runs :func:`process_single_word()` and returns its keywords and the statistics
+    of the word, including the lookups it found in :data:`CLOSEST_CACHE` and the
+    'seconds' it took. The 'trace' of the search is added for the words that take more
+    than SLOW_WORD_SECONDS, see slow_words.py.
+    """
+    stats = {'rule_index': False}
+    # Collected during the search, as it is only known afterwards whether the word was slow
+    trace = [] if settings.SLOW_WORD_SECONDS is not None else None
+    hits, misses = CLOSEST_CACHE.hits, CLOSEST_CACHE.misses
+    start = time.perf_counter()
+    keywords = process_single_word(dialect_word, stats=stats, trace=trace, **kwargs)
+    stats['seconds'] = time.perf_counter() - start
+    stats['closest_hits'] = CLOSEST_CACHE.hits - hits
+    stats['closest_misses'] = CLOSEST_CACHE.misses - misses
+
+    if trace is not None and stats['seconds'] > settings.SLOW_WORD_SECONDS:
+        stats['trace'] = trace
+    return keywords, stats
+
+def _resolve_word(dialect_word, modified, kwargs):
+    """Returns the keywords and the statistics of a word that is a canonical key of the
+    given 'modified' version in the rule index, the same as a search that ends there
+    """
+    hits, misses = CLOSEST_CACHE.hits, CLOSEST_CACHE.misses
+    start = time.perf_counter()
+    estimates, _ = get_closest(modified, kwargs['vocabulary'])
+    keywords = score_estimates(estimates, kwargs.get('max_return', 1))
+    sections = len(kwargs['modifiers'])
+    stats = {'expanded': 0, 'scored': 0, 'step': 0, 'truncated': False, 'timed_out': False,
+             'tried': [0] * sections, 'accepted': [0] * sections, 'rule_index': True,
+             'seconds': time.perf_counter() - start,
+             'closest_hits': CLOSEST_CACHE.hits - hits, 'closest_misses': CLOSEST_CACHE.misses - misses}
+    return keywords, stats
+
+def _process_word_in_worker(dialect_word):
+    """Runs :func:`process_single_word()` in a worker process of :func:`process_words()`"""
+    return _process_word(dialect_word, _WORKER_KWARGS)
+
+def _process_word_in_pool(options, dialect_word):
+    """Runs :func:`process_single_word()` in a worker of the pool of :func:`start_pool()`,
+    with the vocabulary and the rules the worker inherited and the given other arguments
+    """
+    return _process_word(dialect_word, dict(options, vocabulary=get_vocabulary_index(),
+                                            modifiers=COMPILED_MODIFIERS))
+
+# The long-lived pool of the rule-based workers, see :func:`start_pool()`
+_POOL = None
+_POOL_WORKERS = 0
+
+def rulebased_workers():
+    """Returns the number of rule-based worker processes of a job: RULEBASED_WORKERS, or the
+    number of CPUs shared by the JOB_WORKERS jobs that run at the same time when it is not set
+    """
+    return settings.RULEBASED_WORKERS or max(1, os.cpu_count() // settings.JOB_WORKERS)
+
+def start_pool(workers=None):
+    """Starts the pool of rule-based worker processes that :func:`process_words()` uses
+    for the rest of the life of the current process, unless it is started already.
+
+    Each worker keeps its own :data:`CLOSEST_CACHE`, so the vocabulary lookups of one
+    chunk of words are reused by the next chunks and the next jobs. The pool should be
+    started before any threads, e.g. those of the Phonetisaurus workers, as they are
+    not copied into the forked workers.
+
+    Parameters
+    ----------
+    workers : integer, (default=None)
+        The number of worker processes, :func:`rulebased_workers()` when not given.
+        No pool is started for a single worker.
+    """
+    global _POOL, _POOL_WORKERS
+
+    workers = workers or rulebased_workers()
+    if _POOL is not None or workers <= 1:
+        return
+    # Loaded before forking, so that the workers share the vocabulary and its index
+    get_vocabulary_index().prepare()
+    _POOL = multiprocessing.get_context('fork').Pool(workers)
+    _POOL_WORKERS = workers
+
+def stop_pool():
+    """Stops the pool of :func:`start_pool()`"""
+    global _POOL, _POOL_WORKERS
+
+    if _POOL is not None:
+        _POOL.terminate()
+        _POOL.join()
+    _POOL = None
+    _POOL_WORKERS = 0
+
+def process_words(dialect_words, workers=None, chunksize=None, stats=None, rule_index=None, **kwargs):
+    """Apply the rule-based prediction algorithm on a batch of words,
+    using a pool of worker processes
+
+    The words are searched by the pool of :func:`start_pool()` when it is started with
+    the same number of workers and the default vocabulary and rules are used. Otherwise,
+    a pool is forked from the current process for this call only, so that the workers
+    start with the vocabulary index and the given rules already loaded.
+
+    Parameters
+    ----------
+    dialect_words : list of strings
+        Give the dialect words that needs to be processed
+
+    workers : integer, (default=None)
+        The number of worker processes, :func:`rulebased_workers()` when not given.
+        When 1, the words are processed in the current process.
+
+    chunksize : integer, (default=None)
+        The number of words sent to a worker at once. When not given, every worker
+        gets about four chunks.
+
+    stats : list, (default=None)
+        When given, it is extended with the statistics of :func:`alternate_dialect()`
+        for each word, in the same order as the words. They also contain the number of
+        vocabulary lookups that were found in :data:`CLOSEST_CACHE` ('closest_hits')
+        and that were not ('closest_misses'), the 'seconds' spent on the word, and the
+        'trace' of the search of the words that took more than SLOW_WORD_SECONDS.
+        'rule_index' tells whether the word was resolved by the rule index.
+
+    rule_index : :class:`rule_index.RuleIndex`, (default=None)
+        When given, the words that are canonical keys in the index are resolved
+        with a lookup, and only the other words are searched.
+
+    **kwargs
+        Given to the :func:`process_single_word()` function. The vocabulary and the
+        modifiers default to :func:`get_vocabulary_index()` and :data:`rules.COMPILED_MODIFIERS`.
+
+    Returns
+    -------
+    keywords : list of lists of dictionaries
+        The predictions of :func:`process_single_word()` for each word, in the same order.
+    """
+    global _WORKER_KWARGS
+
+    kwargs.setdefault('vocabulary', get_vocabulary_index())
+    kwargs.setdefault('modifiers', COMPILED_MODIFIERS)
+
+    resolved = rule_index.lookup_many(dialect_words) if rule_index is not None else {}
+    searched = [dialect_word for dialect_word in dialect_words if dialect_word not in resolved]
+
+    workers = workers or rulebased_workers()
+    workers = min(workers, len(searched))
+
+    if workers <= 1:
+        results = [_process_word(dialect_word, kwargs) for dialect_word in searched]
+    elif (_POOL is not None and workers == min(_POOL_WORKERS, len(searched)) and
+          kwargs['vocabulary'] is get_vocabulary_index() and kwargs['modifiers'] is COMPILED_MODIFIERS):
+        options = {key: value for key, value in kwargs.items() if key not in ('vocabulary', 'modifiers')}
+        chunksize = chunksize or -(-len(searched) // (workers * 4))
+        # map() returns the results in the order of the input
+        results = _POOL.map(partial(_process_word_in_pool, options), searched, chunksize)
+    else:
+        if isinstance(kwargs['vocabulary'], VocabularyIndex):
+            kwargs['vocabulary'].prepare()
+        _WORKER_KWARGS = kwargs
+
+        chunksize = chunksize or -(-len(searched) // (workers * 4))
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            # map() returns the results in the order of the input
+            results = pool.map(_process_word_in_worker, searched, chunksize)
+
+        _WORKER_KWARGS = {}
+
+    if resolved:
+        searched_results = iter(results)
+        results = [_resolve_word(dialect_word, resolved[dialect_word], kwargs) if dialect_word in resolved
+                   else next(searched_results) for dialect_word in dialect_words]
+
+    if stats is not None:
+        stats.extend(word_stats for _, word_stats in results)
+
+    return [keywords for keywords, _ in results]
+
+def apply_phonetisaurus(dialect_words_list, model_path='./models/phonetisaurus-model.fst', shards=None):
     """Runs the Phonetisaurus model and returns its predictions on a given list of dialect words
 
+    The words are sent to the long-lived workers of :func:`g2p.get_pool()`, which keep
+    the model loaded between jobs. The backend and the number of workers are set by
+    the G2P_* settings.
+
     Parameters
     ----------
     dialect_words_list : list of strings
@@ -278,49 +685,201 @@ def apply_phonetisaurus(dialect_words_list, model_path='./models/phonetisaurus-m
     model_path : string, (default='./models/phonetisaurus-model.fst')
         The path of the desired Phonetisaurus model file.
 
+    shards : integer, (default=None)
+        The number of parts the list is split into, which are processed concurrently
+        by separate workers. When not given, G2P_SHARDS in the settings is used,
+        or the number of workers if that is not set either.
+
+    Raises
+    ------
+    g2p.G2PWorkerError
+        When the workers cannot give the predictions, e.g. because Phonetisaurus is not
+        installed. The job then fails instead of giving every word the placeholder.
+
     Returns
     -------
     phonetisaurus_keyword_list : list of strings
         The list of predictions done by the Phonetisaurus model.
     """
-    # Currently phonetisaurus in our system is a script that accepts files as input
-    # Hence, we write our input into a temporary file first
-    tmp_path = os.path.join(settings.BASE_DIR, 'tmp.txt')
-    with open(tmp_path, 'w') as tm:
-        for dwc in dialect_words_list:
-            tm.write(dwc + '\n')
-
-    # Phonetisaurus script called in a subprocess
-    popen_job = Popen(['phonetisaurus-apply',
-                       '--model', model_path,
-                       '--word_list', tmp_path,
-                       '-n', '1'],
-                      stdout=PIPE,
-                      cwd=settings.BASE_DIR)
-    popen_job.wait()
-
-    # Temporary file is removed after usage
-    os.remove(tmp_path)
-
-    # Read the output from the subprocess
-    popen_output = str(popen_job.stdout.read(), 'utf-8')
-
-    # The output is similar to a tab-separated file,
-    # so we first split the lines and align input-output words in a set
-    phonetisaurus_result_dict = {line.split('\t')[0]: line.split('\t')[1]
-                                 for line in popen_output.split('\n')
-                                 if len(line) > 0 and '\t' in line}
+    predictions = g2p.get_pool(model_path).predict(dialect_words_list,
+                                                   shards=shards or settings.G2P_SHARDS)
 
     # Phonetisaurus does not return anything for the words it could not process.
     # To be able to align the results with the original list,
-    # we loop over the original list and fill the blanks with a placeholder
-    phonetisaurus_keyword_list = [phonetisaurus_result_dict[dwc]
-                                  if dwc in phonetisaurus_result_dict.keys() else '-'
-                                  for dwc in dialect_words_list]
+    # we fill the blanks with a placeholder
+    phonetisaurus_keyword_list = [prediction if prediction else '-' for prediction in predictions]
 
     return phonetisaurus_keyword_list
 
-def process_file(file_name, email_address=''):
+def run_predictors(dialect_words_list_clean, max_seconds=None, workers=None, rule_index=None):
+    """Runs the rule-based and the Phonetisaurus predictors at the same time on the same words
+
+    Phonetisaurus runs in its own worker processes, so it only needs a thread here
+    that waits for its results, while the rule-based predictor keeps the CPUs busy.
+    The job then takes about as long as the slower of the two.
+
+    Parameters
+    ----------
+    dialect_words_list_clean : list of strings
+        The dialect words, preprocessed with :func:`clean_str_word()`
+
+    max_seconds : float, (default=None)
+        The time limit of the rule-based search of each word, see :func:`alternate_dialect()`
+
+    workers : integer, (default=None)
+        The number of processes of the rule-based search, see :func:`process_words()`
+
+    rule_index : :class:`rule_index.RuleIndex`, (default=None)
+        The index that resolves the canonical words without a search, see :func:`process_words()`
+
+    Returns
+    -------
+    rulebased_keywords_list : list of lists of dictionaries
+        The predictions of :func:`process_words()`, in the same order as the words
+
+    words_stats : list of dictionaries
+        The statistics of :func:`alternate_dialect()` for each word
+
+    phonetisaurus_keyword_list : list of strings
+        The predictions of :func:`apply_phonetisaurus()`, in the same order as the words
+
+    timings : dictionary
+        The seconds spent on 'rulebased', 'phonetisaurus' and on both together ('total')
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    def timed_phonetisaurus():
+        phonetisaurus_keyword_list = apply_phonetisaurus(dialect_words_list_clean)
+        timings['phonetisaurus'] = time.perf_counter() - start
+        return phonetisaurus_keyword_list
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        phonetisaurus_future = executor.submit(timed_phonetisaurus)
+
+        words_stats = []
+        rulebased_keywords_list = process_words(dialect_words_list_clean, workers=workers,
+                                                max_expansions=settings.MAX_EXPANSIONS,
+                                                max_seconds=max_seconds, stats=words_stats,
+                                                rule_index=rule_index)
+        timings['rulebased'] = time.perf_counter() - start
+
+        phonetisaurus_keyword_list = phonetisaurus_future.result()
+
+    timings['total'] = time.perf_counter() - start
+
+    return rulebased_keywords_list, words_stats, phonetisaurus_keyword_list, timings
+
+def read_unique_lines(file_path, run_size=100000):
+    """Reads the stripped lines of a file and yields each of them once, in sorted order.
+    The memory use does not depend on the size of the file: the lines are sorted in runs
+    of `run_size` lines which are stored in temporary files, and the runs are merged.
+
+    Parameters
+    ----------
+    file_path : string
+        The path of the file to read
+
+    run_size : integer, (default=100000)
+        The number of lines sorted in the memory at once
+
+    Yields
+    ------
+    line : string
+        The unique lines of the file, without the surrounding white space
+    """
+    runs = []
+    try:
+        with open(file_path, 'r') as f:
+            while True:
+                lines = list(islice(f, run_size))
+                if not lines:
+                    break
+                run = tempfile.TemporaryFile('w+', encoding='utf-8')
+                run.writelines(line + '\n' for line in sorted({line.strip() for line in lines}))
+                run.seek(0)
+                runs.append(run)
+
+        # Duplicates of different runs end up next to each other after merging
+        previous = None
+        for line in heapq.merge(*runs, key=lambda l: l[:-1]):
+            line = line[:-1]
+            if line != previous:
+                yield line
+            previous = line
+    finally:
+        for run in runs:
+            run.close()
+
+@lru_cache(maxsize=None)
+def _file_hash(path, size, mtime):
+    """Returns the hash of a file's contents. The size and the modification time are
+    part of the arguments so that a changed file is hashed again.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def prediction_config(model_path='./models/phonetisaurus-model.fst'):
+    """Returns a hash of everything that changes the predictions of a word:
+    the vocabulary, the rules, the Phonetisaurus model and backend, and the
+    settings of the rule-based search. Used as the key of the cached predictions
+    of :mod:`prediction_cache`, so that they are never reused after a change.
+    """
+    model_path = os.path.join(settings.BASE_DIR, model_path)
+    if os.path.isfile(model_path):
+        model_stat = os.stat(model_path)
+        model_hash = _file_hash(model_path, model_stat.st_size, model_stat.st_mtime_ns)
+    else:
+        model_hash = ''
+
+    rule_index = get_rule_index(get_vocabulary_index(), MODIFIERS)
+    config = json.dumps([get_vocabulary_index().version, MODIFIERS, model_hash,
+                         settings.G2P_BACKEND, settings.MAX_EXPANSIONS,
+                         rule_index.version if rule_index is not None else None], ensure_ascii=False)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()
+
+def format_row(dialect_word, rulebased_keywords, phonetisaurus_keyword):
+    """Returns the line of the processed file for a single dialect word"""
+    row = dialect_word + '\t'
+    if len(rulebased_keywords) > 0:
+        keyword = rulebased_keywords[0]
+        # The score of a keyword whose search was stopped early is marked with an asterisk
+        row += keyword['trefwoord'] + ' (' + str(keyword['score']) + ('*' if keyword.get('truncated') else '') + ')\t'
+    else:
+        row += '-\t'
+    row += phonetisaurus_keyword + ' (3)' + '\t' if phonetisaurus_keyword != '-' else '- (-)\t'
+    row += '\n'
+    return row
+
+def word_time_limit(job_deadline, remaining_words):
+    """Returns the time limit of the rule-based search of each word: WORD_DEADLINE_SECONDS,
+    or less when the time that is left until the deadline of the job, shared by the
+    rule-based worker processes, is spread over the remaining words
+
+    Parameters
+    ----------
+    job_deadline : float or None
+        The :func:`time.perf_counter()` at which the job should be done, None for no deadline
+
+    remaining_words : integer
+        The number of words that are not processed yet
+
+    Returns
+    -------
+    max_seconds : float or None
+        None when there is no limit
+    """
+    max_seconds = settings.WORD_DEADLINE_SECONDS
+    if job_deadline is not None:
+        workers = rulebased_workers()
+        share = max(job_deadline - time.perf_counter(), 0.0) * workers / max(remaining_words, 1)
+        max_seconds = share if max_seconds is None else min(max_seconds, share)
+    return max_seconds
+
+def process_file(file_name, email_address='', progress=None, workers=None):
     """A wrapper function that reads data from file, runs the algorithms, writes
     the results to a file, and sends a notification email to the given email address
 
@@ -332,38 +891,171 @@ def process_file(file_name, email_address=''):
 
     email_address : string, (default='')
         The email address that should be notified when the processing is completed.
+
+    progress : function, (default=None)
+        When given, called after each chunk of words with the number of words processed
+        so far, the total number of words, the seconds spent per stage so far
+        (the 'timings' of :func:`run_predictors()`), the number of words whose
+        predictions were found in the prediction cache and the number of distinct
+        words the predictors were run on, which the timings belong to.
+
+    workers : integer, (default=None)
+        The number of processes of the rule-based search, :func:`rulebased_workers()` when not given.
+        A profiled job uses 1, so that the search runs in the profiled process.
+
+    Returns
+    -------
+    metrics : dictionary
+        The :meth:`metrics.Metrics.summary()` of the job, which is also written as JSON
+        to the file with the extension '_processed.metrics.json'. Empty when
+        METRICS_ENABLED is False.
     """
     fs = FileSystemStorage()
-
-    # Read the uploaded file from the file system
-    # and load the dialect keywords into a list
-    with open(fs.path(file_name + '.txt'), 'r') as f:
-        dialect_words_list = sorted(list({line.strip() for line in f.readlines()}))
-
-    # Apply the preprocessing. Currently needed both for rule-based and phonetisaurus systems
-    dialect_words_list_clean = [clean_str_word(dw, split=True, hard=True)
-                                for dw in dialect_words_list]
-
-    # Give the list of preprocessed strings to the phonetisaurus algorithm
-    phonetisaurus_keyword_list = apply_phonetisaurus(dialect_words_list_clean)
-
-    # Prepare the string to be written to the file
-    to_write = 'Dialect Word\tFirst Estimate\tSecond Estimate\n'
-    for dialect_word, dialect_word_clean, phonetisaurus_keyword in zip(dialect_words_list,
-                                                                       dialect_words_list_clean,
-                                                                       phonetisaurus_keyword_list):
-        # Rule-based system is currently designed to process a single keyword at once
-        # Hence it is callsed here inside the loop (unlike apply_phonetisaurus())
-        rulebased_keywords = process_single_word(dialect_word_clean, vocabulary=VOCABULARY, modifiers=MODIFIERS)
-        to_write += dialect_word + '\t'
-        to_write += rulebased_keywords[0]['trefwoord'] + ' (' + str(rulebased_keywords[0]['score']) + ')' + '\t' if len(rulebased_keywords) > 0 else '-\t'
-        to_write += phonetisaurus_keyword + ' (3)' + '\t' if phonetisaurus_keyword != '-' else '- (-)\t'
-        to_write += '\n'
-
-    # Write the string to the file
-    with open('media/' + file_name + '_processed.tsv', 'w') as fn:
+    job_metrics = Metrics(enabled=settings.METRICS_ENABLED)
+    # Started before the Phonetisaurus threads, and kept for the next jobs
+    start_pool(workers)
+    job_start = time.perf_counter()
+
+    # The uploaded file is processed in chunks, which are written to the file
+    # as soon as they are ready, so that the memory use does not depend on its size.
+    # The dialect keywords are read in sorted order and without duplicates,
+    # and kept in a temporary file so that their number is known in advance.
+    unique_words = tempfile.TemporaryFile('w+', encoding='utf-8')
+    total_words = 0
+    for dialect_word in read_unique_lines(fs.path(file_name + '.txt'), run_size=settings.SORT_RUN_SIZE):
+        unique_words.write(dialect_word + '\n')
+        total_words += 1
+    unique_words.seek(0)
+    dialect_words = (line[:-1] for line in unique_words)
+
+    processed_words = 0
+    total_expanded = 0
+    timings = {'rulebased': 0.0, 'phonetisaurus': 0.0, 'total': 0.0}
+
+    # The predictions of words that were in earlier uploads are taken from the cache
+    cache = get_cache()
+    config = prediction_config() if cache is not None else None
+    cache_hits = 0
+    rule_index = get_rule_index(get_vocabulary_index(), MODIFIERS)
+    predicted_words = 0
+    slow_words = SlowWordReport()
+
+    # The time the job may take, spread over the words that are left, see :func:`word_time_limit()`
+    job_deadline = job_start + settings.JOB_DEADLINE_SECONDS if settings.JOB_DEADLINE_SECONDS is not None else None
+
+    if progress:
+        progress(processed_words, total_words, timings, cache_hits, predicted_words)
+
+    with unique_words, open(fs.path(file_name + '_processed.tsv'), 'w') as fn:
         myfile = File(fn)
-        myfile.write(to_write)
+        myfile.write('Dialect Word\tFirst Estimate\tSecond Estimate\n')
+
+        while True:
+            dialect_words_list = list(islice(dialect_words, settings.UPLOAD_CHUNK_SIZE))
+            if not dialect_words_list:
+                break
+
+            # Apply the preprocessing. Currently needed both for rule-based and phonetisaurus systems
+            with job_metrics.timer('clean'):
+                dialect_words_list_clean = clean_many(dialect_words_list, split=True, hard=True)
+
+            with job_metrics.timer('prediction_cache_get'):
+                predictions = cache.get_many(config, dialect_words_list_clean) if cache is not None else {}
+            chunk_cache_hits = sum(dialect_word_clean in predictions for dialect_word_clean in dialect_words_list_clean)
+            cache_hits += chunk_cache_hits
+
+            # Both predictors are run at the same time on the preprocessed strings that are not cached
+            missing = list(dict.fromkeys(dw for dw in dialect_words_list_clean if dw not in predictions))
+            chunk_timings = {}
+            if missing:
+                max_seconds = word_time_limit(job_deadline, total_words - processed_words)
+                rulebased_keywords_list, words_stats, phonetisaurus_keyword_list, chunk_timings = run_predictors(
+                    missing, max_seconds=max_seconds, workers=workers, rule_index=rule_index)
+
+                for dialect_word_clean, rulebased_keywords, phonetisaurus_keyword, stats in zip(
+                        missing, rulebased_keywords_list, phonetisaurus_keyword_list, words_stats):
+                    # The number of expanded strings shows how much of the rule search was needed
+                    logger.debug('%s: %d strings expanded, %d scored, reached step %d%s', dialect_word_clean,
+                                 stats['expanded'], stats['scored'], stats['step'],
+                                 ' (truncated)' if stats['truncated'] else '')
+                    total_expanded += stats['expanded']
+
+                    if 'trace' in stats:
+                        logger.warning('%s: slow word, %.2fs, %d strings expanded, %d scored, reached step %d%s\n%s',
+                                       dialect_word_clean, stats['seconds'], stats['expanded'], stats['scored'],
+                                       stats['step'], ' (truncated)' if stats['truncated'] else '',
+                                       format_trace(stats['trace']))
+                        slow_words.add(dialect_word_clean, stats['seconds'], stats, stats['trace'])
+
+                    if job_metrics.enabled:
+                        job_metrics.observe('word', stats['seconds'])
+                        job_metrics.incr('words_slow', 'trace' in stats)
+                        job_metrics.incr('words_rule_index', stats['rule_index'])
+                        job_metrics.incr('strings_expanded', stats['expanded'])
+                        job_metrics.incr('words_truncated', stats['truncated'])
+                        job_metrics.incr('closest_calls', stats['closest_hits'] + stats['closest_misses'])
+                        job_metrics.incr('closest_cache_hits', stats['closest_hits'])
+                        for section, (tried, accepted) in enumerate(zip(stats['tried'], stats['accepted'])):
+                            job_metrics.incr('alternations_tried{section="%d"}' % section, tried)
+                            job_metrics.incr('alternations_accepted{section="%d"}' % section, accepted)
+
+                for stage, seconds in chunk_timings.items():
+                    job_metrics.observe(stage, seconds)
+
+                computed = {dw: (rulebased_keywords, phonetisaurus_keyword)
+                            for dw, rulebased_keywords, phonetisaurus_keyword in zip(
+                                missing, rulebased_keywords_list, phonetisaurus_keyword_list)}
+                if cache is not None:
+                    # Only successful predictions are stored: when the Phonetisaurus workers fail,
+                    # run_predictors() raises g2p.G2PWorkerError before anything of the chunk is kept.
+                    # A search stopped by the time limit may find more another time
+                    timed_out = {dw for dw, stats in zip(missing, words_stats) if stats['timed_out']}
+                    with job_metrics.timer('prediction_cache_put'):
+                        cache.put_many(config, {dw: prediction for dw, prediction in computed.items()
+                                                if dw not in timed_out})
+                predictions.update(computed)
+
+            rows = []
+            for dialect_word, dialect_word_clean in zip(dialect_words_list, dialect_words_list_clean):
+                rulebased_keywords, phonetisaurus_keyword = predictions[dialect_word_clean]
+                rows.append(format_row(dialect_word, rulebased_keywords, phonetisaurus_keyword))
+
+            # Write the chunk to the file
+            with job_metrics.timer('write'):
+                myfile.write(''.join(rows))
+                myfile.flush()
+
+            processed_words += len(dialect_words_list)
+            predicted_words += len(missing)
+            job_metrics.incr('words', len(dialect_words_list))
+            job_metrics.incr('words_cached', chunk_cache_hits)
+            for stage, seconds in chunk_timings.items():
+                timings[stage] += seconds
+
+            if progress:
+                progress(processed_words, total_words, timings, cache_hits, predicted_words)
+
+    # The index lets the words page read a single page of the rows
+    with job_metrics.timer('index'):
+        build_index(fs.path(file_name + '_processed.tsv'))
+    job_metrics.observe('job', time.perf_counter() - job_start)
+
+    logger.info('%s: %d words processed, %d strings expanded, rule-based %.1fs, phonetisaurus %.1fs, total %.1fs',
+                file_name, total_words, total_expanded,
+                timings['rulebased'], timings['phonetisaurus'], timings['total'])
+    if cache is not None:
+        logger.info('%s: %d of %d words found in the prediction cache (%.0f%%)', file_name,
+                    cache_hits, total_words, 100 * cache_hits / total_words if total_words else 0)
+
+    # The rules that made the searches of the slow words large
+    if slow_words.words:
+        report = slow_words.summary()
+        with open(fs.path(file_name + '_processed.slow_words.json'), 'w') as f:
+            json.dump(report, f, indent=1, ensure_ascii=False)
+        logger.warning('%s: %d slow words, worst rules: %s', file_name, len(report['words']),
+                       ', '.join('%d:%s (%d tried, %d kept, %d words)' % (
+                           rule['section'], rule['key'], rule['tried'], rule['kept'], rule['words'])
+                           for rule in report['worst_rules'][:10]))
 
     send_mail(
         'Text processing is done. Dialect words are converted.',
@@ -377,3 +1069,9 @@ def process_file(file_name, email_address=''):
         [email_address],
         fail_silently=False,
     )
+
+    summary = job_metrics.summary()
+    if job_metrics.enabled:
+        with open(fs.path(file_name + '_processed.metrics.json'), 'w') as f:
+            json.dump(summary, f, indent=1, sort_keys=True)
+    return summary
@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+"""Contains the index structures used to search the vocabulary for the closest keywords"""
+
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+from functools import partial
+
+import Levenshtein as lev
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only needed for the batch scoring in :meth:`VocabularyIndex.closest_many()`.
+    # Without it, the batch is answered one dialect word at a time.
+    np = None
+
+# Upper limit for the number of (dialect word, vocabulary string) pairs compared
+# at once by the batch scoring. Larger groups are split so that the memory use stays bounded.
+MAX_BATCH_CELLS = 4000000
+
+# The header of the binary vocabulary format, see :func:`build_binary()`
+BINARY_MAGIC = b'D2KVOCAB'
+BINARY_FORMAT = 1
+BINARY_HEADER = struct.Struct('<8sI40sqqIIII')
+
+def vocabulary_version(vocabulary):
+    """Returns a hash that identifies the contents of a vocabulary,
+    the same for the JSON and the binary version of it
+    """
+    return hashlib.sha1('\n'.join(w['modified'] + '\t' + w['trefwoord']
+                                  for w in vocabulary).encode('utf-8')).hexdigest()
+
+def build_binary(vocabulary, path, source_path=None):
+    """Writes a vocabulary to a binary file that can be loaded by :class:`BinaryVocabulary`
+    much faster than the JSON version, as nothing but the strings needs to be parsed.
+
+    The file contains, after the header, the following arrays of 32-bit unsigned integers:
+    the byte offsets of the strings, the string ids of the 'modified' and of the 'trefwoord'
+    version of every entry, and the positions of the entries grouped by their 'modified'
+    version with the offsets of the groups. The strings come last, encoded as UTF-8 and
+    each followed by a newline. The unique 'modified' versions are the first strings,
+    in the order of their first entry, followed by the 'trefwoord' versions that do
+    not occur as a 'modified' version.
+
+    Parameters
+    ----------
+    vocabulary : list of dictionaries
+        The vocabulary, as stored in the JSON file
+
+    path : string
+        The path of the binary file
+
+    source_path : string, (default=None)
+        The path of the JSON file the vocabulary is read from. Its size and modification
+        time are stored, so that an outdated binary file is noticed when loading.
+    """
+    strings = {}
+    for w in vocabulary:
+        strings.setdefault(w['modified'], len(strings))
+    unique = len(strings)
+    for w in vocabulary:
+        strings.setdefault(w['trefwoord'], len(strings))
+
+    encoded = [string.encode('utf-8') + b'\n' for string in strings]
+    offsets = array('I', [0])
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+
+    modified_ids = array('I', (strings[w['modified']] for w in vocabulary))
+    trefwoord_ids = array('I', (strings[w['trefwoord']] for w in vocabulary))
+
+    groups = [[] for _ in range(unique)]
+    for i, string_id in enumerate(modified_ids):
+        groups[string_id].append(i)
+    group_offsets = array('I', [0])
+    for group in groups:
+        group_offsets.append(group_offsets[-1] + len(group))
+    positions = array('I', (i for group in groups for i in group))
+
+    source_size, source_mtime = -1, -1
+    if source_path is not None:
+        source_stat = os.stat(source_path)
+        source_size, source_mtime = source_stat.st_size, source_stat.st_mtime_ns
+
+    string_bytes = offsets[-1]
+    arrays = [offsets, modified_ids, trefwoord_ids, group_offsets, positions]
+    if sys.byteorder != 'little':
+        for a in arrays:
+            a.byteswap()
+
+    # Written to a temporary file first, so that a running process never maps a half-written file
+    with open(path + '.tmp', 'wb') as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_FORMAT, vocabulary_version(vocabulary).encode('ascii'),
+                                   source_size, source_mtime, len(vocabulary), len(strings), unique,
+                                   string_bytes))
+        for a in arrays:
+            a.tofile(f)
+        f.write(b''.join(encoded))
+    os.replace(path + '.tmp', path)
+
+class BinaryVocabulary(Sequence):
+    """A read-only vocabulary backed by a memory map of the file written by :func:`build_binary()`.
+    Behaves like the list of dictionaries of the JSON file: the entries can be read
+    by their position and iterated over, but are only created when they are accessed.
+
+    Parameters
+    ----------
+    path : string
+        The path of the binary file
+
+    Raises
+    ------
+    ValueError
+        When the file is not a binary vocabulary of the current format,
+        or the machine is not little-endian.
+    """
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError('The binary vocabulary can only be mapped on little-endian machines')
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, binary_format, version, self.source_size, self.source_mtime,
+         entries, strings, unique, string_bytes) = BINARY_HEADER.unpack_from(self.map)
+        if magic != BINARY_MAGIC or binary_format != BINARY_FORMAT:
+            raise ValueError(path + ' is not a binary vocabulary of format ' + str(BINARY_FORMAT))
+        self.version = version.decode('ascii')
+
+        view = memoryview(self.map)
+        start = BINARY_HEADER.size
+        arrays = []
+        for length in (strings + 1, entries, entries, unique + 1, entries):
+            arrays.append(view[start:start + 4 * length].cast('I'))
+            start += 4 * length
+        self.offsets, self.modified_ids, self.trefwoord_ids, self.group_offsets, self.positions = arrays
+        self.strings = view[start:start + string_bytes]
+
+        # The 'modified' versions are needed by the index anyway, so they are decoded at once.
+        # The other strings are decoded when an entry is read.
+        self.modified = bytes(self.strings[:self.offsets[unique]]).decode('utf-8').split('\n')[:-1]
+
+    def string(self, string_id):
+        """Returns a string of the string table by its id"""
+        if string_id < len(self.modified):
+            return self.modified[string_id]
+        return bytes(self.strings[self.offsets[string_id]:self.offsets[string_id + 1] - 1]).decode('utf-8')
+
+    def grouped_positions(self):
+        """Returns the positions of the entries for each unique 'modified' version,
+        as used by :class:`VocabularyIndex`
+        """
+        group_offsets = self.group_offsets.tolist()
+        positions = self.positions.tolist()
+        return {modified: positions[start:end]
+                for modified, start, end in zip(self.modified, group_offsets, group_offsets[1:])}
+
+    def is_outdated(self, source_path):
+        """Returns whether the JSON file the vocabulary was built from has changed since"""
+        source_stat = os.stat(source_path)
+        return (source_stat.st_size, source_stat.st_mtime_ns) != (self.source_size, self.source_mtime)
+
+    def __len__(self):
+        return len(self.modified_ids)
+
+    def __getitem__(self, i):
+        return {'modified': self.modified[self.modified_ids[i]],
+                'trefwoord': self.string(self.trefwoord_ids[i])}
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+class CompactVocabulary(Sequence):
+    """The vocabulary stored as columns instead of a dictionary per entry.
+    The 'modified' versions are kept as a list of interned strings, so entries that
+    share a version share a single string, and the 'trefwoord' versions only for the
+    entries where they differ from the 'modified' version, which is rare.
+
+    Behaves like the list of dictionaries of the JSON file: reading an entry by its
+    position returns a new dictionary, and the columns can be used directly
+    to avoid creating them.
+
+    Parameters
+    ----------
+    modified : list of strings
+        The 'modified' version of every entry
+
+    trefwoord : dictionary
+        The 'trefwoord' version of the entries where it differs from the 'modified' version,
+        by the position of the entry
+
+    groups : dictionary, (default=None)
+        The positions of the entries for each unique 'modified' version, when already known
+
+    version : string, (default=None)
+        The hash of the contents, calculated when not given. See :func:`vocabulary_version()`.
+    """
+    __slots__ = ('modified', 'trefwoord', 'groups', '_version')
+
+    def __init__(self, modified, trefwoord, groups=None, version=None):
+        self.modified = modified
+        self.trefwoord = trefwoord
+        self.groups = groups
+        self._version = version
+
+    @classmethod
+    def from_entries(cls, vocabulary):
+        """Creates the compact version of a list of dictionaries"""
+        modified = [sys.intern(w['modified']) for w in vocabulary]
+        trefwoord = {i: w['trefwoord'] for i, w in enumerate(vocabulary) if w['trefwoord'] != w['modified']}
+        return cls(modified, trefwoord)
+
+    @classmethod
+    def from_binary(cls, binary):
+        """Creates the compact version of a :class:`BinaryVocabulary`, reusing its index"""
+        unique = binary.modified
+        modified = [unique[string_id] for string_id in binary.modified_ids]
+        trefwoord = {i: binary.string(trefwoord_id)
+                     for i, (modified_id, trefwoord_id) in enumerate(zip(binary.modified_ids, binary.trefwoord_ids))
+                     if modified_id != trefwoord_id}
+        return cls(modified, trefwoord, groups=binary.grouped_positions(), version=binary.version)
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = vocabulary_version(self)
+        return self._version
+
+    def trefwoord_at(self, i):
+        """Returns the 'trefwoord' version of the entry at the given position"""
+        return self.trefwoord.get(i, self.modified[i])
+
+    def grouped_positions(self):
+        """Returns the positions of the entries for each unique 'modified' version"""
+        if self.groups is None:
+            groups = {}
+            for i, modified in enumerate(self.modified):
+                groups.setdefault(modified, []).append(i)
+            self.groups = groups
+        return self.groups
+
+    def __len__(self):
+        return len(self.modified)
+
+    def __getitem__(self, i):
+        return {'modified': self.modified[i], 'trefwoord': self.trefwoord_at(i)}
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+class VocabularyIndex:
+    """A prebuilt index over the 'modified' versions of the vocabulary that answers
+    the same question as :func:`text_processing.get_closest()` without comparing
+    the dialect word to every entry of the vocabulary.
+
+    The search is done in three layers:
+
+    1.  An exact hash lookup, which answers distance 0.
+    2.  A lookup of every string one edit away from the dialect word
+        (deletions, substitutions and insertions over the vocabulary alphabet),
+        which answers distance 1.
+    3.  A scan that visits the vocabulary grouped by length, starting with the
+        length of the dialect word. The Levenshtein distance is never smaller than
+        the difference in length, so the scan stops as soon as the remaining
+        groups cannot contain anything closer than what is already found.
+
+    Parameters
+    ----------
+    vocabulary : list of dictionaries, :class:`CompactVocabulary` or :class:`BinaryVocabulary`
+        The list of known "dictionary" versions of the words.
+        The vocabulary should contain both 'modified' and the original 'trefwoord'
+        versions under the keys named the same. Stored as a :class:`CompactVocabulary`.
+    """
+    def __init__(self, vocabulary):
+        if isinstance(vocabulary, BinaryVocabulary):
+            vocabulary = CompactVocabulary.from_binary(vocabulary)
+        elif not isinstance(vocabulary, CompactVocabulary):
+            vocabulary = CompactVocabulary.from_entries(vocabulary)
+        self.vocabulary = vocabulary
+
+        # Several entries may share the same 'modified' version,
+        # so each unique string points to the positions of its entries
+        self.positions = vocabulary.grouped_positions()
+
+        # Unique strings grouped by their length, used by the bounded scan
+        self.by_length = {}
+        for modified in self.positions:
+            self.by_length.setdefault(len(modified), []).append(modified)
+        self.max_length = max(self.by_length) if self.by_length else 0
+
+        # Identifies the contents of the vocabulary, e.g. for the keys of :class:`ClosestCache`
+        self.version = vocabulary.version
+
+        # The characters used to generate the strings one edit away
+        self.alphabet = sorted(set(''.join(self.positions)))
+
+        # Bit mask encoded versions of the length groups for the batch scoring.
+        # Created on the first call of :meth:`closest_many()`.
+        self.codes = None
+        self.encoded = None
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.vocabulary)
+
+    def _neighbours(self, word):
+        """Returns every string that is exactly one edit away from the given word"""
+        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        neighbours = {l + r[1:] for l, r in splits if r}
+        neighbours.update(l + c + r[1:] for l, r in splits if r for c in self.alphabet)
+        neighbours.update(l + c + r for l, r in splits for c in self.alphabet)
+        neighbours.discard(word)
+        return neighbours
+
+    def _scan(self, dialect_word, distance_limit):
+        """Scans the length groups outwards from the length of the dialect word
+        and returns the distances of the strings that can still be in the result
+        """
+        length = len(dialect_word)
+        distances = {}
+        # The largest distance that can still be part of the result.
+        # Unknown until 'distance_limit' different distances are found.
+        bound = None
+
+        for offset in range(max(length, self.max_length - length) + 1):
+            if bound is not None and offset > bound:
+                break
+
+            for group_length in {length - offset, length + offset}:
+                group = self.by_length.get(group_length)
+                if not group:
+                    continue
+                for modified, distance in zip(group, map(partial(lev.distance, dialect_word), group)):
+                    if bound is None or distance <= bound:
+                        distances[modified] = distance
+
+            found = sorted(set(distances.values()))
+            if len(found) >= distance_limit:
+                bound = found[distance_limit - 1]
+
+        return distances
+
+    def closest(self, dialect_word, distance_limit=1):
+        """Calculates and returns the most similar keywords from the vocabulary.
+        Takes the same parameters and returns the same values as
+        :func:`text_processing.get_closest()`.
+        """
+        if not distance_limit:
+            # Without a limit every entry is a part of the result
+            distances = {modified: lev.distance(dialect_word, modified)
+                         for modified in self.positions}
+        elif distance_limit == 1 and dialect_word in self.positions:
+            distances = {dialect_word: 0}
+        else:
+            distances = None
+            if distance_limit == 1:
+                distances = {n: 1 for n in self._neighbours(dialect_word) if n in self.positions}
+            if not distances:
+                distances = self._scan(dialect_word, distance_limit)
+
+        return self._result(distances, distance_limit)
+
+    def _result(self, distances, distance_limit):
+        """Turns the distances of the unique strings into the output of :meth:`closest()`"""
+        if distance_limit:
+            limit_to = sorted(set(distances.values()))[:distance_limit]
+            distances = {m: d for m, d in distances.items() if d in limit_to}
+
+        # Visit the entries in the order of the vocabulary,
+        # so the ties are resolved the same way as in the linear scan
+        positions = sorted(i for modified in distances for i in self.positions[modified])
+        modified = self.vocabulary.modified
+        vocab_ = [{'modified': modified[i],
+                   'trefwoord': self.vocabulary.trefwoord_at(i),
+                   'distance': distances[modified[i]]}
+                  for i in positions]
+
+        vocab_ = list({c['trefwoord']: c for c in vocab_}.values())
+        vocab_ = sorted(vocab_, key=lambda k: k['distance'])
+
+        return vocab_, min({c['distance'] for c in vocab_})
+
+    def prepare(self):
+        """Builds the lazily created parts of the index, e.g. before forking worker processes
+        so that they share the structures instead of each building their own copy
+        """
+        if np is not None and self.encoded is None:
+            self._encode()
+
+    def _encode(self):
+        """Encodes each length group as bit masks: for every character of the alphabet,
+        an array with one 64-bit integer per unique string, in which bit i is set
+        when the string has that character at position i. The last row is left
+        empty for the characters that never occur in the vocabulary.
+        """
+        self.codes = {c: i for i, c in enumerate(self.alphabet)}
+        self.encoded = {}
+        for length, group in self.by_length.items():
+            # The masks only fit strings up to 64 characters.
+            # Longer ones are compared with :func:`Levenshtein.distance()`.
+            if length > 64:
+                continue
+            masks = np.zeros((len(self.alphabet) + 1, len(group)), dtype=np.uint64)
+            for i in range(length):
+                chars = np.array([self.codes[modified[i]] for modified in group])
+                masks[chars, np.arange(len(group))] |= np.uint64(1 << i)
+            self.encoded[length] = masks
+
+    def _distances(self, queries, length):
+        """Calculates the Levenshtein distances between the given dialect words,
+        which all have the same length, and every string of a length group at once.
+        Uses the bit-parallel algorithm of Myers (1999) in the formulation of Hyyrö (2003),
+        so every character of the dialect words is a handful of NumPy operations
+        over the entire group.
+
+        Returns
+        -------
+        distances : numpy array
+            An array of shape (number of queries, size of the group)
+        """
+        group = self.by_length[length]
+        if length not in self.encoded:
+            return np.array([list(map(partial(lev.distance, q), group)) for q in queries])
+
+        masks = self.encoded[length]
+        unknown = len(self.alphabet)
+        query_codes = [[self.codes.get(c, unknown) for c in q] for q in queries]
+        last = np.uint64(1 << (length - 1))
+        one = np.uint64(1)
+
+        chunk = max(1, MAX_BATCH_CELLS // len(queries))
+        parts = []
+        for start in range(0, len(group), chunk):
+            group_masks = masks[:, start:start + chunk]
+            shape = (len(queries), group_masks.shape[1])
+            # Vertical positive and negative deltas of the last column,
+            # and the distance in its bottom cell
+            vp = np.full(shape, np.iinfo(np.uint64).max, dtype=np.uint64)
+            vn = np.zeros(shape, dtype=np.uint64)
+            distance = np.full(shape, length, dtype=np.int64)
+
+            for i in range(len(queries[0])):
+                x = group_masks[[codes[i] for codes in query_codes]]
+                d0 = (((x & vp) + vp) ^ vp) | x | vn
+                hp = vn | ~(d0 | vp)
+                hn = d0 & vp
+                distance += (hp & last) != 0
+                distance -= (hn & last) != 0
+                hp = (hp << one) | one
+                hn = hn << one
+                vp = hn | ~(d0 | hp)
+                vn = hp & d0
+
+            parts.append(distance)
+
+        return np.concatenate(parts, axis=1)
+
+    def closest_many(self, dialect_words, distance_limit=1):
+        """Calculates the most similar keywords for a batch of dialect words at once.
+        Instead of a Python loop per dialect word, the distances to a length group
+        of the vocabulary are calculated for every dialect word of the same length
+        in a single NumPy pass.
+
+        Parameters
+        ----------
+        dialect_words : list of strings
+            Give the dialect words that needs to be checked against the vocabulary
+
+        distance_limit : integer, (default=1)
+            The same as in :meth:`closest()`.
+
+        Returns
+        -------
+        results : list of tuples
+            The output of :meth:`closest()` for each of the given dialect words,
+            in the same order.
+        """
+        if np is None or not distance_limit:
+            return [self.closest(dw, distance_limit) for dw in dialect_words]
+
+        if self.encoded is None:
+            self._encode()
+
+        unique = list(dict.fromkeys(dialect_words))
+        distances = {}
+        # Dialect words grouped by their length, which are still scanned
+        pending = {}
+
+        for dw in unique:
+            distances[dw] = {}
+            if distance_limit == 1:
+                if dw in self.positions:
+                    distances[dw] = {dw: 0}
+                else:
+                    distances[dw] = {n: 1 for n in self._neighbours(dw) if n in self.positions}
+            if not distances[dw]:
+                pending.setdefault(len(dw), []).append(dw)
+
+        # The same scan as in :meth:`_scan()`, for all pending dialect words at once
+        bounds = {}
+        for offset in range(self.max_length + max(pending, default=0) + 1):
+            for length, queries in pending.items():
+                active = [q for q in queries if bounds.get(q) is None or offset <= bounds[q]]
+                if not active:
+                    continue
+
+                for group_length in {length - offset, length + offset}:
+                    if group_length not in self.by_length:
+                        continue
+                    group = self.by_length[group_length]
+                    for q, row in zip(active, self._distances(active, group_length)):
+                        # Only the strings that can still be in the result leave NumPy
+                        found = sorted(set(distances[q].values()) | set(np.unique(row)[:distance_limit].tolist()))
+                        if len(found) >= distance_limit:
+                            keep = np.flatnonzero(row <= found[distance_limit - 1])
+                        else:
+                            keep = range(len(group))
+                        distances[q].update((group[k], int(row[k])) for k in keep)
+
+                for q in active:
+                    found = sorted(set(distances[q].values()))
+                    if len(found) >= distance_limit:
+                        bounds[q] = found[distance_limit - 1]
+
+        results = {dw: self._result(distances[dw], distance_limit) for dw in unique}
+        return [results[dw] for dw in dialect_words]
+
+class ClosestCache:
+    """A size-bounded, least recently used cache for the results of
+    :func:`text_processing.get_closest()`.
+
+    The keys are built from the version of the vocabulary, the cleaned dialect word
+    and the distance limit, so results of different vocabularies never mix.
+    The cache is safe to use from several threads. It is not shared between processes:
+    a forked child starts with a copy of the results cached in its parent at that moment,
+    a fresh lock and its own counters, and what it caches afterwards stays in the child.
+    The rule-based workers therefore only profit from it across chunks and jobs when they
+    live as long as those, see :func:`text_processing.start_pool()`.
+
+    Parameters
+    ----------
+    maxsize : integer
+        The maximum number of results kept. When given 0, nothing is cached.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._init_process()
+        # A lock that was held by another thread during the fork would never be released
+        os.register_at_fork(after_in_child=self._init_process)
+
+    def _init_process(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not hasattr(self, 'results'):
+            self.results = OrderedDict()
+
+    @staticmethod
+    def key(vocabulary, dialect_word, distance_limit):
+        return (vocabulary.version, dialect_word, distance_limit)
+
+    def get(self, key):
+        """Returns the cached result for the given key, or None if it is not cached"""
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        """Stores a result, dropping the least recently used ones beyond the size limit"""
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the counters of the cache in the current process"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self.results),
+                    'hit_rate': self.hits / total if total else 0.0}